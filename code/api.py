@@ -9,12 +9,24 @@ Arguments:
 
 """
 
+import json
 import os
 import signal
+import threading
 import time
-from flask import Flask, render_template, redirect, Response, request
-from system_manager.common import utils
+from datetime import datetime
+from flask import Flask, abort, render_template, redirect, Response, request, jsonify, send_file, \
+    stream_with_context
+from werkzeug.http import is_resource_modified
+from system_manager.common import openmetrics, utils, web
+from system_manager.common.certs import CertificateIndex
+from system_manager.common.lazy import lazy_import
 from system_manager.common.logging import logging
+from system_manager.common.logs import LogMultiplexer
+from system_manager.common.shm import SharedSnapshotReader
+from system_manager.common.stats import StatsStore
+from system_manager.common.status import NuvlaBoxStatus
+from system_manager.common.timeseries import RingBuffer, MetricsArchive
 from system_manager.Supervise import Supervise
 
 
@@ -23,9 +35,136 @@ __email__ = "support@sixsq.com"
 
 log = logging.getLogger(__name__)
 
-app = Flask(__name__)
+# only loaded once a page needs the Docker client
+docker_clients = lazy_import('system_manager.common.docker_client')
+
+# static files are served by static_file, under their content-hashed names
+app = Flask(__name__, static_folder=None)
 app.config["supervisor"] = Supervise()
 app.config["TEMPLATES_AUTO_RELOAD"] = True
+app.config["docker_stats"] = StatsStore()
+# snapshots published by the supervisor, read from shared memory
+app.config["docker_stats_reader"] = SharedSnapshotReader(utils.docker_stats_snapshot_file)
+app.config["nuvlabox_status_reader"] = SharedSnapshotReader(utils.nuvlabox_status_snapshot_file,
+                                                            decode=NuvlaBoxStatus.loads)
+app.config["openmetrics_reader"] = SharedSnapshotReader(utils.openmetrics_snapshot_file, decode=None)
+app.config["metrics_history"] = {}
+app.config["static_assets"] = web.StaticAssets(os.path.join(app.root_path, 'static'))
+app.config["compression_cache"] = web.CompressionCache()
+app.config["cert_index"] = CertificateIndex(utils.data_volume, utils.rotated_cert_files, utils.cert_rotation_margin)
+# created on first use, together with the Docker client (see get_log_multiplexer)
+app.config["log_multiplexer"] = None
+log_multiplexer_lock = threading.Lock()
+
+
+def get_log_multiplexer():
+    """ Gets the log multiplexer, creating it on first use
+
+    :returns LogMultiplexer
+    """
+
+    with log_multiplexer_lock:
+        if app.config["log_multiplexer"] is None:
+            app.config["log_multiplexer"] = LogMultiplexer(app.config["supervisor"].docker_client,
+                                                           buffer_lines=utils.log_buffer_lines,
+                                                           buffer_bytes=utils.log_buffer_bytes)
+
+    return app.config["log_multiplexer"]
+
+
+def get_docker_stats():
+    """ Gets the latest Docker stats, reloading them only if the supervisor has published new ones
+
+    :returns StatsStore
+    """
+
+    app.config["docker_stats"].refresh(app.config["docker_stats_reader"])
+    return app.config["docker_stats"]
+
+
+def get_nuvlabox_status():
+    """ Gets the NuvlaBox status, as published by the supervisor, or straight from the NuvlaBox Agent file until
+    the supervisor has published it
+
+    :returns NuvlaBoxStatus, which stays the same object, with its dashboard view, until the status changes
+    """
+
+    _, nuvlabox_status = app.config["nuvlabox_status_reader"].get()
+    if nuvlabox_status is None:
+        return app.config["supervisor"].get_nuvlabox_status()
+
+    return nuvlabox_status
+
+
+def not_modified(etag, last_modified=None):
+    """ Answers a conditional request, when the client already has the current version of the response
+
+    :param etag: ETag of the current version, from web.make_etag
+    :param last_modified: time of the current version, as a timestamp
+    :returns a 304 response, or None if the response must be sent in full
+    """
+
+    last_modified = datetime.utcfromtimestamp(last_modified) if last_modified else None
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+
+    response = Response(status=304)
+    return set_validators(response, etag, last_modified)
+
+
+def set_validators(response, etag, last_modified=None):
+    """ Sets the ETag and Last-Modified of a response, which clients must revalidate on every use
+
+    :param response: Response
+    :param etag: ETag, from web.make_etag
+    :param last_modified: datetime or timestamp
+    :returns the response
+    """
+
+    response.headers['ETag'] = etag
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = web.REVALIDATE_CACHE_CONTROL
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@app.context_processor
+def static_url_processor():
+    return {"static_url": app.config["static_assets"].url}
+
+
+@app.after_request
+def compress_response(response):
+    return web.compress_response(response, request.accept_encodings, app.config["compression_cache"])
+
+
+@app.route('/static/<path:filename>')
+def static_file(filename):
+    """ Static files. Those requested by their content-hashed name (see StaticAssets.url) can be cached for good,
+    while the others are revalidated. Precompressed variants are sent to the clients which accept them """
+
+    asset, immutable = app.config["static_assets"].find(filename)
+    if not asset:
+        abort(404)
+
+    encoding = web.negotiate_encoding(request.accept_encodings, asset.variants)
+    etag = asset.etag(encoding)
+    last_modified = datetime.utcfromtimestamp(asset.last_modified)
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+    else:
+        response = send_file(asset.variants.get(encoding, asset.path), mimetype=asset.mimetype, add_etags=False,
+                             last_modified=last_modified)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = web.IMMUTABLE_CACHE_CONTROL if immutable else web.REVALIDATE_CACHE_CONTROL
+    if asset.variants:
+        response.vary.add('Accept-Encoding')
+
+    return response
 
 
 @app.route('/')
@@ -38,87 +177,243 @@ def dashboard():
     """ Dashboard """
 
     docker_info = app.config["supervisor"].get_docker_info()
-    nuvlabox_status = app.config["supervisor"].get_nuvlabox_status()
-    docker_stats = app.config["supervisor"].reader(utils.docker_stats_html_file)
-
-    # net_stats is provided in the form of {"iface1": {"rx_bytes": X, "tx_bytes": Y}, "iface2": ...}
-    # Reference: nuvlabox/agent
-    #
-    # Need to parse it into a chartjs dataset
-    net_stats = {
-        "labels": []
-    }
-
-    rx = []
-    tx = []
-    for nstat in nuvlabox_status.get("resources", {}).get("net-stats", []):
-        iface = nstat.get('interface')
-        if not iface:
-            continue
-
-        net_stats['labels'].append(iface)
-        rx.append(float(nstat['bytes-received']))
-        tx.append(float(nstat['bytes-transmitted']))
-
-    net_stats["datasets"] = [{
-        "label": "rx_bytes",
-        "backgroundColor": "#d88d0e",
-        "borderColor": "#d88d0e",
-        "borderWidth": 1,
-        "data": rx
-    }, {
-        "label": "tx_bytes",
-        "backgroundColor": "#61acb5",
-        "borderColor": "#61acb5",
-        "borderWidth": 1,
-        "data": tx
-    }]
+    nuvlabox_status = get_nuvlabox_status()
+    docker_stats = get_docker_stats()
 
     try:
         if not nuvlabox_status:
             return render_template("loading.html")
         else:
-            return render_template("dashboard.html", cpus_total=nuvlabox_status.get("cpus"),
-                                   memory_total="%.2f GB" % float(int(nuvlabox_status.get("memory"))/1024),
-                                   disk_total="%s GB" % nuvlabox_status.get("disk"),
-                                   cpu_usage=nuvlabox_status.get("cpu-usage"),
-                                   memory_usage=nuvlabox_status.get("memory-usage"),
-                                   disk_usage=nuvlabox_status.get("disk-usage"),
-                                   os=nuvlabox_status.get("operating-system"),
-                                   arch=nuvlabox_status.get("architecture"), ip=nuvlabox_status.get("ip"),
-                                   docker_version=nuvlabox_status.get("docker-server-version"),
-                                   hostname=nuvlabox_status.get("hostname"),
-                                   containers_running=docker_info.get("ContainersRunning"),
-                                   docker_images=docker_info.get("Images"),
-                                   swarm_node_id=docker_info["Swarm"].get("NodeID"),
-                                   docker_stats=docker_stats, net_stats=net_stats,
-                                   last_boot=nuvlabox_status.get("last-boot unknown"))
+            docker_view = {"containers_running": docker_info.get("ContainersRunning"),
+                           "docker_images": docker_info.get("Images"),
+                           "swarm_node_id": docker_info["Swarm"].get("NodeID")}
+            # the page only changes with the stats, the status or the few Docker info values it shows
+            etag = web.make_etag('dashboard', docker_stats.generation, docker_stats.last_update,
+                                 nuvlabox_status.version, sorted(docker_view.items()))
+            # validated by ETag only, since the status has no modification time
+            return not_modified(etag) or set_validators(
+                Response(render_template("dashboard.html", docker_stats=docker_stats, **docker_view,
+                                         **nuvlabox_status.dashboard_view)),
+                etag, docker_stats.last_update)
     except:
         log.exception("Server side error")
         os.kill(os.getppid(), signal.SIGKILL)
 
 
-@app.route('/dashboard/logs')
-def logs():
-    """ Logs """
+@app.route('/api/stats')
+def stats():
+    """ Docker stats, as JSON, or as an HTML table if requested with ?format=html.
+
+    With text/event-stream, the stats are pushed as JSON whenever the supervisor publishes new ones """
 
-    past_logs, now = app.config["supervisor"].get_internal_logs_html()
     if request.headers.get('accept') == 'text/event-stream':
-        def generate_logs(since):
+        reader = app.config["docker_stats_reader"]
+
+        def generate_stats():
+            yield ": connected\n\n"
+            sequence = None
             while True:
-                new_logs, timestamp = app.config["supervisor"].get_internal_logs_html(since=since)
-                since = timestamp
-                yield "data: %s \n\n" % (new_logs)
-                time.sleep(5)
-        return Response(generate_logs(now), content_type='text/event-stream')
+                new_sequence, content = reader.wait(sequence, timeout=15)
+                if content is None or new_sequence == sequence:
+                    # SSE comment, to keep the connection alive
+                    yield ": keepalive\n\n"
+                    continue
+
+                sequence = new_sequence
+                yield "id: %s\ndata: %s\n\n" % (content.get("generation"), json.dumps(content))
+
+        return Response(generate_stats(), content_type='text/event-stream')
+
+    docker_stats = get_docker_stats()
+    fmt = request.args.get('format')
+    etag = web.make_etag('stats', fmt, docker_stats.generation, docker_stats.last_update)
+    response = not_modified(etag, docker_stats.last_update)
+    if response is not None:
+        return response
+
+    if fmt == 'html':
+        response = Response(render_template("docker_stats.html", docker_stats=docker_stats))
+    else:
+        response = jsonify(docker_stats.snapshot())
+
+    return set_validators(response, etag, docker_stats.last_update)
+
+
+@app.route('/metrics')
+def metrics():
+    """ Container, host and supervisor metrics, in OpenMetrics text format, as last rendered by the supervisor """
+
+    reader = app.config["openmetrics_reader"]
+    sequence, exposition = reader.get()
+    if exposition is None:
+        return Response("Metrics not collected yet\n", status=503, mimetype='text/plain')
+
+    etag = web.make_etag('metrics', sequence, reader.timestamp)
+    return not_modified(etag, reader.timestamp) or \
+        set_validators(Response(exposition, content_type=openmetrics.CONTENT_TYPE), etag, reader.timestamp)
+
+
+@app.route('/api/certs')
+def certs():
+    """ Expiry dates of the NuvlaBox certificates, and when they are due for rotation """
+
+    return jsonify(app.config["cert_index"].report())
+
+
+@app.route('/api/docker')
+def docker_api_metrics():
+    """ Docker API calls made by the dashboard and by the supervisor, per endpoint, with their latencies """
 
     try:
-        return render_template("logs.html", logs=past_logs)
+        with open(utils.docker_api_metrics_file) as m:
+            supervisor_metrics = json.load(m)
+    except (OSError, ValueError):
+        supervisor_metrics = None
+
+    return jsonify({"dashboard": docker_clients.docker_client_factory.report(), "supervisor": supervisor_metrics})
+
+
+def get_metrics_history(path):
+    """ Maps the metrics ring buffer written by the supervisor, (re)opening it when needed
+
+    :param path: ring buffer file path
+    :returns RingBuffer, or None if the supervisor has not created it yet
+    """
+
+    ring_buffer = app.config["metrics_history"].get(path)
+    if ring_buffer and not ring_buffer.is_stale():
+        return ring_buffer
+
+    if ring_buffer:
+        ring_buffer.close()
+
+    try:
+        ring_buffer = RingBuffer.open(path)
+    except (OSError, ValueError):
+        ring_buffer = None
+
+    app.config["metrics_history"][path] = ring_buffer
+    return ring_buffer
+
+
+def metrics_history_response(paths, keys=None):
+    """ Range query over the metrics history, with the time range taken from the start and end
+    query parameters (seconds since the epoch).
+
+    The query is served by the finest ring buffer going back far enough to cover the start of the range,
+    or by the one with the resolution (in seconds) requested via the resolution query parameter
+
+    :param paths: ring buffer file paths, from the finest to the coarsest resolution
+    :param keys: list of series to get. All if None
+    :returns JSON response
+    """
+
+    start = request.args.get('start', type=float)
+    resolution = request.args.get('resolution', type=float)
+
+    ring_buffers = [rb for rb in map(get_metrics_history, paths) if rb]
+    if resolution:
+        ring_buffers = [rb for rb in ring_buffers if rb.resolution == resolution]
+    if not ring_buffers:
+        return jsonify({"resolution": None, "fields": [], "series": {}})
+
+    ring_buffer = ring_buffers[-1]
+    if start is None:
+        ring_buffer = ring_buffers[0]
+    else:
+        for rb in ring_buffers:
+            if time.time() - rb.retention <= start:
+                ring_buffer = rb
+                break
+
+    series = ring_buffer.query(start=start,
+                               end=request.args.get('end', type=float),
+                               keys=keys)
+
+    return jsonify({"resolution": ring_buffer.resolution,
+                    "fields": ["timestamp"] + ring_buffer.fields,
+                    "series": series})
+
+
+def metrics_history_paths(name, live_path):
+    """ Ring buffer file paths for a metrics stream, from the live one to the coarsest archive level """
+
+    return [live_path] + [MetricsArchive.level_path(utils.metrics_archive_folder, name, resolution)
+                          for resolution, _ in utils.metrics_archive_levels]
+
+
+@app.route('/api/stats/history')
+def stats_history():
+    """ Docker stats history. Filter by container name with ?container=name (can be repeated) """
+
+    containers = request.args.getlist('container') or None
+    return metrics_history_response(metrics_history_paths('containers', utils.container_metrics_file),
+                                    keys=containers)
+
+
+@app.route('/api/status/history')
+def status_history():
+    """ NuvlaBox host usages history """
+
+    return metrics_history_response(metrics_history_paths('host', utils.host_metrics_file))
+
+
+@app.route('/dashboard/logs')
+def logs():
+    """ Logs. The live stream (text/event-stream) is sent as HTML, or as NDJSON with ?format=ndjson """
+
+    multiplexer = get_log_multiplexer()
+    if request.headers.get('accept') == 'text/event-stream':
+        fmt = request.args.get('format', 'html')
+        # resume from the last line the viewer got, either from the page or from a previous connection
+        after = request.args.get('after', type=int)
+        if request.headers.get('Last-Event-ID', '').isdigit():
+            after = int(request.headers['Last-Event-ID'])
+
+        subscription = multiplexer.subscribe(after=after)
+
+        def generate_logs():
+            try:
+                # sends the response headers right away, without waiting for the first lines
+                yield ": connected\n\n"
+                while True:
+                    batch = subscription.get_batch(timeout=15)
+                    if not batch:
+                        # SSE comment, to keep the connection alive
+                        yield ": keepalive\n\n"
+                        continue
+
+                    if fmt == 'ndjson':
+                        yield "id: %s\n%s\n" % (batch[-1].sequence, ''.join('data: ' + line.ndjson for line in batch))
+                    else:
+                        yield "id: %s\ndata: %s \n\n" % (batch[-1].sequence, ''.join(line.html for line in batch))
+            finally:
+                multiplexer.unsubscribe(subscription)
+
+        return Response(generate_logs(), content_type='text/event-stream')
+
+    past_logs, last_sequence = multiplexer.tail()
+    try:
+        return render_template("logs.html", logs=''.join(line.html for line in past_logs),
+                               last_sequence=last_sequence)
     except:
         log.exception("Server side error")
         os.kill(os.getppid(), signal.SIGKILL)
 
 
+@app.route('/api/logs')
+def export_logs():
+    """ Streams the logs of all NuvlaBox containers, straight from Docker, as NDJSON (default)
+    or as HTML with ?format=html. Use ?tail=N (default 30) and ?since=timestamp to select the lines """
+
+    fmt = request.args.get('format', 'ndjson')
+    lines = app.config["supervisor"].iter_internal_logs(tail=request.args.get('tail', 30, type=int),
+                                                        since=request.args.get('since', type=int))
+
+    return Response(stream_with_context(line.render(fmt) for line in lines),
+                    mimetype='application/x-ndjson' if fmt == 'ndjson' else 'text/html')
+
+
 @app.route('/dashboard/peripherals')
 def peripherals():
     """ Logs """
@@ -0,0 +1,187 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+"""NuvlaBox System Manager service - dashboard load test
+
+Opens a number of live log streams (/dashboard/logs) and of live stats streams (/api/stats), as text/event-stream,
+against a running dashboard, and keeps them open while measuring the latency of the dashboard pages. The stats
+streams must keep getting the stats the supervisor publishes, however many there are.
+
+Meant to be run against the system-manager container, e.g. from the container itself:
+
+    python3 benchmarks/dashboard_load.py --streams 20 --stats-streams 20 --requests 200
+
+Arguments:
+    --url: dashboard base URL (default http://127.0.0.1:3636)
+    --streams: number of concurrent log streams (default 20)
+    --stats-streams: number of concurrent stats streams (default 20)
+    --requests: number of requests per page (default 200)
+    --concurrency: number of clients requesting the pages at the same time (default 4)
+    --pages: comma separated pages to request (default /dashboard,/dashboard/peripherals)
+    --timeout: request timeout, in seconds (default 30)
+    --json: print the raw results as JSON
+"""
+
+import argparse
+import concurrent.futures
+import http.client
+import json
+import socket
+import statistics
+import threading
+import time
+from urllib.parse import urlsplit
+
+__copyright__ = "Copyright (C) 2020 SixSq"
+__email__ = "support@sixsq.com"
+
+
+class EventStream(object):
+    """ A live event stream, opened and read in the background until closed """
+
+    def __init__(self, host, port, path, timeout):
+        """ Opens the stream
+
+        :param host: dashboard host
+        :param port: dashboard port
+        :param path: e.g. /dashboard/logs
+        :param timeout: connection timeout, in seconds
+        """
+
+        self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+        self.path = path
+        self.connected = False
+        self.received = 0
+        self.events = 0
+        self.error = None
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        try:
+            self.connection.request('GET', self.path, headers={'Accept': 'text/event-stream'})
+            response = self.connection.getresponse()
+            self.connected = response.status == 200
+            while True:
+                line = response.readline()
+                if not line:
+                    break
+                self.received += len(line)
+                if line.startswith(b'data:'):
+                    self.events += 1
+        except Exception as e:
+            self.error = e
+
+    @property
+    def open(self):
+        """ Whether the server is streaming """
+
+        return self.connected and self.thread.is_alive()
+
+    def close(self):
+        # shutting the socket down unblocks the reading thread, which closing the connection would wait for
+        try:
+            self.connection.sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
+        self.thread.join(timeout=1)
+        self.connection.close()
+
+
+def timed_request(host, port, path, timeout):
+    """ Requests a page on a new connection
+
+    :returns (latency in seconds, HTTP status), with a None status on error
+    """
+
+    start = time.perf_counter()
+    connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        response.read()
+        status = response.status
+    except Exception:
+        status = None
+    finally:
+        connection.close()
+
+    return time.perf_counter() - start, status
+
+
+def percentile(values, p):
+    """ p-th percentile of the values, by the nearest rank method """
+
+    ordered = sorted(values)
+    return ordered[max(int(round(p / 100 * len(ordered))) - 1, 0)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NuvlaBox System Manager dashboard load test')
+    parser.add_argument('--url', default='http://127.0.0.1:3636', help='dashboard base URL')
+    parser.add_argument('--streams', type=int, default=20, help='number of concurrent log streams')
+    parser.add_argument('--stats-streams', type=int, default=20, help='number of concurrent stats streams')
+    parser.add_argument('--requests', type=int, default=200, help='number of requests per page')
+    parser.add_argument('--concurrency', type=int, default=4, help='number of concurrent page clients')
+    parser.add_argument('--pages', default='/dashboard,/dashboard/peripherals', help='comma separated pages')
+    parser.add_argument('--timeout', type=float, default=30, help='request timeout, in seconds')
+    parser.add_argument('--json', action='store_true', help='print the raw results as JSON')
+    args = parser.parse_args()
+
+    url = urlsplit(args.url)
+    host, port = url.hostname, url.port or 80
+
+    streams = [EventStream(host, port, '/dashboard/logs', args.timeout) for _ in range(args.streams)]
+    stats_streams = [EventStream(host, port, '/api/stats', args.timeout) for _ in range(args.stats_streams)]
+    # let the streams settle
+    time.sleep(1)
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for page in args.pages.split(','):
+            responses = list(executor.map(lambda _: timed_request(host, port, page, args.timeout),
+                                          range(args.requests)))
+            latencies = [latency for latency, status in responses if status == 200]
+            results[page] = {
+                "requests": len(responses),
+                "errors": len(responses) - len(latencies),
+                "p50": percentile(latencies, 50) if latencies else None,
+                "p95": percentile(latencies, 95) if latencies else None,
+                "p99": percentile(latencies, 99) if latencies else None,
+                "max": max(latencies) if latencies else None,
+                "mean": statistics.mean(latencies) if latencies else None
+            }
+
+    results["streams"] = {"requested": len(streams),
+                          "open": sum(1 for stream in streams if stream.open),
+                          "bytes-received": sum(stream.received for stream in streams)}
+    # each stats stream should have got every publication made while it was open
+    results["stats-streams"] = {"requested": len(stats_streams),
+                                "open": sum(1 for stream in stats_streams if stream.open),
+                                "min-events": min((stream.events for stream in stats_streams), default=0),
+                                "max-events": max((stream.events for stream in stats_streams), default=0)}
+    for stream in streams + stats_streams:
+        stream.close()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f'{args.streams} log streams and {args.stats_streams} stats streams requested, {args.concurrency} '
+          f'concurrent clients, latencies in seconds:')
+    for page, result in results.items():
+        if page in ('streams', 'stats-streams'):
+            continue
+        if not result["p99"]:
+            print(f'  {page:<24} all {result["requests"]} requests failed')
+            continue
+        print(f'  {page:<24} p50 {result["p50"]:>7.3f}   p95 {result["p95"]:>7.3f}   p99 {result["p99"]:>7.3f}   '
+              f'max {result["max"]:>7.3f}   errors {result["errors"]}/{result["requests"]}')
+    print(f'  log streams open at the end: {results["streams"]["open"]}/{args.streams}')
+    stats_results = results["stats-streams"]
+    print(f'  stats streams open at the end: {stats_results["open"]}/{args.stats_streams}, '
+          f'stats received per stream: {stats_results["min-events"]} to {stats_results["max-events"]}')
+
+
+if __name__ == '__main__':
+    main()
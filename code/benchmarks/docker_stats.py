@@ -0,0 +1,101 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+"""NuvlaBox System Manager service - Docker stats benchmark
+
+Compares the Docker stats modes (see utils.docker_stats_mode) over the containers running on this host, by timing
+full collection passes: their wall-clock time, the CPU time they cost to this process, and the number of
+/containers/{id}/stats calls they make to the Docker daemon.
+
+Meant to be run inside the system-manager container, on the target hardware:
+
+    python3 benchmarks/docker_stats.py --passes 10
+
+Arguments:
+    --passes: number of timed passes per mode (default 10)
+    --modes: comma separated modes to compare (default stream,oneshot,cgroup)
+    --json: print the raw results as JSON
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from system_manager.common import utils
+from system_manager.common.docker_client import docker_client_factory
+from system_manager.Supervise import Supervise
+
+__copyright__ = "Copyright (C) 2020 SixSq"
+__email__ = "support@sixsq.com"
+
+STATS_ENDPOINT = 'GET /containers/{id}/stats'
+
+
+def stats_calls():
+    """ Number of Docker stats API calls made so far by this process """
+
+    return docker_client_factory.report()["endpoints"].get(STATS_ENDPOINT, {}).get("calls", 0)
+
+
+def run_mode(supervisor, containers, mode, passes):
+    """ Times collection passes in a given mode, after a warm-up pass
+
+    :param supervisor: Supervise object
+    :param containers: list of container objects
+    :param mode: Docker stats mode
+    :param passes: number of timed passes
+    :returns dict with the per-pass wall-clock and CPU times, the API calls and the errors of the last pass
+    """
+
+    utils.docker_stats_mode = mode
+    supervisor.previous_cpu_stats.clear()
+    supervisor.collect_docker_stats(containers)
+
+    wall = []
+    cpu = []
+    calls = stats_calls()
+    errors = []
+    for _ in range(passes):
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        usages, errors = supervisor.collect_docker_stats(containers)
+        cpu.append(time.process_time() - start_cpu)
+        wall.append(time.perf_counter() - start_wall)
+
+    return {"wall": wall,
+            "cpu": cpu,
+            "api-calls-per-pass": (stats_calls() - calls) / passes,
+            "sampled": len(usages),
+            "errors": errors}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NuvlaBox System Manager Docker stats benchmark')
+    parser.add_argument('--passes', type=int, default=10, help='number of timed passes per mode')
+    parser.add_argument('--modes', default='stream,oneshot,cgroup', help='comma separated modes to compare')
+    parser.add_argument('--json', action='store_true', help='print the raw results as JSON')
+    args = parser.parse_args()
+
+    supervisor = Supervise()
+    containers = supervisor.docker_client.containers.list()
+    results = {mode: run_mode(supervisor, containers, mode, args.passes) for mode in args.modes.split(',')}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f'{len(containers)} containers, {args.passes} passes per mode (seconds per pass):')
+    for mode, result in results.items():
+        print(f'  {mode:<8} wall median {statistics.median(result["wall"]):>8.4f}   max {max(result["wall"]):>8.4f}   '
+              f'cpu median {statistics.median(result["cpu"]):>8.4f}   '
+              f'stats API calls {result["api-calls-per-pass"]:>5.1f}   '
+              f'sampled {result["sampled"]}   errors {len(result["errors"])}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+"""NuvlaBox System Manager service - startup benchmark
+
+Measures, in fresh Python processes, how long it takes from the process start until:
+ - the dashboard (api.py) is imported, and until it has served its first /dashboard page
+ - the supervisor is constructed, and until it has completed its first cycle of monitoring tasks
+
+The probes only read from the live system: their metrics history (RUNTIME_FOLDER and the metrics archive) goes to a
+temporary folder, and the supervisor tasks which act on the containers (the datagateway supervision) are left out.
+
+Meant to be run inside the system-manager container, on the target hardware:
+
+    python3 benchmarks/startup.py --runs 5
+
+Arguments:
+    --runs: number of fresh processes per target (default 5)
+    --target: dashboard, supervisor or all (default all)
+    --json: print the raw results as JSON
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+__copyright__ = "Copyright (C) 2020 SixSq"
+__email__ = "support@sixsq.com"
+
+CODE_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# each probe prints one "<milestone> <time.time()>" line per milestone it reaches
+DASHBOARD_PROBE = '''
+import os
+import time
+import api
+# on server errors, the dashboard kills its parent process (the gunicorn master): make it kill the probe instead
+os.getppid = os.getpid
+print("imported", time.time(), flush=True)
+response = api.app.test_client().get("/dashboard")
+print("first-dashboard", time.time(), flush=True)
+print("status", response.status_code, flush=True)
+'''
+
+SUPERVISOR_PROBE = '''
+import time
+from system_manager.Supervise import Supervise
+print("imported", time.time(), flush=True)
+supervisor = Supervise()
+supervisor.init_metrics_history()
+print("constructed", time.time(), flush=True)
+supervisor.update_docker_stats()
+print("docker-stats", time.time(), flush=True)
+supervisor.record_host_metrics()
+supervisor.is_cert_rotation_needed()
+print("first-cycle", time.time(), flush=True)
+'''
+
+PROBES = {"dashboard": DASHBOARD_PROBE, "supervisor": SUPERVISOR_PROBE}
+
+
+def run_probe(probe):
+    """ Runs a probe in a fresh Python process
+
+    :param probe: Python code, printing its milestones
+    :returns dict of milestone -> seconds since the process was spawned
+    """
+
+    with tempfile.TemporaryDirectory(prefix='startup-benchmark-') as scratch:
+        # keep the probe away from the live ring buffers and archives, which have a single writer
+        env = dict(os.environ, RUNTIME_FOLDER=scratch, METRICS_ARCHIVE_FOLDER=os.path.join(scratch, 'archive'))
+        start = time.time()
+        result = subprocess.run([sys.executable, '-c', probe], cwd=CODE_FOLDER, env=env, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, universal_newlines=True)
+        result_time = time.time()
+
+    if result.returncode != 0:
+        raise RuntimeError(f'Probe failed with exit code {result.returncode}: {result.stderr.strip()}')
+
+    milestones = {}
+    for line in result.stdout.splitlines():
+        name, _, value = line.partition(' ')
+        if name == 'status':
+            milestones[name] = int(value)
+        elif name in ('imported', 'constructed', 'docker-stats', 'first-dashboard', 'first-cycle'):
+            milestones[name] = round(float(value) - start, 4)
+
+    milestones["total"] = round(result_time - start, 4)
+    return milestones
+
+
+def summarize(runs):
+    """ Min, median and max of each milestone
+
+    :param runs: list of milestone dicts, see run_probe
+    :returns dict of milestone -> {"min", "median", "max"}
+    """
+
+    summary = {}
+    for name in runs[0]:
+        if name == 'status':
+            continue
+        values = [run[name] for run in runs if name in run]
+        summary[name] = {"min": min(values), "median": round(statistics.median(values), 4), "max": max(values)}
+
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NuvlaBox System Manager startup benchmark')
+    parser.add_argument('--runs', type=int, default=5, help='number of fresh processes per target')
+    parser.add_argument('--target', choices=['dashboard', 'supervisor', 'all'], default='all')
+    parser.add_argument('--json', action='store_true', help='print the raw results as JSON')
+    args = parser.parse_args()
+
+    targets = list(PROBES) if args.target == 'all' else [args.target]
+    results = {}
+    for target in targets:
+        runs = [run_probe(PROBES[target]) for _ in range(args.runs)]
+        results[target] = {"runs": runs, "summary": summarize(runs)}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for target, result in results.items():
+        print(f'{target} ({args.runs} runs, seconds since the process was spawned):')
+        for milestone, values in result["summary"].items():
+            print(f'  {milestone:<16} min {values["min"]:>8.3f}   median {values["median"]:>8.3f}   '
+                  f'max {values["max"]:>8.3f}')
+
+
+if __name__ == '__main__':
+    main()
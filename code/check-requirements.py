@@ -27,10 +27,12 @@ log = logging.getLogger(__name__)
 def run_requirements_check():
     if not MinReq.SKIP_MINIMUM_REQUIREMENTS:
         # Check if the system complies with the minimum hw and sw requirements for the NuvlaBox
-        system_requirements = MinReq.SystemRequirements()
-        software_requirements = MinReq.SoftwareRequirements()
+        report = MinReq.RequirementsProbe().run()
+        log.info(f"Requirements checked in {report['duration']} seconds: "
+                 + ", ".join(f"{name}: {'OK' if check['ok'] else 'FAILED'} ({check['detail']})"
+                             for name, check in report["checks"].items()))
 
-        if not software_requirements.check_docker_requirements() or not system_requirements.check_all_hw_requirements():
+        if not report["ok"]:
             log.error("System does not meet the minimum requirements! Stopping")
             utils.cleanup(utils.list_internal_containers(), utils.docker_id)
             sys.exit(1)
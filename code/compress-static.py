@@ -0,0 +1,31 @@
+#!/usr/local/bin/python
+# -*- coding: utf-8 -*-
+
+"""NuvlaBox System Manager service - compress static files
+
+Points the stylesheets to the content-hashed names of the files they use (e.g. the webfonts), then writes the gzip
+and brotli variants of the dashboard static files next to them, with the best compression, so that they are not
+compressed on every request. Run when building the image
+
+Arguments:
+    folder: static folder (default: static, next to this script)
+"""
+
+import os
+import sys
+from system_manager.common import web
+from system_manager.common.logging import logging
+
+__copyright__ = "Copyright (C) 2020 SixSq"
+__email__ = "support@sixsq.com"
+
+
+log = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+    folder = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    rewritten = web.hash_css_references(folder)
+    log.info(f'Rewrote {rewritten} stylesheet references with content-hashed names in {folder}')
+    written = web.precompress(folder)
+    log.info(f'Wrote {written} precompressed variants ({", ".join(web.ENCODINGS)}) of the files in {folder}')
@@ -8,9 +8,14 @@ supervises all internal components of the NuvlaBox
 Arguments:
 
 """
+import atexit
 import requests
-import time
+import signal
+from system_manager.common import utils
+from system_manager.common.docker_client import docker_client_factory
+from system_manager.common.events import DockerEventWatcher
 from system_manager.common.logging import logging
+from system_manager.common.scheduler import Scheduler, Task
 from system_manager.Supervise import Supervise
 
 __copyright__ = "Copyright (C) 2020 SixSq"
@@ -18,36 +23,98 @@ __email__ = "support@sixsq.com"
 
 log = logging.getLogger(__name__)
 self_sup = Supervise()
+self_sup.init_shared_snapshots()
+self_sup.init_metrics_history()
+atexit.register(self_sup.flush_metrics_archive)
 
+if utils.supervision_mode == 'events':
+    event_watcher = DockerEventWatcher(self_sup.docker_client,
+                                       {"type": "container", "event": ["die", "stop", "destroy", "start"]},
+                                       self_sup.handle_container_event)
+    event_watcher.start()
 
-while True:
-    # docker_stats streaming
-    try:
-        self_sup.write_docker_stats_table_html()
-    except requests.exceptions.ConnectionError:
-        raise
-    except:
-        # catch all exceptions, cause if there's any problem, we simply want the thread to restart
-        log.exception("Restarting Docker stats streamer...")
 
-    # certificate rotation check
+def check_certificates():
+    """ Requests the rotation of the NuvlaBox certificates if they are about to expire
+
+    :returns seconds until the next check: at the latest when the certificates are due for rotation
+    """
+
     if self_sup.is_cert_rotation_needed():
         log.info("Rotating NuvlaBox certificates...")
         self_sup.request_rotate_certificates()
+        return utils.cert_check_interval
+
+    until_rotation = self_sup.time_until_cert_rotation()
+    if until_rotation:
+        return min(until_rotation, utils.cert_check_interval)
+
+    return utils.cert_check_interval
+
+
+def check_docker_health():
+    """ Pings the Docker daemon, and publishes the Docker API call metrics of the supervisor """
+
+    docker_client_factory.check_health()
+    docker_client_factory.save_report(utils.docker_api_metrics_file)
+
+
+def export_metrics():
+    """ Publishes the OpenMetrics exposition, with the supervisor's own task timings and Docker API calls """
+
+    self_sup.export_metrics(scheduler_report=scheduler.report(), docker_api_report=docker_client_factory.report())
+
+
+# in event-driven mode, the datagateway checks below are only a safety net for missed events
+if utils.supervision_mode == 'events':
+    datagateway_check_interval = utils.supervision_reconciliation_interval
+else:
+    datagateway_check_interval = utils.datagateway_check_interval
+
+scheduler = Scheduler(max_workers=utils.scheduler_workers)
+
+# docker_stats streaming. A connection error with the Docker daemon stops the supervisor, so that it gets restarted
+scheduler.add(Task('docker-stats', self_sup.update_docker_stats, utils.docker_stats_interval,
+                   timeout=utils.docker_stats_timeout * 2,
+                   fatal_exceptions=(requests.exceptions.ConnectionError,)))
+
+scheduler.add(Task('host-metrics', self_sup.record_host_metrics, utils.metrics_resolution))
+
+# certificate rotation check
+scheduler.add(Task('cert-rotation', check_certificates, utils.cert_check_interval, timeout=60, jitter=60))
+
+# COPING WITH CORNER CASE ISSUES 1
+# https://github.com/docker/for-linux/issues/293
+# this bug causes Traefik (datagateway) to go into a exited state, regardless of the Docker restart policy
+# it can happen because of abrupt system reboots, broken bind-mounts, or even Docker daemon error
+# This check serves as an external boost for the datagateway to recover when in such situations
+scheduler.add(Task('datagateway', self_sup.keep_datagateway_up, datagateway_check_interval,
+                   timeout=30, jitter=datagateway_check_interval / 10))
+
+# COPING WITH CORNER CASE ISSUES 2
+# https://github.com/docker/compose/issues/6385
+# occasionally, a container restart might fail to
+# find the overlay nuvlabox-shared-netword: "failed to get network during CreateEndpoint: network"
+# It might be solved in recent versions of Docker: https://github.com/moby/moby/pull/41189
+# But for older versions, this routine makes sure the datagateway data-source* containers are kept alive
+scheduler.add(Task('datagateway-containers', self_sup.keep_datagateway_containers_up, datagateway_check_interval,
+                   timeout=60, jitter=datagateway_check_interval / 10))
+
+scheduler.add(Task('docker-health', check_docker_health, utils.docker_health_check_interval, timeout=10))
+
+scheduler.add(Task('metrics-export', export_metrics, utils.metrics_export_interval, timeout=10))
+
+
+
+def shutdown(signum, frame):
+    """ On SIGTERM (docker stop), stops scheduling the tasks and writes the metrics history collected so far to
+    disk, including the rollups which are not over yet: atexit handlers are not run on a signal """
+
+    log.info(f'Received signal {signum}: stopping the supervisor')
+    scheduler.stop()
+    self_sup.flush_metrics_archive(close_buckets=True)
+
+
+signal.signal(signal.SIGTERM, shutdown)
 
-    # COPING WITH CORNER CASE ISSUES 1
-    # https://github.com/docker/for-linux/issues/293
-    # this bug causes Traefik (datagateway) to go into a exited state, regardless of the Docker restart policy
-    # it can happen because of abrupt system reboots, broken bind-mounts, or even Docker daemon error
-    # This check serves as an external boost for the datagateway to recover when in such situations
-    self_sup.keep_datagateway_up()
-
-    # COPING WITH CORNER CASE ISSUES 2
-    # https://github.com/docker/compose/issues/6385
-    # occasionally, a container restart might fail to
-    # find the overlay nuvlabox-shared-netword: "failed to get network during CreateEndpoint: network"
-    # It might be solved in recent versions of Docker: https://github.com/moby/moby/pull/41189
-    # But for older versions, this routine makes sure the datagateway data-source* containers are kept alive
-    self_sup.keep_datagateway_containers_up()
-
-    time.sleep(3)
+scheduler.run_forever()
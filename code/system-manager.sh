@@ -4,6 +4,20 @@ set -xe
 
 ./check-requirements.py
 
-gunicorn --bind=0.0.0.0:3636 --threads=2 --worker-class=gthread --workers=1 --reload wsgi:app --daemon
+# the dashboard is served by a gevent worker, where each open live stream (logs, stats) costs a greenlet instead of
+# a thread. DASHBOARD_WORKER_CLASS=gthread goes back to a pool of DASHBOARD_THREADS threads.
+# Code reloading is only meant for development: DASHBOARD_RELOAD=true
+DASHBOARD_WORKER_CLASS=${DASHBOARD_WORKER_CLASS:-gevent}
+DASHBOARD_WORKER_CONNECTIONS=${DASHBOARD_WORKER_CONNECTIONS:-1000}
+DASHBOARD_THREADS=${DASHBOARD_THREADS:-2}
+RELOAD=""
+if [ "${DASHBOARD_RELOAD}" = "true" ]
+then
+  RELOAD="--reload"
+fi
 
-./run.py
\ No newline at end of file
+gunicorn --bind=0.0.0.0:3636 --workers=1 --worker-class=${DASHBOARD_WORKER_CLASS} \
+  --worker-connections=${DASHBOARD_WORKER_CONNECTIONS} --threads=${DASHBOARD_THREADS} ${RELOAD} wsgi:app --daemon
+
+# exec, so that the supervisor gets the SIGTERM from docker stop, and can save the metrics history
+exec ./run.py
@@ -3,11 +3,14 @@
 
 """ Check system requirements for the NuvlaBox Engine """
 
+import json
 import multiprocessing
 import logging
 import shutil
-import docker
 import os
+import time
+from system_manager.common import utils
+from system_manager.common.docker_client import get_docker_client
 
 
 SKIP_MINIMUM_REQUIREMENTS = False
@@ -15,26 +18,72 @@ if 'SKIP_MINIMUM_REQUIREMENTS' in os.environ and \
         str(os.environ.get('SKIP_MINIMUM_REQUIREMENTS', "false")).lower() == "true":
     SKIP_MINIMUM_REQUIREMENTS = True
 
+MINIMUM_REQUIREMENTS = {
+    "cpu": 1,
+    "ram": 768,
+    "disk": 1,
+    "docker_version": 18
+}
+
+
+def get_boot_id():
+    """ Gets the ID of the current host boot, which changes on every reboot """
+
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as b:
+            return b.read().strip()
+    except OSError:
+        return None
+
+
+class DockerFacts(object):
+    """ Everything the requirements are checked against, from a single docker info call """
+
+    def __init__(self, docker_client):
+        """ Fetches docker info
+
+        :param docker_client: Docker client
+        """
+
+        self.info = docker_client.info()
+
+    @property
+    def engine_id(self):
+        """ ID of the Docker engine """
+
+        return self.info.get("ID")
+
+    @property
+    def server_version(self):
+        """ Version of the Docker engine """
+
+        return self.info.get("ServerVersion", "")
+
+    @property
+    def swarm(self):
+        """ Swarm state of the node: LocalNodeState, ControlAvailable, NodeID... """
+
+        return self.info.get("Swarm") or {}
+
 
 class SystemRequirements(object):
     """ The SystemRequirements contains all the methods and
     definitions for checking whether a device is physically capable of
     hosting the NuvlaBox Engine
 
-    Attributes:
-
+    Each check returns whether it passed, and a description of what was found
     """
 
-    def __init__(self):
-        """ Constructs an SystemRequirements object """
+    def __init__(self, facts, minimum_requirements=None):
+        """ Constructs an SystemRequirements object
+
+        :param facts: DockerFacts
+        :param minimum_requirements: defaults to MINIMUM_REQUIREMENTS
+        """
 
         self.log = logging.getLogger(__name__)
-        self.minimum_requirements = {
-            "cpu": 1,
-            "ram": 768,
-            "disk": 1
-        }
-        self.docker_client = docker.from_env()
+        self.minimum_requirements = minimum_requirements or MINIMUM_REQUIREMENTS
+        self.facts = facts
 
     def check_cpu_requirements(self):
         """ Check the device for the CPU requirements according to the
@@ -43,24 +92,24 @@ class SystemRequirements(object):
         cpu_count = int(multiprocessing.cpu_count())
 
         if cpu_count < self.minimum_requirements["cpu"]:
-            logging.error("Your device only provides {} CPUs. MIN REQUIREMENTS: {}"
-                                .format(cpu_count, self.minimum_requirements["cpu"]))
-            return False
+            self.log.error("Your device only provides {} CPUs. MIN REQUIREMENTS: {}"
+                           .format(cpu_count, self.minimum_requirements["cpu"]))
+            return False, f"{cpu_count} CPUs"
         else:
-            return True
+            return True, f"{cpu_count} CPUs"
 
     def check_ram_requirements(self):
         """ Check the device for the RAM requirements according to the
          recommended ones """
 
-        total_ram = round((self.docker_client.info()['MemTotal']/1024/1024), 2)
+        total_ram = round((self.facts.info['MemTotal']/1024/1024), 2)
 
         if total_ram < self.minimum_requirements["ram"]:
             self.log.error("Your device only provides {} MBs of memory. MIN REQUIREMENTS: {} MBs"
-                          .format(total_ram, self.minimum_requirements["ram"]))
-            return False
+                           .format(total_ram, self.minimum_requirements["ram"]))
+            return False, f"{total_ram} MBs of memory"
         else:
-            return True
+            return True, f"{total_ram} MBs of memory"
 
     def check_disk_requirements(self):
         """ Check the device for the disk requirements according to the
@@ -70,15 +119,17 @@ class SystemRequirements(object):
 
         if total_disk < self.minimum_requirements["disk"]:
             self.log.error("Your device only provides {} GBs of disk. MIN REQUIREMENTS: {} GBs"
-                          .format(total_disk, self.minimum_requirements["disk"]))
-            return False
+                           .format(total_disk, self.minimum_requirements["disk"]))
+            return False, f"{total_disk} GBs of disk"
         else:
-            return True
+            return True, f"{total_disk} GBs of disk"
 
-    def check_all_hw_requirements(self):
-        """ Runs all checks """
+    def checks(self):
+        """ All checks, by name """
 
-        return self.check_cpu_requirements() and self.check_disk_requirements() and self.check_ram_requirements()
+        return {"cpu": self.check_cpu_requirements,
+                "ram": self.check_ram_requirements,
+                "disk": self.check_disk_requirements}
 
 
 class SoftwareRequirements(object):
@@ -86,53 +137,121 @@ class SoftwareRequirements(object):
     definitions for checking whether a device has all the Software
     dependencies and configurations required by the NuvlaBox Engine
 
-    Attributes:
-
+    Each check returns whether it passed, and a description of what was found
     """
 
-    def __init__(self):
-        """ Constructs the class """
+    def __init__(self, facts, minimum_requirements=None):
+        """ Constructs the class
 
-        self.log = logging.getLogger(__name__)
+        :param facts: DockerFacts
+        :param minimum_requirements: defaults to MINIMUM_REQUIREMENTS
+        """
 
-        self.minimum_requirements = {
-            "docker_version": 18
-        }
-        self.docker_client = docker.from_env()
+        self.log = logging.getLogger(__name__)
+        self.minimum_requirements = minimum_requirements or MINIMUM_REQUIREMENTS
+        self.facts = facts
 
-    def check_docker_requirements(self):
+    def check_docker_version(self):
         """ Checks if Docker version is high enough """
 
-        docker_major_version = int(self.docker_client.version()["Components"][0]["Version"].split(".")[0])
+        docker_version = self.facts.server_version
+        docker_major_version = int(docker_version.split(".")[0])
 
         if docker_major_version < self.minimum_requirements["docker_version"]:
             self.log.error("Your Docker version is too old: {}. MIN REQUIREMENTS: Docker {} or newer"
-                         .format(docker_major_version, self.minimum_requirements["docker_version"]))
-            return False
+                           .format(docker_major_version, self.minimum_requirements["docker_version"]))
+            return False, f"Docker {docker_version}"
         else:
-            if not self.check_active_swarm():
-                self.log.error("The minimum requirements for your Docker setup are not met!")
-                return False
-            else:
-                return True
+            return True, f"Docker {docker_version}"
 
     def check_active_swarm(self):
         """ Checks that the device is running on Swarm mode """
 
-        if not self.docker_client.swarm.attrs:
+        if self.facts.swarm.get("LocalNodeState") != "active":
             self.log.error("Your device is not running in Swarm mode! "
-                            "To install the NuvlaBox Engine, please first run 'docker swarm init'")
-            return False
-        elif not self.check_is_swarm_manager():
-            self.log.error("Your device is not a Swarm manager! "
-                          "The NuvlaBox Engine can only run in Swarm Manager nodes")
-            return False
+                           "To install the NuvlaBox Engine, please first run 'docker swarm init'")
+            return False, "Swarm mode is not active"
         else:
-            return True
+            return True, "Swarm mode is active"
 
     def check_is_swarm_manager(self):
         """ Checks that the device is a Swarm manager """
 
-        return self.docker_client.info()["Swarm"]["NodeID"] in \
-            [manager["NodeID"] for manager in self.docker_client.info()["Swarm"]["RemoteManagers"]]
+        if not self.facts.swarm.get("ControlAvailable"):
+            self.log.error("Your device is not a Swarm manager! "
+                           "The NuvlaBox Engine can only run in Swarm Manager nodes")
+            return False, "Not a Swarm manager"
+        else:
+            return True, "Swarm manager"
+
+    def checks(self):
+        """ All checks, by name """
+
+        return {"docker-version": self.check_docker_version,
+                "swarm-active": self.check_active_swarm,
+                "swarm-manager": self.check_is_swarm_manager}
+
+
+class RequirementsProbe(object):
+    """ Checks all the requirements against a single docker info call, and keeps a report of the results """
 
+    def __init__(self, docker_client=None, report_file=None, minimum_requirements=None):
+        """ Constructs the probe
+
+        :param docker_client: Docker client. Defaults to the process-wide one
+        :param report_file: file where the last report is written. Defaults to utils.requirements_report_file
+        :param minimum_requirements: defaults to MINIMUM_REQUIREMENTS
+        """
+
+        self.log = logging.getLogger(__name__)
+        self.docker_client = docker_client or get_docker_client()
+        self.report_file = report_file or utils.requirements_report_file
+        self.minimum_requirements = minimum_requirements or MINIMUM_REQUIREMENTS
+
+    def save_report(self, report):
+        """ Atomically writes the report into the report file
+
+        :param report: dict
+        """
+
+        tmp_path = f'{self.report_file}.tmp'
+        try:
+            with open(tmp_path, 'w') as c:
+                json.dump(report, c, indent=2)
+            os.replace(tmp_path, self.report_file)
+        except OSError as e:
+            self.log.warning(f"Unable to save the requirements report into {self.report_file}: {str(e)}")
+
+    def run(self):
+        """ Checks all requirements
+
+        :returns report: {"ok": bool, "duration": seconds, "checks": {name: {"ok": bool, "detail": str}}, ...}
+        """
+
+        start = time.time()
+        facts = DockerFacts(self.docker_client)
+
+        checks = {}
+        checks.update(SystemRequirements(facts, self.minimum_requirements).checks())
+        checks.update(SoftwareRequirements(facts, self.minimum_requirements).checks())
+
+        results = {}
+        for name, check in checks.items():
+            try:
+                ok, detail = check()
+            except Exception as e:
+                self.log.exception(f"Unable to check the {name} requirement")
+                ok, detail = False, f"check failed: {str(e)}"
+            results[name] = {"ok": ok, "detail": detail}
+
+        report = {
+            "ok": all(result["ok"] for result in results.values()),
+            "engine-id": facts.engine_id,
+            "boot-id": get_boot_id(),
+            "minimum-requirements": self.minimum_requirements,
+            "checked-at": time.time(),
+            "duration": round(time.time() - start, 3),
+            "checks": results
+        }
+        self.save_report(report)
+        return report
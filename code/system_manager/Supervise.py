@@ -3,16 +3,32 @@
 
 """ Contains the supervising class for all NuvlaBox Engine components """
 
-import docker
+import concurrent.futures
 import logging
-import json
 import time
 import os
-import glob
-import OpenSSL
-import requests
+import threading
 from datetime import datetime
-from system_manager.common import utils
+from system_manager.common import openmetrics, utils
+from system_manager.common.certs import CertificateIndex
+from system_manager.common.cgroups import CgroupStatsCollector
+from system_manager.common.lazy import lazy_import, lazy_property
+from system_manager.common.logs import iter_container_logs
+from system_manager.common.peripherals import PeripheralIndex
+from system_manager.common.shm import SharedSnapshot
+from system_manager.common.snapshots import DockerSnapshots
+from system_manager.common.stats import ContainerStats, StatsStore
+from system_manager.common.status import NuvlaBoxStatusFile
+from system_manager.common.timeseries import RingBuffer, MetricsArchive
+
+# the Docker and HTTP client libraries are only loaded once a Docker or management-api call is made
+docker = lazy_import('docker')
+docker_clients = lazy_import('system_manager.common.docker_client')
+management_api = lazy_import('system_manager.common.management_api')
+
+HOST_METRICS_FIELDS = ('cpu-usage', 'memory-usage', 'disk-usage', 'net-rx', 'net-tx')
+HOST_METRICS_COUNTERS = ('net-rx', 'net-tx')
+CONTAINER_METRICS_COUNTERS = ('net_in', 'net_out', 'blk_in', 'blk_out')
 
 
 class Supervise():
@@ -25,54 +41,158 @@ class Supervise():
     def __init__(self):
         """ Constructs the Supervise object """
 
-        self.docker_client = docker.from_env()
         self.log = logging.getLogger(__name__)
         self.system_usages = {}
+        self.nuvlabox_status_file = NuvlaBoxStatusFile(utils.nuvlabox_status_file)
+        self.stats_executor = concurrent.futures.ThreadPoolExecutor(max_workers=utils.docker_stats_workers,
+                                                                    thread_name_prefix='docker-stats')
+        self.stats_in_flight = {}
+        self.last_stats_pass_duration = None
+        # CPU counters from the previous cycle, by container ID, in the form (total_usage, system_cpu_usage)
+        self.previous_cpu_stats = {}
+        self.stats_store = StatsStore()
+        # snapshots shared with the dashboard, only published by the supervisor process (see init_shared_snapshots)
+        self.stats_snapshot = None
+        self.status_snapshot = None
+        self.openmetrics_snapshot = None
+        # the datagateway can be supervised both from the main loop and from the Docker events thread
+        self.datagateway_lock = threading.RLock()
+        # IDs of the peripherals whose datagateway container is being disabled, so that it is only disabled once
+        self.datagateway_disabling = set()
+        self.datagateway_executor = concurrent.futures.ThreadPoolExecutor(max_workers=utils.management_api_workers,
+                                                                         thread_name_prefix='datagateway')
+        # metrics history, only kept by the supervisor process (see init_metrics_history)
+        self.container_metrics = None
+        self.host_metrics = None
+        self.container_metrics_archive = None
+        self.host_metrics_archive = None
+        self.peripheral_index = PeripheralIndex(utils.nuvlabox_peripherals_folder)
+        self.cert_index = CertificateIndex(utils.data_volume, utils.rotated_cert_files, utils.cert_rotation_margin)
+
+    @lazy_property
+    def docker_client(self):
+        """ Process-wide Docker client, created on first use """
+
+        return docker_clients.get_docker_client()
+
+    @lazy_property
+    def docker_snapshots(self):
+        """ Cached Docker info, df and container lists """
+
+        return DockerSnapshots(self.docker_client, info_ttl=utils.docker_info_ttl, df_ttl=utils.docker_df_ttl,
+                               containers_ttl=utils.docker_containers_ttl)
+
+    @lazy_property
+    def cgroup_stats_collector(self):
+        """ Reader of the container counters from the cgroup filesystem, for the "cgroup" Docker stats mode """
+
+        return CgroupStatsCollector(root=utils.cgroup_root, proc_root=utils.cgroup_proc_root)
+
+    @lazy_property
+    def management_api(self):
+        """ management-api client, created on first use """
+
+        return management_api.ManagementAPIClient(utils.management_api_url, utils.cert_file, utils.key_file,
+                                                  pool_size=utils.management_api_workers,
+                                                  connect_timeout=utils.management_api_connect_timeout,
+                                                  read_timeout=utils.management_api_timeout,
+                                                  failure_threshold=utils.management_api_failure_threshold,
+                                                  reset_timeout=utils.management_api_reset_timeout)
 
-    @staticmethod
-    def printer(content, file):
-        """ Pretty prints to template file """
+    def get_nuvlabox_status(self):
+        """ Re-uses the consumption metrics from NuvlaBox Agent. The status file is only parsed again when it changes
+
+        :returns NuvlaBoxStatus
+        """
 
-        with open("{}/{}".format(utils.html_templates, file), 'w') as p:
-            p.write("{}".format(content))
+        status = self.nuvlabox_status_file.get()
+        if self.status_snapshot and status and status.content is not self.system_usages:
+            self.status_snapshot.publish(status.raw)
+
+        # update in-mem copy of usages
+        self.system_usages = status.content
 
-    @staticmethod
-    def reader(file):
-        """ Reads template file
+        return status
 
-        :returns file content as a string
+    def init_shared_snapshots(self):
+        """ Creates the shared snapshots where the Docker stats and the NuvlaBox status are published for the
+        dashboard.
+
+        Only the process publishing them should call this, while readers should use SharedSnapshotReader
         """
 
-        with open("{}/{}".format(utils.html_templates, file)) as r:
-            return r.read()
+        self.stats_snapshot = SharedSnapshot.create(utils.docker_stats_snapshot_file)
+        self.status_snapshot = SharedSnapshot.create(utils.nuvlabox_status_snapshot_file)
+        self.openmetrics_snapshot = SharedSnapshot.create(utils.openmetrics_snapshot_file)
 
-    def get_nuvlabox_status(self):
-        """ Re-uses the consumption metrics from NuvlaBox Agent """
+    def init_metrics_history(self):
+        """ Creates the fixed-size ring buffers where the container and host metrics are recorded, together with
+        their on-disk archives.
+
+        Only the process writing the metrics should call this, while readers should use RingBuffer.open
+        """
+
+        self.container_metrics = RingBuffer.create(utils.container_metrics_file, ContainerStats.metrics_fields,
+                                                   utils.metrics_resolution, utils.metrics_retention,
+                                                   utils.metrics_max_containers)
+        self.host_metrics = RingBuffer.create(utils.host_metrics_file, HOST_METRICS_FIELDS,
+                                              utils.metrics_resolution, utils.metrics_retention, 1)
 
         try:
-            with open(utils.nuvlabox_status_file) as nbsf:
-                usages = json.loads(nbsf.read())
-        except FileNotFoundError:
-            self.log.warning("NuvlaBox status metrics file not found locally...wait for Agent to create it")
-            usages = {}
-        except:
-            self.log.exception("Unknown issues while retrieving NuvlaBox status metrics")
-            usages = self.system_usages
+            self.container_metrics_archive = MetricsArchive(utils.metrics_archive_folder, 'containers',
+                                                            ContainerStats.metrics_fields,
+                                                            utils.metrics_max_containers,
+                                                            utils.metrics_archive_levels,
+                                                            flush_interval=utils.metrics_archive_flush_interval,
+                                                            counter_fields=CONTAINER_METRICS_COUNTERS)
+            self.host_metrics_archive = MetricsArchive(utils.metrics_archive_folder, 'host', HOST_METRICS_FIELDS, 1,
+                                                       utils.metrics_archive_levels,
+                                                       flush_interval=utils.metrics_archive_flush_interval,
+                                                       counter_fields=HOST_METRICS_COUNTERS)
+        except OSError:
+            self.log.exception(f'Unable to create the metrics archive in {utils.metrics_archive_folder}. '
+                               f'Only the live metrics will be kept')
+
+    def flush_metrics_archive(self, close_buckets=False):
+        """ Writes the pending rollups of the metrics archives to disk
+
+        :param close_buckets: whether to also write the rollups which are not over yet, e.g. on shutdown
+        """
 
-        # update in-mem copy of usages
-        self.system_usages = usages
+        for archive in (self.container_metrics_archive, self.host_metrics_archive):
+            if archive:
+                archive.flush(close_buckets=close_buckets)
+
+    def record_host_metrics(self):
+        """ Records the host usages from the NuvlaBox status into the metrics history """
+
+        if not self.host_metrics:
+            return
+
+        usages = self.get_nuvlabox_status().content
+        if not usages:
+            return
 
-        return usages
+        net_stats = usages.get("resources", {}).get("net-stats", [])
+        net_rx = sum(float(nstat.get('bytes-received', 0)) for nstat in net_stats)
+        net_tx = sum(float(nstat.get('bytes-transmitted', 0)) for nstat in net_stats)
+
+        now = time.time()
+        values = {"host": [usages.get("cpu-usage"), usages.get("memory-usage"), usages.get("disk-usage"),
+                           net_rx, net_tx]}
+        self.host_metrics.append(now, values)
+        if self.host_metrics_archive:
+            self.host_metrics_archive.add(now, values)
 
     def get_docker_disk_usage(self):
-        """ Runs docker system df and gets disk usage """
+        """ Gets the disk usage from the latest docker system df snapshot """
 
-        return round(float(self.docker_client.df()["LayersSize"] / 1000 / 1000 / 1000), 2)
+        return round(float(self.docker_snapshots.df()["LayersSize"] / 1000 / 1000 / 1000), 2)
 
     def get_docker_info(self):
-        """ Gets everything from the Docker client info """
+        """ Gets everything from the latest Docker info snapshot """
 
-        return self.docker_client.info()
+        return self.docker_snapshots.info()
 
     def get_nuvlabox_peripherals(self):
         """ Reads the list of peripherals discovered by the other NuvlaBox microservices,
@@ -81,201 +201,385 @@ class Supervise():
         :returns list of peripherals [{...}, {...}] with the original data schema (see Nuvla nuvlabox-peripherals)
         """
 
-        peripherals = []
+        return self.peripheral_index.list()
+
+    def get_nuvlabox_peripheral(self, peripheral_id):
+        """ Looks a peripheral up by its ID
+
+        :param peripheral_id: e.g. nuvlabox-peripheral/<uuid>
+        :returns the peripheral, with the original data schema, or None if it does not exist
+        """
+
+        return self.peripheral_index.get(peripheral_id)
+
+    def iter_internal_logs(self, tail=30, since=None):
+        """ Streams the logs for all NuvlaBox containers, line by line
+
+        :param tail: number of lines to get from the end of each container's logs
+        :param since: only get the lines since this timestamp (in seconds since the epoch)
+        :returns generator of LogLine
+        """
+
+        containers = self.docker_snapshots.containers(filters={"label": utils.base_label})
+        return iter_container_logs(self.docker_client, containers, tail=tail, since=since)
+
+    def get_container_cpu_percent(self, container, container_stats, previous_cpu, previous_system, errors):
+        """ Computes the CPU usage of a container, from the difference between its current CPU stats
+        and the previous ones
+
+        :param container: container object
+        :param container_stats: stats sample, as returned by the Docker API
+        :param previous_cpu: container CPU total_usage from the previous sample
+        :param previous_system: system_cpu_usage from the previous sample
+        :param errors: list of errors, to be updated in place
+        :returns CPU percentage (0 if there is nothing to compare with), and the current total_usage and
+        system_cpu_usage (None if unavailable)
+        """
+
+        cpu_percent = 0.0
         try:
-            peripheral_files = glob.iglob(utils.nuvlabox_peripherals_folder + '**/**', recursive=True)
-        except FileNotFoundError:
-            return peripherals
+            cpu_total = float(container_stats["cpu_stats"]["cpu_usage"]["total_usage"])
+            cpu_system = float(container_stats["cpu_stats"]["system_cpu_usage"])
+            # percpu_usage is not reported on cgroup v2
+            online_cpus = container_stats["cpu_stats"].get("online_cpus") \
+                or len(container_stats["cpu_stats"]["cpu_usage"].get("percpu_usage") or [])
+
+            cpu_delta = cpu_total - previous_cpu
+            system_delta = cpu_system - previous_system
+
+            # a negative delta means that the counters were reset (e.g. by a docker restart, which keeps the
+            # container ID): there is then no previous sample to compare with, and the current one becomes it
+            if cpu_delta >= 0.0 and system_delta > 0.0 and online_cpus > 0:
+                cpu_percent = (cpu_delta / system_delta) * online_cpus * 100.0
+        except (IndexError, KeyError, ValueError, ZeroDivisionError) as e:
+            self.log.debug(f"Cannot get CPU stats for container {container.name}: {str(e)}. Moving on")
+            error_name = f'{container.name}:cpu:{str(e)}'
+            if error_name not in errors:
+                errors.append(error_name)
+            return 0.0, None, None
+
+        return cpu_percent, cpu_total, cpu_system
+
+    def get_container_usages(self, container, container_stats, cpu_percent, errors):
+        """ Parses the memory, network and block I/O usages out of a container stats sample
+
+        :param container: container object
+        :param container_stats: stats sample, as returned by the Docker API
+        :param cpu_percent: CPU percentage, already computed for this sample
+        :param errors: list of errors, to be updated in place
+        :returns dict with the container usages
+        """
 
-        for per_file_path in peripheral_files:
-            if os.path.isdir(per_file_path):
-                continue
-            try:
-                with open(per_file_path) as p:
-                    peripheral_content = json.loads(p.read())
-            except FileNotFoundError:
-                logging.warning("Cannot read peripheral {}".format(per_file_path))
-                continue
+        mem_percent = mem_usage = mem_limit = net_in = net_out = blk_in = blk_out = 0.0
+        try:
+            mem_usage = float(container_stats["memory_stats"]["usage"] / 1024 / 1024)
+            mem_limit = float(container_stats["memory_stats"]["limit"] / 1024 / 1024)
+            if round(mem_limit, 2) == 0.00:
+                mem_percent = 0.00
+            else:
+                mem_percent = round(float(mem_usage / mem_limit) * 100, 2)
+        except (IndexError, KeyError, ValueError) as e:
+            self.log.debug(f"Cannot get Mem stats for container {container.name}: {str(e)}. Moving on")
+            mem_percent = mem_usage = mem_limit = 0.00
+            error_name = f'{container.name}:mem:{str(e)}'
+            if error_name not in errors:
+                errors.append(error_name)
+
+        if "networks" in container_stats:
+            net_in = sum(container_stats["networks"][iface]["rx_bytes"] for iface in container_stats["networks"]) / 1000 / 1000
+            net_out = sum(container_stats["networks"][iface]["tx_bytes"] for iface in container_stats["networks"]) / 1000 / 1000
 
-            peripherals.append(peripheral_content)
+        try:
+            blk_in = float(container_stats.get("blkio_stats", {}).get("io_service_bytes_recursive", [{"value": 0}])[0]["value"] / 1000 / 1000)
+        except Exception as e:
+            self.log.debug(f"Cannot get Block stats for container {container.name}: {str(e)}. Moving on")
+            blk_in = 0.0
+            error_name = f'{container.name}:block-in:{str(e)}'
+            if error_name not in errors:
+                errors.append(error_name)
+        try:
+            blk_out = float(container_stats.get("blkio_stats", {}).get("io_service_bytes_recursive", [0, {"value": 0}])[1]["value"] / 1000 / 1000)
+        except Exception as e:
+            self.log.debug(f"Cannot get Block stats for container {container.name}: {str(e)}. Moving on")
+            blk_out = 0.0
+            error_name = f'{container.name}:block-out:{str(e)}'
+            if error_name not in errors:
+                errors.append(error_name)
+
+        return {
+            "id": container.id,
+            "name": container.name,
+            "cpu_percent": cpu_percent,
+            "mem_usage": mem_usage,
+            "mem_limit": mem_limit,
+            "mem_percent": mem_percent,
+            "net_in": net_in,
+            "net_out": net_out,
+            "blk_in": blk_in,
+            "blk_out": blk_out,
+            "status": container.status,
+            "restart_count": int(container.attrs["RestartCount"]) if "RestartCount" in container.attrs else 0
+        }
+
+    def sample_container_stats(self, container):
+        """ Samples the Docker stats for a single container, according to utils.docker_stats_mode, and computes
+        its resource usages
+
+        :param container: container object
+        :returns dict with the container usages (None if no sample could be taken), and list of errors found
+        while parsing the stats
+        """
 
-        return peripherals
+        # in "cgroup" mode, only the containers whose cgroup cannot be read are sampled through the API
+        if utils.docker_stats_mode in ('oneshot', 'cgroup'):
+            return self.sample_container_stats_oneshot(container)
 
-    def get_internal_logs_html(self, tail=30, since=None):
-        """ Get the logs for all NuvlaBox containers
+        return self.sample_container_stats_stream(container)
 
-        :returns list of log generators
-        :returns timestamp for when the logs were fetched
+    def sample_container_stats_stream(self, container):
+        """ Streams the Docker stats for a single container until two samples are collected,
+        and computes its resource usages
+
+        :param container: container object
+        :returns same as sample_container_stats
         """
 
-        nb_containers = utils.list_internal_containers()
-        logs = ''
-        for container in nb_containers:
-            container_log = self.docker_client.api.logs(container.id,
-                                                        timestamps=True,
-                                                        tail=tail,
-                                                        since=since).decode('utf-8')
-
-            if container_log:
-                log_id = '<b style="color: #{};">{} |</b> '.format(container.id[:6], container.name)
-                logs += '{} {}'.format(log_id,
-                                       '<br/>{}'.format(log_id).join(container_log.splitlines()))
-                logs += '<br/>'
-        return logs, int(time.time())
-
-    def write_docker_stats_table_html(self):
-        """ Run docker stats """
-
-        stats = '<table class="table table-striped table-hover mt-5 mr-auto">' \
-                ' <caption>Docker Stats, last update: {} UTC</caption>' \
-                ' <thead class="bg-secondary text-light">' \
-                '  <tr>' \
-                '    <th scope="col">CONTAINER ID</th>' \
-                '    <th scope="col">NAME</th>' \
-                '    <th scope="col">CPU %</th>' \
-                '    <th scope="col">MEM USAGE/LIMIT</th>' \
-                '    <th scope="col">MEM %</th>' \
-                '    <th scope="col">NET I/O</th>' \
-                '    <th scope="col">BLOCK I/O</th>' \
-                '    <th scope="col">STATUS</th>' \
-                '    <th scope="col">RESTARTED</th>' \
-                '  </tr>' \
-                ' </thead>' \
-                ' <tbody>'.format(datetime.utcnow())
+        errors = []
+        previous_cpu = previous_system = 0.0
+        x = 0
+        for container_stats in self.docker_client.api.stats(container.id, stream=True, decode=True):
+            cpu_percent, cpu_total, cpu_system = self.get_container_cpu_percent(container, container_stats,
+                                                                                previous_cpu, previous_system,
+                                                                                errors)
+            if cpu_total is not None:
+                previous_cpu = cpu_total
+                previous_system = cpu_system
+
+            # generate stats at least twice
+            x += 1
+            if x >= 2:
+                # stop streaming
+                return self.get_container_usages(container, container_stats, cpu_percent, errors), errors
+
+        return None, errors
+
+    def sample_container_stats_oneshot(self, container):
+        """ Takes a single, non-streamed, Docker stats sample for a container, and computes its CPU usage against the
+        CPU counters kept from the previous supervisor cycle. On the first sample of a container, the precpu_stats
+        reported by Docker are used instead
+
+        :param container: container object
+        :returns same as sample_container_stats
+        """
 
         errors = []
-        for container in self.docker_client.containers.list():
-            previous_cpu = previous_system = cpu_percent = mem_percent = mem_usage = mem_limit = net_in = net_out = blk_in = blk_out = 0.0
-            restart_count = 0
-            container_status = "unknown"
-            x = 0
-            # TODO: this should be executed in parallel, one thread per generator
-            for container_stats in self.docker_client.api.stats(container.id, stream=True, decode=True):
+        container_stats = self.docker_client.api.stats(container.id, stream=False)
+
+        previous = self.previous_cpu_stats.get(container.id)
+        if not previous:
+            precpu = container_stats.get("precpu_stats", {})
+            previous = (float(precpu.get("cpu_usage", {}).get("total_usage", 0.0)),
+                        float(precpu.get("system_cpu_usage", 0.0)))
+
+        cpu_percent, cpu_total, cpu_system = self.get_container_cpu_percent(container, container_stats,
+                                                                            previous[0], previous[1], errors)
+        if cpu_total is not None:
+            self.previous_cpu_stats[container.id] = (cpu_total, cpu_system)
+
+        return self.get_container_usages(container, container_stats, cpu_percent, errors), errors
+
+    def _timed_sample_container_stats(self, container):
+        """ Wraps sample_container_stats, flagging the container as in-flight for as long as its stats are
+        being streamed, so that the collector can tell when the sampling has started and whether it is hanging
+
+        :param container: container object
+        :returns same as sample_container_stats
+        """
+
+        self.stats_in_flight[container.id] = time.time()
+        try:
+            return self.sample_container_stats(container)
+        finally:
+            self.stats_in_flight.pop(container.id, None)
+
+    def collect_docker_stats(self, containers):
+        """ Samples the Docker stats for all the given containers, according to utils.docker_stats_mode
+
+        :param containers: list of container objects
+        :returns dict of container usages, by container ID, and list of errors
+        """
+
+        if utils.docker_stats_mode == 'cgroup':
+            usages, errors = self.collect_cgroup_stats(containers)
+        else:
+            usages, errors = self.collect_api_stats(containers)
+
+        # forget the CPU counters of the containers that are gone
+        listed = set(c.id for c in containers)
+        for container_id in set(self.previous_cpu_stats) - listed:
+            self.previous_cpu_stats.pop(container_id, None)
+
+        return usages, errors
+
+    def collect_cgroup_stats(self, containers):
+        """ Reads the stats of all the given containers from the cgroup filesystem, in one pass, and computes their
+        CPU usage against the CPU counters kept from the previous supervisor cycle (so it is 0 on the first one).
+
+        The containers whose cgroup cannot be read are sampled through the Docker API instead
+
+        :param containers: list of container objects
+        :returns dict of container usages, by container ID, and list of errors
+        """
+
+        samples, unreadable = self.cgroup_stats_collector.sample(containers)
+
+        usages = {}
+        errors = []
+        for container in containers:
+            container_stats = samples.get(container.id)
+            if not container_stats:
+                continue
+
+            previous = self.previous_cpu_stats.get(container.id)
+            if previous:
+                cpu_percent, cpu_total, cpu_system = self.get_container_cpu_percent(container, container_stats,
+                                                                                    previous[0], previous[1],
+                                                                                    errors)
+            else:
                 cpu_percent = 0.0
+                cpu_total = container_stats["cpu_stats"]["cpu_usage"]["total_usage"]
+                cpu_system = container_stats["cpu_stats"]["system_cpu_usage"]
+
+            if cpu_total is not None:
+                self.previous_cpu_stats[container.id] = (cpu_total, cpu_system)
 
+            usages[container.id] = self.get_container_usages(container, container_stats, cpu_percent, errors)
+
+        if unreadable:
+            self.log.debug(f'Sampling {len(unreadable)} containers through the Docker API, as their cgroup '
+                           f'cannot be read: {", ".join(c.name for c in unreadable)}')
+            api_usages, api_errors = self.collect_api_stats(unreadable)
+            usages.update(api_usages)
+            errors += api_errors
+
+        return usages, errors
+
+    def collect_api_stats(self, containers):
+        """ Samples the Docker stats for all the given containers at once, using the bounded stats worker pool.
+
+        Each container is given utils.docker_stats_timeout seconds, counted from the moment its sampling starts,
+        after which it is left behind. A container whose previous sample is still hanging is not resubmitted,
+        so that hung stats streams cannot take over the whole worker pool
+
+        :param containers: list of container objects
+        :returns dict of container usages, by container ID, and list of errors
+        """
+
+        usages = {}
+        errors = []
+        futures = {}
+        for container in containers:
+            if container.id in self.stats_in_flight:
+                errors.append(f'{container.name}:stats:previous sample is still in flight')
+                continue
+
+            futures[self.stats_executor.submit(self._timed_sample_container_stats, container)] = container
+
+        pending = set(futures)
+        while pending:
+            done, pending = concurrent.futures.wait(pending, timeout=0.5,
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                container = futures[future]
                 try:
-                    cpu_total = float(container_stats["cpu_stats"]["cpu_usage"]["total_usage"])
-                    cpu_system = float(container_stats["cpu_stats"]["system_cpu_usage"])
-                    online_cpus = container_stats["cpu_stats"] \
-                        .get("online_cpus", len(container_stats["cpu_stats"]["cpu_usage"].get("percpu_usage", -1)))
-
-                    cpu_delta = cpu_total - previous_cpu
-                    system_delta = cpu_system - previous_system
-
-                    if system_delta > 0.0 and online_cpus > -1:
-                        cpu_percent = (cpu_delta / system_delta) * online_cpus * 100.0
-
-                    previous_system = cpu_system
-                    previous_cpu = cpu_total
-                except (IndexError, KeyError, ValueError, ZeroDivisionError) as e:
-                    self.log.debug(f"Cannot get CPU stats for container {container.name}: {str(e)}. Moving on")
-                    cpu_percent = 0.0
-                    error_name = f'{container.name}:cpu:{str(e)}'
-                    if error_name not in errors:
-                        errors.append(error_name)
-
-                # generate stats at least twice
-                x += 1
-                if x >= 2:
-                    try:
-                        mem_usage = float(container_stats["memory_stats"]["usage"] / 1024 / 1024)
-                        mem_limit = float(container_stats["memory_stats"]["limit"] / 1024 / 1024)
-                        if round(mem_limit, 2) == 0.00:
-                            mem_percent = 0.00
-                        else:
-                            mem_percent = round(float(mem_usage / mem_limit) * 100, 2)
-                    except (IndexError, KeyError, ValueError) as e:
-                        self.log.debug(f"Cannot get Mem stats for container {container.name}: {str(e)}. Moving on")
-                        mem_percent = mem_usage = mem_limit = 0.00
-                        error_name = f'{container.name}:mem:{str(e)}'
-                        if error_name not in errors:
-                            errors.append(error_name)
-
-                    if "networks" in container_stats:
-                        net_in = sum(container_stats["networks"][iface]["rx_bytes"] for iface in container_stats["networks"]) / 1000 / 1000
-                        net_out = sum(container_stats["networks"][iface]["tx_bytes"] for iface in container_stats["networks"]) / 1000 / 1000
-
-                    try:
-                        blk_in = float(container_stats.get("blkio_stats", {}).get("io_service_bytes_recursive", [{"value": 0}])[0]["value"] / 1000 / 1000)
-                    except Exception as e:
-                        self.log.debug(f"Cannot get Block stats for container {container.name}: {str(e)}. Moving on")
-                        blk_in = 0.0
-                        error_name = f'{container.name}:block-in:{str(e)}'
-                        if error_name not in errors:
-                            errors.append(error_name)
-                    try:
-                        blk_out = float(container_stats.get("blkio_stats", {}).get("io_service_bytes_recursive", [0, {"value": 0}])[1]["value"] / 1000 / 1000)
-                    except Exception as e:
-                        self.log.debug(f"Cannot get Block stats for container {container.name}: {str(e)}. Moving on")
-                        blk_out = 0.0
-                        error_name = f'{container.name}:block-out:{str(e)}'
-                        if error_name not in errors:
-                            errors.append(error_name)
-
-                    container_status = container.status
-                    restart_count = int(container.attrs["RestartCount"]) if "RestartCount" in container.attrs else 0
-
-                    stats += '<tr>' \
-                             ' <th scope="row">{}</th> ' \
-                             ' <td>{}</td>' \
-                             ' <td>{}</td>' \
-                             ' <td>{}</td>' \
-                             ' <td>{}</td>' \
-                             ' <td>{}</td>' \
-                             ' <td>{}</td>' \
-                             ' <td>{}</td>' \
-                             ' <td>{}</td>' \
-                             '</tr>'.format(container.id[:12],
-                                            container.name[:25],
-                                            "%.2f" % round(cpu_percent, 2),
-                                            "%sMiB / %sGiB" % (round(mem_usage, 2), round(mem_limit / 1024, 2)),
-                                            "%.2f" % mem_percent,
-                                            "%sMB / %sMB" % (round(net_in, 2), round(net_out, 2)),
-                                            "%sMB / %sMB" % (round(blk_in, 2), round(blk_out, 2)),
-                                            container_status,
-                                            restart_count)
-                    # stop streaming
-                    break
+                    container_usages, container_errors = future.result()
+                except Exception as e:
+                    self.log.debug(f"Cannot get stats for container {container.name}: {str(e)}. Moving on")
+                    errors.append(f'{container.name}:stats:{str(e)}')
+                    continue
+
+                errors += container_errors
+                if container_usages:
+                    usages[container.id] = container_usages
+
+            now = time.time()
+            for future in list(pending):
+                container = futures[future]
+                started = self.stats_in_flight.get(container.id)
+                if started and now - started > utils.docker_stats_timeout:
+                    errors.append(f'{container.name}:stats:timed out after {utils.docker_stats_timeout} seconds')
+                    pending.discard(future)
+
+        return usages, errors
+
+    def update_docker_stats(self):
+        """ Runs docker stats for all containers, and updates the stats store with the new samples
+
+        The store snapshot is only published to the dashboard when the samples have changed
+
+        :returns True if the stats changed since the previous pass
+        """
+
+        pass_start = time.time()
+        containers = self.docker_client.containers.list()
+        usages, errors = self.collect_docker_stats(containers)
+
+        samples = [ContainerStats(**usages[container.id]) for container in containers if container.id in usages]
 
         if errors:
             self.log.warning(f'Failed to get some container stats. List (container:metric:error): {", ".join(errors)}')
 
-        stats += ' </tbody>' \
-                 '</table>'
-        self.printer(stats, utils.docker_stats_html_file)
+        self.last_stats_pass_duration = round(time.time() - pass_start, 2)
+        self.log.debug(f'Docker stats pass over {len(containers)} containers took {self.last_stats_pass_duration} seconds')
+
+        if self.container_metrics:
+            values = {sample.name: sample.metrics() for sample in samples}
+            self.container_metrics.append(pass_start, values)
+            if self.container_metrics_archive:
+                self.container_metrics_archive.add(pass_start, values)
+
+        changed = self.stats_store.update(samples, self.last_stats_pass_duration)
+        if changed and self.stats_snapshot:
+            self.stats_store.publish(self.stats_snapshot)
+
+        return changed
+
+    def export_metrics(self, scheduler_report=None, docker_api_report=None):
+        """ Renders the OpenMetrics exposition of the latest Docker stats and host usages, together with the given
+        supervisor reports, and publishes it for the dashboard to serve on /metrics
+
+        :param scheduler_report: Scheduler report
+        :param docker_api_report: DockerClientFactory report
+        """
+
+        exposition = openmetrics.render(stats_snapshot=self.stats_store.snapshot(),
+                                        nuvlabox_status=self.system_usages,
+                                        scheduler_report=scheduler_report,
+                                        docker_api_report=docker_api_report)
+        if self.openmetrics_snapshot:
+            self.openmetrics_snapshot.publish(exposition)
 
     def is_cert_rotation_needed(self):
         """ Checks whether the Docker and NB API certs are about to expire """
 
-        # certificates to be checked for expiration dates:
-        check_expiry_date_on = ["ca.pem", "server-cert.pem", "cert.pem"]
-
         # if the TLS sync file does not exist, then the compute-api is going to generate the certs by itself, by default
         if not os.path.isfile(utils.tls_sync_file):
             return False
 
-        for file in check_expiry_date_on:
-            file_path = f"{utils.data_volume}/{file}"
-
-            if os.path.isfile(file_path):
-                with open(file_path) as fp:
-                    content = fp.read()
+        expiring = self.cert_index.expiring()
+        for cert in expiring:
+            self.log.warning(f"{cert.path} expires on {datetime.utcfromtimestamp(cert.not_after)} UTC, in less than "
+                             f"{self.cert_index.rotation_margin} seconds. Requesting rotation of all certs")
 
-                cert_obj = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, content)
+        return bool(expiring)
 
-                end_date = cert_obj.get_notAfter().decode()
-                formatted_end_date = datetime(int(end_date[0:4]),
-                                              int(end_date[4:6]),
-                                              int(end_date[6:8]))
+    def time_until_cert_rotation(self):
+        """ How long, in seconds, until the certificates are due for rotation
 
-                days_left = formatted_end_date - datetime.now()
-                # if expiring in less than d days, rotate all
-                d = 5
-                if days_left.days < d:
-                    self.log.warning(f"{file_path} is expiring in less than {d} days. Requesting rotation of all certs")
-                    return True
+        :returns seconds, or None if there are no certificates to check
+        """
 
-        return False
+        return self.cert_index.time_until_rotation()
 
     def request_rotate_certificates(self):
         """ Deletes the existing .tls sync file from the shared volume and restarts the compute-api container
@@ -301,28 +605,30 @@ class Supervise():
         container_name = 'datagateway'
 
         degraded = 'DEGRADED'
-        try:
-            datagateway_container = self.docker_client.containers.get(container_name)
-        except docker.errors.NotFound:
-            self.log.warning(f'{container_name} container is not running. Setting operational status to {degraded}')
-            utils.set_operational_status(degraded)
-            return
-        except:
-            # really nothing to do
-            return
-
-        if datagateway_container.status.lower() not in ["running", "paused"]:
-            self.log.warning(f'{container_name} is down and not restarting on its own. Forcing the restart...')
+        with self.datagateway_lock:
             try:
-                datagateway_container.start()
-            except:
-                self.log.exception(f'Unable to force restart {container_name}. Setting operational status to {degraded}')
+                datagateway_container = self.docker_client.containers.get(container_name)
+            except docker.errors.NotFound:
+                self.log.warning(f'{container_name} container is not running. Setting operational status to {degraded}')
                 utils.set_operational_status(degraded)
+                return
+            except:
+                # really nothing to do
+                return
 
-            utils.set_operational_status('OPERATIONAL')
+            if datagateway_container.status.lower() not in ["running", "paused"]:
+                self.log.warning(f'{container_name} is down and not restarting on its own. Forcing the restart...')
+                try:
+                    datagateway_container.start()
+                except:
+                    self.log.exception(f'Unable to force restart {container_name}. Setting operational status to {degraded}')
+                    utils.set_operational_status(degraded)
+
+                utils.set_operational_status('OPERATIONAL')
 
     def keep_datagateway_containers_up(self):
-        """ Restarts the datagateway containers, if any. These are identified by their labels
+        """ Reconciles the datagateway containers, if any, with the existing peripherals.
+        These containers are identified by their labels
 
         :return:
         """
@@ -331,38 +637,109 @@ class Supervise():
 
         datagateway_containers = self.docker_client.containers.list(all=True, filters={'label': container_label})
 
-        if datagateway_containers:
-            peripherals = self.get_nuvlabox_peripherals()
-        else:
+        if not datagateway_containers:
             return
 
-        peripheral_ids = list(map(lambda x: x.get("id"), peripherals))
+        _, _, disabling = self.reconcile_datagateway_containers(datagateway_containers, self.peripheral_index.ids())
+        # waited for without holding the datagateway lock, which the disabling can hold up for a long time
+        concurrent.futures.wait(disabling)
 
-        for dg_container in datagateway_containers:
-            id = f"nuvlabox-peripheral/{dg_container.name}"
-            if id not in peripheral_ids:
-                # then it means the peripheral is gone, and the DG container was not removed
-                self.log.warning(f"Found old DG container {dg_container.name}. Trying to disable it")
-                try:
-                    r = requests.post("https://management-api:5001/api/data-source-mjpg/disable",
-                                      verify=False,
-                                      cert=(utils.cert_file, utils.key_file),
-                                      json={"id": id})
-                    r.raise_for_status()
-                except:
-                    # force disable manual
-                    self.log.exception(f"Could not disable DG container {dg_container.name} via the management-api. Force deleting it...")
-                    try:
-                        dg_container.remove(force=True)
-                    except Exception as e:
-                        self.log.error(f"Unable to cleanup old DG container {dg_container.name}: {str(e)}")
+    def reconcile_datagateway_containers(self, datagateway_containers, peripheral_ids):
+        """ Diffs the datagateway containers against the peripherals they are for, and only acts on the difference:
+        the containers whose peripheral is gone are disabled, in the background, and the ones which are down are
+        restarted. Containers which are running, or paused, or already being disabled, are left untouched
 
-                continue
+        :param datagateway_containers: list of container objects
+        :param peripheral_ids: set of the IDs of the existing peripherals
+        :returns tuple with the names of the containers which are being disabled, the names of the ones which were
+        restarted, and the futures of the disabling
+        """
+
+        # a datagateway container is named after the peripheral it is for
+        containers_by_peripheral = {f"nuvlabox-peripheral/{c.name}": c for c in datagateway_containers}
+        with self.datagateway_lock:
+            stale = containers_by_peripheral.keys() - peripheral_ids
+            down = [c for pid, c in containers_by_peripheral.items()
+                    if pid not in stale and c.status.lower() not in ["running", "paused"]]
 
-            if dg_container.status.lower() not in ["running", "paused"]:
+            disabling = []
+            for pid in stale - self.datagateway_disabling:
+                self.datagateway_disabling.add(pid)
+                disabling.append(self.datagateway_executor.submit(self._disable_datagateway_container,
+                                                                  containers_by_peripheral[pid], pid))
+
+            for dg_container in down:
                 self.log.warning(f'The data-gateway container {dg_container.name} is down. Forcing its restart...')
+                try:
+                    dg_container.start()
+                except Exception as e:
+                    self.log.exception(f'Unable to force restart {dg_container.name}. Reason: {str(e)}')
+
+        return [containers_by_peripheral[pid].name for pid in stale], [c.name for c in down], disabling
+
+    def _disable_datagateway_container(self, dg_container, peripheral_id):
+        """ Runs disable_datagateway_container, then allows the peripheral's container to be disabled again """
+
+        try:
+            self.disable_datagateway_container(dg_container, peripheral_id)
+        finally:
+            with self.datagateway_lock:
+                self.datagateway_disabling.discard(peripheral_id)
+
+    def disable_datagateway_container(self, dg_container, peripheral_id):
+        """ Disables a datagateway container whose peripheral is gone, via the management-api, retrying with
+        an exponential backoff. If it still fails, or if the management-api circuit breaker is open, the container
+        is force deleted
+
+        :param dg_container: container object
+        :param peripheral_id: ID of the peripheral the container was for
+        :return:
+        """
+
+        # then it means the peripheral is gone, and the DG container was not removed
+        self.log.warning(f"Found old DG container {dg_container.name}. Trying to disable it")
+        for attempt in range(utils.management_api_retries + 1):
+            if attempt:
+                time.sleep(utils.management_api_backoff * 2 ** (attempt - 1))
 
             try:
-                dg_container.start()
+                self.management_api.post("/api/data-source-mjpg/disable", json={"id": peripheral_id})
+                return
+            except management_api.CircuitOpenError as e:
+                self.log.warning(f"Cannot disable DG container {dg_container.name} via the management-api: {str(e)}")
+                break
             except Exception as e:
-                self.log.exception(f'Unable to force restart {dg_container.name}. Reason: {str(e)}')
+                self.log.warning(f"Attempt {attempt + 1} to disable DG container {dg_container.name} "
+                                 f"via the management-api failed: {str(e)}")
+
+        # force disable manual
+        self.log.error(f"Could not disable DG container {dg_container.name} via the management-api. Force deleting it...")
+        try:
+            dg_container.remove(force=True)
+        except Exception as e:
+            self.log.error(f"Unable to cleanup old DG container {dg_container.name}: {str(e)}")
+
+    def handle_container_event(self, event):
+        """ Reacts to a Docker container event (die, stop, destroy or start), by supervising
+        the datagateway or the data-source container the event is about
+
+        :param event: Docker event, as a dict
+        :return:
+        """
+
+        attributes = event.get("Actor", {}).get("Attributes", {})
+        action = event.get("Action", event.get("status"))
+        name = attributes.get("name")
+
+        if name == 'datagateway':
+            self.log.debug(f'Got event {action} for {name}')
+            self.keep_datagateway_up()
+        elif attributes.get("nuvlabox.data-source-container") == "True" and action != "destroy":
+            self.log.debug(f'Got event {action} for data-gateway container {name}')
+            try:
+                dg_container = self.docker_client.containers.get(event.get("Actor", {}).get("ID", name))
+            except docker.errors.NotFound:
+                return
+
+            # the disabling, if any, goes on in the background, so that the next events are not held up
+            self.reconcile_datagateway_containers([dg_container], self.peripheral_index.ids())
@@ -0,0 +1,189 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Expiry index for the NuvlaBox TLS certificates """
+
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from system_manager.common.lazy import lazy_import
+from system_manager.common.logging import logging
+
+
+log = logging.getLogger(__name__)
+
+# only loaded when a certificate is parsed
+OpenSSL = lazy_import('OpenSSL')
+
+
+def asn1_time_to_timestamp(asn1_time):
+    """ Converts an ASN.1 GeneralizedTime, as given by OpenSSL (e.g. b'20250101120000Z'), into a Unix timestamp
+
+    :param asn1_time: bytes
+    :returns float, or None if not set
+    """
+
+    if not asn1_time:
+        return None
+
+    return datetime.strptime(asn1_time.decode(), '%Y%m%d%H%M%SZ').replace(tzinfo=timezone.utc).timestamp()
+
+
+class CertificateInfo(object):
+    """ The relevant bits of a parsed certificate """
+
+    __slots__ = ('path', 'subject', 'issuer', 'serial', 'not_before', 'not_after', 'signature')
+
+    def __init__(self, path, subject, issuer, serial, not_before, not_after, signature):
+        """ Constructs a CertificateInfo record
+
+        :param path: certificate file path
+        :param subject: subject common name
+        :param issuer: issuer common name
+        :param serial: serial number
+        :param not_before: start of validity, as a Unix timestamp
+        :param not_after: end of validity, as a Unix timestamp
+        :param signature: (inode, mtime, size) of the file when it was parsed
+        """
+
+        self.path = path
+        self.subject = subject
+        self.issuer = issuer
+        self.serial = serial
+        self.not_before = not_before
+        self.not_after = not_after
+        self.signature = signature
+
+    @classmethod
+    def load(cls, path, signature):
+        """ Parses a PEM certificate file
+
+        :param path: file path
+        :param signature: (inode, mtime, size) of the file
+        :returns CertificateInfo
+        """
+
+        with open(path) as fp:
+            cert_obj = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, fp.read())
+
+        return cls(path,
+                   cert_obj.get_subject().CN,
+                   cert_obj.get_issuer().CN,
+                   cert_obj.get_serial_number(),
+                   asn1_time_to_timestamp(cert_obj.get_notBefore()),
+                   asn1_time_to_timestamp(cert_obj.get_notAfter()),
+                   signature)
+
+    def to_dict(self, rotation_margin=None, now=None):
+        """ Serializes the record, with UTC ISO dates
+
+        :param rotation_margin: if given, also include when the certificate is due for rotation
+        :param now: current time, defaults to time.time()
+        :returns dict
+        """
+
+        now = time.time() if now is None else now
+        content = {
+            "file": os.path.basename(self.path),
+            "subject": self.subject,
+            "issuer": self.issuer,
+            "serial-number": str(self.serial),
+            "not-before": datetime.utcfromtimestamp(self.not_before).isoformat() + 'Z' if self.not_before else None,
+            "not-after": datetime.utcfromtimestamp(self.not_after).isoformat() + 'Z' if self.not_after else None,
+            "seconds-until-expiry": int(self.not_after - now) if self.not_after else None
+        }
+
+        if rotation_margin is not None and self.not_after:
+            content["rotation-due"] = datetime.utcfromtimestamp(self.not_after - rotation_margin).isoformat() + 'Z'
+
+        return content
+
+
+class CertificateIndex(object):
+    """ Keeps the expiry dates of a set of certificate files.
+
+    Each file is only parsed again when its inode, modification time or size changes, so that checking the index
+    costs one stat per file
+    """
+
+    def __init__(self, folder, files, rotation_margin):
+        """ Constructs the index. Nothing is parsed until refresh() is called
+
+        :param folder: folder with the certificate files
+        :param files: certificate file names
+        :param rotation_margin: how long, in seconds, before its expiry a certificate must be rotated
+        """
+
+        self.paths = [os.path.join(folder, file) for file in files]
+        self.rotation_margin = rotation_margin
+        self.lock = threading.Lock()
+        # path -> CertificateInfo
+        self.certificates = {}
+
+    def refresh(self):
+        """ Parses the certificate files which are new or have changed since the last refresh, and forgets the
+        ones that are gone
+
+        :returns list of CertificateInfo, for the certificates that exist
+        """
+
+        with self.lock:
+            for path in self.paths:
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    self.certificates.pop(path, None)
+                    continue
+
+                signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+                cached = self.certificates.get(path)
+                if cached and cached.signature == signature:
+                    continue
+
+                try:
+                    self.certificates[path] = CertificateInfo.load(path, signature)
+                except (OSError, OpenSSL.crypto.Error, ValueError):
+                    log.exception(f'Unable to parse the certificate {path}')
+                    self.certificates.pop(path, None)
+
+            return [self.certificates[path] for path in self.paths if path in self.certificates]
+
+    def expiring(self, now=None):
+        """ Gets the certificates which are due for rotation
+
+        :param now: current time, defaults to time.time()
+        :returns list of CertificateInfo
+        """
+
+        now = time.time() if now is None else now
+        return [cert for cert in self.refresh()
+                if cert.not_after is not None and cert.not_after - self.rotation_margin <= now]
+
+    def time_until_rotation(self, now=None):
+        """ How long until the first certificate is due for rotation
+
+        :param now: current time, defaults to time.time()
+        :returns seconds (0 if a rotation is already due), or None if there are no certificates
+        """
+
+        now = time.time() if now is None else now
+        due = [cert.not_after - self.rotation_margin for cert in self.refresh() if cert.not_after is not None]
+        if not due:
+            return None
+
+        return max(min(due) - now, 0)
+
+    def report(self):
+        """ JSON serializable view of the index
+
+        :returns dict
+        """
+
+        now = time.time()
+        until_rotation = self.time_until_rotation(now)
+        return {
+            "rotation-margin": self.rotation_margin,
+            "seconds-until-rotation": int(until_rotation) if until_rotation is not None else None,
+            "certificates": [cert.to_dict(self.rotation_margin, now) for cert in self.refresh()]
+        }
@@ -0,0 +1,307 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Container stats read straight from the cgroup filesystem, instead of the Docker stats API
+
+The CPU, memory and block I/O counters of all containers are read in a single pass over /sys/fs/cgroup (v1 or v2),
+and the network counters from /proc/<pid>/net/dev of each container's main process. The samples are returned in the
+same shape as the Docker stats API, so that they can be parsed the same way.
+
+The supervisor needs to see the host's cgroup hierarchy (bind-mount /sys/fs/cgroup, and use the host cgroup
+namespace on cgroup v2), and the host processes for the network counters (host PID namespace, or the host /proc
+mounted at proc_root). Containers which cannot be read this way are left to the Docker API
+"""
+
+import os
+import time
+from system_manager.common.logging import logging
+
+
+log = logging.getLogger(__name__)
+
+# cgroup of a container, relative to the hierarchy root, for the cgroupfs and systemd cgroup drivers
+GROUP_TEMPLATES = ('docker/{id}', 'system.slice/docker-{id}.scope')
+
+
+def read_int(path):
+    """ Reads a file holding a single integer (or "max", for no limit)
+
+    :param path: file path
+    :returns int, or None for "max"
+    """
+
+    with open(path) as f:
+        value = f.read().strip()
+
+    return None if value == 'max' else int(value)
+
+
+def read_keyed(path):
+    """ Reads a flat keyed file, such as cpu.stat or memory.stat
+
+    :param path: file path
+    :returns dict of key -> int
+    """
+
+    content = {}
+    with open(path) as f:
+        for line in f:
+            key, _, value = line.partition(' ')
+            if value.strip().isdigit():
+                content[key] = int(value)
+
+    return content
+
+
+class CgroupStatsCollector(object):
+    """ Reads the resource usage counters of Docker containers from the cgroup filesystem """
+
+    def __init__(self, root='/sys/fs/cgroup', proc_root='/proc'):
+        """ Constructs the collector, and detects the cgroup version
+
+        :param root: mount point of the cgroup hierarchy
+        :param proc_root: mount point of the host /proc, for the network counters
+        """
+
+        self.root = root
+        self.proc_root = proc_root
+        self.version = 2 if os.path.isfile(os.path.join(root, 'cgroup.controllers')) else 1
+        # container ID -> cgroup, relative to the hierarchy root
+        self.groups = {}
+        self.host_memory = self.read_host_memory()
+
+    @staticmethod
+    def read_host_memory():
+        """ Total host memory, which is the memory limit of the containers without one
+
+        :returns bytes, or None if unknown
+        """
+
+        try:
+            with open('/proc/meminfo') as m:
+                for line in m:
+                    if line.startswith('MemTotal:'):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError, IndexError):
+            pass
+
+        return None
+
+    @staticmethod
+    def read_system_cpu_usage():
+        """ Host CPU time, as reported by Docker in system_cpu_usage
+
+        :returns (nanoseconds, number of online CPUs)
+        """
+
+        clock_ticks = os.sysconf('SC_CLK_TCK')
+        total = online_cpus = 0
+        with open('/proc/stat') as s:
+            for line in s:
+                if line.startswith('cpu '):
+                    # user, nice, system, idle, iowait, irq, softirq and steal
+                    total = sum(int(value) for value in line.split()[1:9])
+                elif line.startswith('cpu'):
+                    online_cpus += 1
+                else:
+                    break
+
+        return total * 1000000000 // clock_ticks, online_cpus
+
+    def controller_path(self, controller, group):
+        """ Folder of a cgroup, for a given controller
+
+        :param controller: cgroup v1 controller (ignored on cgroup v2)
+        :param group: cgroup, relative to the hierarchy root
+        :returns path
+        """
+
+        if self.version == 2:
+            return os.path.join(self.root, group)
+
+        return os.path.join(self.root, controller, group)
+
+    def find_group(self, container):
+        """ Finds the cgroup of a container
+
+        :param container: container object
+        :returns cgroup, relative to the hierarchy root, or None if not found
+        """
+
+        group = self.groups.get(container.id)
+        if group:
+            return group
+
+        templates = list(GROUP_TEMPLATES)
+        parent = container.attrs.get("HostConfig", {}).get("CgroupParent")
+        if parent:
+            parent = parent.strip('/')
+            templates = [f'{parent}/{{id}}', f'{parent}/docker-{{id}}.scope'] + templates
+
+        for template in templates:
+            group = template.format(id=container.id)
+            if os.path.isdir(self.controller_path('memory', group)):
+                self.groups[container.id] = group
+                return group
+
+        return None
+
+    def read_cpu_usage(self, group):
+        """ CPU time used by a cgroup
+
+        :param group: cgroup
+        :returns nanoseconds
+        """
+
+        if self.version == 2:
+            return read_keyed(os.path.join(self.controller_path('cpu', group), 'cpu.stat'))['usage_usec'] * 1000
+
+        return read_int(os.path.join(self.controller_path('cpuacct', group), 'cpuacct.usage'))
+
+    def read_memory(self, group):
+        """ Memory usage and limit of a cgroup
+
+        :param group: cgroup
+        :returns (usage, limit), in bytes
+        """
+
+        path = self.controller_path('memory', group)
+        if self.version == 2:
+            usage = read_int(os.path.join(path, 'memory.current'))
+            limit = read_int(os.path.join(path, 'memory.max'))
+        else:
+            usage = read_int(os.path.join(path, 'memory.usage_in_bytes'))
+            limit = read_int(os.path.join(path, 'memory.limit_in_bytes'))
+
+        # no limit is reported as "max" on cgroup v2, and as a huge number on cgroup v1
+        if self.host_memory and (limit is None or limit > self.host_memory):
+            limit = self.host_memory
+
+        return usage, limit
+
+    def read_block_io(self, group):
+        """ Bytes read from and written to block devices by a cgroup, over all devices
+
+        :param group: cgroup
+        :returns (read, written), in bytes
+        """
+
+        read = written = 0
+        if self.version == 2:
+            with open(os.path.join(self.controller_path('io', group), 'io.stat')) as f:
+                for line in f:
+                    for field in line.split()[1:]:
+                        key, _, value = field.partition('=')
+                        if key == 'rbytes':
+                            read += int(value)
+                        elif key == 'wbytes':
+                            written += int(value)
+
+            return read, written
+
+        with open(os.path.join(self.controller_path('blkio', group), 'blkio.throttle.io_service_bytes')) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) != 3:
+                    continue
+                if fields[1] == 'Read':
+                    read += int(fields[2])
+                elif fields[1] == 'Write':
+                    written += int(fields[2])
+
+        return read, written
+
+    def read_networks(self, container):
+        """ Network counters of a container, from its main process
+
+        :param container: container object
+        :returns dict of interface -> {"rx_bytes", "tx_bytes"}, as in the Docker stats, empty if the container
+        uses the host network, or None if they cannot be read
+        """
+
+        host_config = container.attrs.get("HostConfig", {})
+        if host_config.get("NetworkMode") in ('host', 'none'):
+            return {}
+
+        pid = container.attrs.get("State", {}).get("Pid")
+        if not pid:
+            return None
+
+        proc = os.path.join(self.proc_root, str(pid))
+        try:
+            # make sure the PID is the container's, and not another process in a different PID namespace
+            with open(os.path.join(proc, 'cgroup')) as c:
+                if container.id not in c.read():
+                    return None
+
+            networks = {}
+            with open(os.path.join(proc, 'net', 'dev')) as d:
+                for line in d.readlines()[2:]:
+                    iface, _, counters = line.partition(':')
+                    iface = iface.strip()
+                    if iface == 'lo':
+                        continue
+
+                    counters = counters.split()
+                    networks[iface] = {"rx_bytes": int(counters[0]), "tx_bytes": int(counters[8])}
+        except (OSError, ValueError, IndexError):
+            return None
+
+        return networks
+
+    def sample(self, containers):
+        """ Reads the counters of all the given containers, in one pass
+
+        :param containers: list of container objects
+        :returns dict of container ID -> stats sample (in the shape of the Docker stats API), and the list of
+        containers which could not be read, and should be sampled through the Docker API instead
+        """
+
+        samples = {}
+        unreadable = []
+        try:
+            system_cpu_usage, online_cpus = self.read_system_cpu_usage()
+        except (OSError, ValueError):
+            log.exception('Unable to read the host CPU usage from /proc/stat')
+            return samples, list(containers)
+
+        now = time.time()
+        for container in containers:
+            group = self.find_group(container)
+            networks = self.read_networks(container) if group else None
+            if not group or networks is None:
+                unreadable.append(container)
+                continue
+
+            try:
+                cpu_usage = self.read_cpu_usage(group)
+                mem_usage, mem_limit = self.read_memory(group)
+                blk_read, blk_written = self.read_block_io(group)
+            except (OSError, ValueError, KeyError) as e:
+                log.debug(f'Unable to read the cgroup {group} of container {container.name}: {str(e)}')
+                # the container might have been re-created: look its cgroup up again on the next pass
+                self.groups.pop(container.id, None)
+                unreadable.append(container)
+                continue
+
+            samples[container.id] = {
+                "read": now,
+                "cpu_stats": {
+                    "cpu_usage": {"total_usage": cpu_usage},
+                    "system_cpu_usage": system_cpu_usage,
+                    "online_cpus": online_cpus
+                },
+                "memory_stats": {"usage": mem_usage, "limit": mem_limit},
+                "blkio_stats": {
+                    "io_service_bytes_recursive": [{"op": "Read", "value": blk_read},
+                                                   {"op": "Write", "value": blk_written}]
+                },
+                "networks": networks
+            }
+
+        # forget the cgroups of the containers that are gone
+        listed = set(c.id for c in containers)
+        for container_id in set(self.groups) - listed:
+            self.groups.pop(container_id, None)
+
+        return samples, unreadable
@@ -0,0 +1,244 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Process-wide Docker client, instrumented with per-endpoint call counts and latencies """
+
+import docker
+import json
+import os
+import re
+import threading
+import time
+from docker.transport.unixconn import UnixHTTPAdapter, UnixHTTPConnectionPool
+from urllib.parse import urlsplit
+from system_manager.common import utils
+from system_manager.common.logging import logging
+
+
+log = logging.getLogger(__name__)
+
+# Docker API collections, whose items are addressed by ID or name
+DOCKER_API_COLLECTIONS = {'containers', 'images', 'networks', 'volumes', 'exec', 'services', 'nodes', 'tasks',
+                          'secrets', 'configs', 'plugins', 'distribution'}
+# paths under the collections which are not IDs
+DOCKER_API_ACTIONS = {'json', 'create', 'prune', 'search', 'load', 'get', 'pull', 'push'}
+API_VERSION_PREFIX = re.compile(r'^/v\d+\.\d+')
+
+
+def docker_api_endpoint(method, url):
+    """ Normalizes a Docker API call into an endpoint, without the API version and the IDs,
+    e.g. GET http+docker://localhost/v1.39/containers/3f4e.../stats?stream=0 -> GET /containers/{id}/stats
+
+    :param method: HTTP method
+    :param url: request URL
+    :returns str
+    """
+
+    path = API_VERSION_PREFIX.sub('', urlsplit(url).path)
+    parts = path.strip('/').split('/')
+    if len(parts) > 1 and parts[0] in DOCKER_API_COLLECTIONS and parts[1] not in DOCKER_API_ACTIONS:
+        parts[1] = '{id}'
+
+    return f'{method} /{"/".join(parts)}'
+
+
+class PooledUnixHTTPAdapter(UnixHTTPAdapter):
+    """ Docker unix socket adapter, with a configurable number of connections kept open
+    (docker-py always keeps up to 10) """
+
+    def __init__(self, socket_url, timeout=60, max_pool_size=10):
+        """ Constructs the adapter
+
+        :param socket_url: e.g. http+unix:///var/run/docker.sock
+        :param timeout: default timeout, in seconds
+        :param max_pool_size: maximum number of connections kept open
+        """
+
+        self.max_pool_size = max_pool_size
+        super().__init__(socket_url, timeout=timeout)
+
+    def get_connection(self, url, proxies=None):
+        with self.pools.lock:
+            pool = self.pools.get(url)
+            if pool:
+                return pool
+
+            pool = UnixHTTPConnectionPool(url, self.socket_path, self.timeout, maxsize=self.max_pool_size)
+            self.pools[url] = pool
+
+        return pool
+
+
+class DockerAPIMetrics(object):
+    """ Call counts, errors and latencies, per Docker API endpoint.
+
+    For streaming calls (e.g. stats, logs or events streams), the latency is the time until the response headers
+    """
+
+    def __init__(self):
+        """ Constructs empty metrics """
+
+        self.lock = threading.Lock()
+        # endpoint -> [calls, errors, total latency, max latency]
+        self.endpoints = {}
+        self.since = time.time()
+
+    def record(self, endpoint, latency, error=False):
+        """ Records a call
+
+        :param endpoint: endpoint, see docker_api_endpoint
+        :param latency: call duration, in seconds
+        :param error: whether the call failed, or got an error status
+        """
+
+        with self.lock:
+            metrics = self.endpoints.setdefault(endpoint, [0, 0, 0.0, 0.0])
+            metrics[0] += 1
+            metrics[1] += 1 if error else 0
+            metrics[2] += latency
+            metrics[3] = max(metrics[3], latency)
+
+    def report(self):
+        """ JSON serializable view of the metrics, with the busiest endpoints first
+
+        :returns dict
+        """
+
+        with self.lock:
+            endpoints = sorted(self.endpoints.items(), key=lambda item: item[1][0], reverse=True)
+            return {
+                "since": self.since,
+                "calls": sum(metrics[0] for _, metrics in endpoints),
+                "endpoints": {endpoint: {"calls": calls,
+                                         "errors": errors,
+                                         "mean-latency": round(total / calls, 6) if calls else None,
+                                         "max-latency": round(max_latency, 6)}
+                              for endpoint, (calls, errors, total, max_latency) in endpoints}
+            }
+
+
+class DockerClientFactory(object):
+    """ Builds a single, shared Docker client, whose API calls are all recorded into DockerAPIMetrics """
+
+    def __init__(self, max_pool_size=10, timeout=60):
+        """ Constructs the factory. The client is only built when first requested
+
+        :param max_pool_size: maximum number of connections kept open with the Docker daemon
+        :param timeout: default timeout, in seconds, for the Docker API calls
+        """
+
+        self.max_pool_size = max_pool_size
+        self.timeout = timeout
+        self.metrics = DockerAPIMetrics()
+        self.lock = threading.Lock()
+        self.client = None
+        self.last_ping = None
+
+    def _set_pool_size(self, client):
+        """ Replaces the client's unix socket adapter with one that keeps up to max_pool_size connections
+
+        :param client: docker.DockerClient
+        """
+
+        adapter = getattr(client.api, '_custom_adapter', None)
+        if not isinstance(adapter, UnixHTTPAdapter):
+            # e.g. a TCP Docker host
+            return
+
+        pooled_adapter = PooledUnixHTTPAdapter(f'http+unix://{adapter.socket_path}', timeout=self.timeout,
+                                               max_pool_size=self.max_pool_size)
+        client.api._custom_adapter = pooled_adapter
+        client.api.mount('http+docker://', pooled_adapter)
+        adapter.close()
+
+    def _instrument(self, client):
+        """ Wraps the client's HTTP calls, to record them
+
+        :param client: docker.DockerClient
+        """
+
+        send = client.api.send
+        metrics = self.metrics
+
+        def instrumented_send(request, **kwargs):
+            start = time.time()
+            error = True
+            try:
+                response = send(request, **kwargs)
+                error = response.status_code >= 400
+                return response
+            finally:
+                metrics.record(docker_api_endpoint(request.method, request.url), time.time() - start, error)
+
+        client.api.send = instrumented_send
+
+    def get_client(self):
+        """ Gets the shared client, building it if needed
+
+        :returns docker.DockerClient
+        """
+
+        if self.client is None:
+            with self.lock:
+                if self.client is None:
+                    client = docker.from_env(timeout=self.timeout)
+                    self._set_pool_size(client)
+                    self._instrument(client)
+                    self.client = client
+
+        return self.client
+
+    def check_health(self):
+        """ Pings the Docker daemon. If it does not answer, the pooled connections are dropped, so that the next
+        calls open new ones
+
+        :returns True if the daemon answered
+        """
+
+        client = self.get_client()
+        start = time.time()
+        try:
+            client.ping()
+        except Exception as e:
+            log.warning(f'Docker daemon is not answering: {str(e)}. Resetting the connection pool')
+            self.last_ping = None
+            client.api.close()
+            return False
+
+        self.last_ping = time.time() - start
+        return True
+
+    def report(self):
+        """ JSON serializable view of the client settings, health and metrics
+
+        :returns dict
+        """
+
+        report = self.metrics.report()
+        report.update({"max-pool-size": self.max_pool_size,
+                       "ping-latency": round(self.last_ping, 6) if self.last_ping is not None else None})
+        return report
+
+    def save_report(self, path):
+        """ Atomically writes the report into a JSON file, for other processes to read
+
+        :param path: file path
+        """
+
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as r:
+            json.dump(self.report(), r)
+
+        os.replace(tmp_path, path)
+
+
+docker_client_factory = DockerClientFactory(max_pool_size=utils.docker_max_pool_size, timeout=utils.docker_api_timeout)
+
+
+def get_docker_client():
+    """ Gets the process-wide Docker client
+
+    :returns docker.DockerClient
+    """
+
+    return docker_client_factory.get_client()
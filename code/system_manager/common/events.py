@@ -0,0 +1,67 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Subscription to the Docker events stream """
+
+import threading
+import time
+from system_manager.common.logging import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class DockerEventWatcher(object):
+    """ Follows the Docker events stream on a background thread, and hands every event over to a handler.
+
+    If the stream breaks, it is re-opened from the time of the last event received, so that no events are missed
+    """
+
+    def __init__(self, docker_client, filters, handler, reconnect_delay=5):
+        """ Constructs the watcher
+
+        :param docker_client: Docker client
+        :param filters: Docker events filters, e.g. {"type": "container", "event": ["die"]}
+        :param handler: function to be called with each event (as a dict)
+        :param reconnect_delay: how long to wait, in seconds, before re-opening a broken stream
+        """
+
+        self.docker_client = docker_client
+        self.filters = filters
+        self.handler = handler
+        self.reconnect_delay = reconnect_delay
+        self.last_event_time = None
+        self._thread = None
+
+    def start(self):
+        """ Starts watching, if not yet started """
+
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._thread = threading.Thread(target=self._watch, name='docker-events', daemon=True)
+        self._thread.start()
+
+    def is_alive(self):
+        """ Whether the watcher thread is running """
+
+        return bool(self._thread and self._thread.is_alive())
+
+    def _watch(self):
+        """ Streams the events, forever """
+
+        while True:
+            since = self.last_event_time
+            try:
+                for event in self.docker_client.events(decode=True, filters=self.filters, since=since):
+                    self.last_event_time = event.get('time', self.last_event_time)
+                    try:
+                        self.handler(event)
+                    except Exception:
+                        log.exception(f'Unable to handle Docker event {event.get("Action")} '
+                                      f'for {event.get("Actor", {}).get("Attributes", {}).get("name")}')
+            except Exception as e:
+                log.warning(f'Docker events stream was interrupted: {str(e)}. '
+                            f'Reconnecting in {self.reconnect_delay} seconds')
+
+            time.sleep(self.reconnect_delay)
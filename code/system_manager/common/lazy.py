@@ -0,0 +1,60 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Lazy initialisation helpers, so that heavy modules and clients are only loaded when first used """
+
+import importlib.util
+import sys
+import threading
+
+
+_import_lock = threading.Lock()
+
+
+def lazy_import(name):
+    """ Imports a module lazily: it is only executed when one of its attributes is first accessed.
+    If the module is already imported, it is returned as is
+
+    :param name: absolute module name, e.g. 'OpenSSL'
+    :returns module
+    """
+
+    with _import_lock:
+        if name in sys.modules:
+            return sys.modules[name]
+
+        spec = importlib.util.find_spec(name)
+        if spec is None:
+            raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+
+        spec.loader = importlib.util.LazyLoader(spec.loader)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+
+        parent, _, child = name.rpartition('.')
+        if parent:
+            setattr(sys.modules[parent], child, module)
+
+        return module
+
+
+class lazy_property(object):
+    """ Decorator for properties that are computed once, on first access, in a thread-safe way.
+    The value is then kept on the instance, where it is found before the property on the next accesses """
+
+    def __init__(self, function):
+        self.function = function
+        self.name = function.__name__
+        self.__doc__ = function.__doc__
+        self.lock = threading.RLock()
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        with self.lock:
+            if self.name not in instance.__dict__:
+                instance.__dict__[self.name] = self.function(instance)
+
+            return instance.__dict__[self.name]
@@ -0,0 +1,474 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Live NuvlaBox container logs, multiplexed to all the dashboard viewers """
+
+import calendar
+import collections
+import functools
+import html
+import json
+import queue
+import threading
+import time
+from system_manager.common import utils
+from system_manager.common.logging import logging
+
+
+log = logging.getLogger(__name__)
+
+
+def escape_html_line(text):
+    """ Escapes text for HTML, turning its line breaks into <br/>: a server-sent event field ends at the first CR
+    or LF, so that a rendered line must not have any
+
+    :param text: str
+    :returns str
+    """
+
+    return html.escape(text).replace('\r\n', '<br/>').replace('\r', '<br/>').replace('\n', '<br/>')
+
+
+class LogLine(object):
+    """ A single container log line.
+
+    Its HTML and NDJSON renderings are computed at most once, and then shared by all the viewers
+    """
+
+    __slots__ = ('sequence', 'container_id', 'container_name', 'timestamp', 'message', 'size', '_html', '_ndjson')
+
+    def __init__(self, container_id, container_name, line, sequence=0):
+        """ Constructs a LogLine
+
+        :param container_id: container ID. None for notices from the dashboard itself
+        :param container_name: container name
+        :param line: raw log line, as given by Docker with timestamps=True (i.e. "<timestamp> <message>")
+        :param sequence: global sequence number of the line
+        """
+
+        self.sequence = sequence
+        self.container_id = container_id
+        self.container_name = container_name
+        timestamp, _, message = line.partition(' ')
+        if container_id is None or not timestamp[:1].isdigit():
+            timestamp, message = None, line
+        self.timestamp = timestamp
+        self.message = message
+        self.size = len(line.encode())
+        self._html = None
+        self._ndjson = None
+
+    @classmethod
+    def notice(cls, sequence, message):
+        """ Builds a line with a notice from the dashboard itself (not from any container) """
+
+        return cls(None, None, message, sequence=sequence)
+
+    @property
+    def html(self):
+        """ Escaped HTML rendering, prefixed with the container name, whose color is derived from its ID """
+
+        if self._html is None:
+            if self.container_id is None:
+                self._html = '<i>{}</i><br/>'.format(escape_html_line(self.message))
+            else:
+                self._html = '<b style="color: #{};">{} |</b> {}{}<br/>'.format(
+                    self.container_id[:6],
+                    html.escape(self.container_name),
+                    html.escape(self.timestamp) + ' ' if self.timestamp else '',
+                    escape_html_line(self.message))
+
+        return self._html
+
+    @property
+    def ndjson(self):
+        """ Newline-delimited JSON rendering """
+
+        if self._ndjson is None:
+            self._ndjson = json.dumps({"container": self.container_name,
+                                       "container-id": self.container_id,
+                                       "timestamp": self.timestamp,
+                                       "message": self.message}) + '\n'
+
+        return self._ndjson
+
+    def render(self, fmt):
+        """ Renders the line either as 'html' or as 'ndjson' """
+
+        return self.ndjson if fmt == 'ndjson' else self.html
+
+
+@functools.lru_cache(maxsize=64)
+def _epoch_seconds(seconds):
+    """ Converts the seconds part of a Docker log timestamp (e.g. 2020-07-01T10:20:30), which is shared by the
+    lines logged within the same second, to seconds since the epoch """
+
+    return calendar.timegm(time.strptime(seconds, '%Y-%m-%dT%H:%M:%S'))
+
+
+def parse_log_timestamp(timestamp):
+    """ Parses the timestamp Docker prefixes the log lines with (RFC3339, in UTC, with up to nanoseconds)
+
+    :param timestamp: e.g. 2020-07-01T10:20:30.123456789Z
+    :returns nanoseconds since the epoch, or None if the timestamp cannot be parsed
+    """
+
+    if not timestamp or not timestamp.endswith('Z'):
+        return None
+
+    seconds, _, fraction = timestamp[:-1].partition('.')
+    try:
+        return _epoch_seconds(seconds) * 10 ** 9 + (int(fraction[:9].ljust(9, '0')) if fraction else 0)
+    except ValueError:
+        return None
+
+
+def iter_log_lines(chunks):
+    """ Splits a stream of Docker log chunks into complete, decoded lines, without buffering more than
+    one partial line. The CR of CRLF line endings is dropped, while the bare CRs (e.g. of progress bars) are kept
+
+    :param chunks: iterable of bytes
+    :returns generator of str
+    """
+
+    partial = b''
+    for chunk in chunks:
+        lines = (partial + chunk).split(b'\n')
+        partial = lines.pop()
+        for line in lines:
+            yield line.rstrip(b'\r').decode('utf-8', errors='replace')
+
+    if partial:
+        yield partial.rstrip(b'\r').decode('utf-8', errors='replace')
+
+
+def iter_container_logs(docker_client, containers, tail=30, since=None):
+    """ Streams the logs of several containers, one after the other, as LogLine objects, so that
+    memory usage does not depend on the size of the tail
+
+    :param docker_client: Docker client
+    :param containers: list of container objects
+    :param tail: number of lines to get from the end of each container's logs
+    :param since: only get the lines since this timestamp (in seconds since the epoch)
+    :returns generator of LogLine
+    """
+
+    for container in containers:
+        kwargs = {'since': since} if since else {}
+        try:
+            chunks = docker_client.api.logs(container.id, stream=True, follow=False, timestamps=True,
+                                            tail=tail, **kwargs)
+            for line in iter_log_lines(chunks):
+                yield LogLine(container.id, container.name, line)
+        except Exception as e:
+            log.warning(f'Unable to get the logs for {container.name}: {str(e)}')
+
+
+class LogBuffer(object):
+    """ Shared, per-container tail of the most recent log lines, capped both in lines and in bytes
+
+    Lines are kept as LogLine objects, whose sequence number is global and increasing, so that the tails of all
+    containers can be merged back in order
+    """
+
+    def __init__(self, max_lines, max_bytes):
+        """ Constructs an empty buffer
+
+        :param max_lines: maximum number of lines kept per container
+        :param max_bytes: maximum number of bytes kept per container
+        """
+
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # container ID -> deque of lines
+        self.lines = {}
+        # container ID -> number of bytes in its deque
+        self.sizes = {}
+
+    def append(self, item):
+        """ Adds a line, evicting the oldest lines of that container if the caps are exceeded
+
+        :param item: LogLine
+        """
+
+        container_id = item.container_id
+        with self.lock:
+            lines = self.lines.setdefault(container_id, collections.deque())
+            lines.append(item)
+            size = self.sizes.get(container_id, 0) + item.size
+            while lines and (len(lines) > self.max_lines or size > self.max_bytes):
+                size -= lines.popleft().size
+            self.sizes[container_id] = size
+
+    def discard(self, container_ids):
+        """ Forgets the lines of the given containers
+
+        :param container_ids: iterable of container IDs
+        """
+
+        with self.lock:
+            for container_id in container_ids:
+                self.lines.pop(container_id, None)
+                self.sizes.pop(container_id, None)
+
+    def container_ids(self):
+        """ IDs of the containers with lines in the buffer """
+
+        with self.lock:
+            return list(self.lines)
+
+    def tail(self, lines_per_container=None, after=None):
+        """ Gets the buffered lines of all containers, merged in order
+
+        :param lines_per_container: only get the last N lines of each container
+        :param after: only get the lines with a sequence number greater than this one
+        :returns list of LogLine
+        """
+
+        with self.lock:
+            merged = []
+            for lines in self.lines.values():
+                selected = list(lines)
+                if after is not None:
+                    selected = [item for item in selected if item.sequence > after]
+                if lines_per_container is not None:
+                    selected = selected[-lines_per_container:] if lines_per_container > 0 else []
+                merged.extend(selected)
+
+        merged.sort(key=lambda item: item.sequence)
+        return merged
+
+
+class LogSubscription(object):
+    """ Bounded queue of log lines for a single viewer.
+
+    A viewer that is too slow to keep up is skipped ahead: its queued lines are discarded in favour of the
+    new ones, and it is told how many lines it missed
+    """
+
+    def __init__(self, maxsize):
+        """ Constructs the subscription
+
+        :param maxsize: maximum number of lines waiting to be consumed
+        """
+
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.skipped = 0
+
+    def put(self, item):
+        """ Queues a line, without ever blocking the publisher
+
+        :param item: LogLine
+        """
+
+        try:
+            self.queue.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+
+        skipped = 0
+        while True:
+            try:
+                self.queue.get_nowait()
+                skipped += 1
+            except queue.Empty:
+                break
+
+        self.skipped += skipped
+        try:
+            self.queue.put_nowait(LogLine.notice(item.sequence, f'... too slow, skipped {skipped} log lines ...'))
+            self.queue.put_nowait(item)
+        except queue.Full:
+            pass
+
+    def get_batch(self, timeout, max_lines=500):
+        """ Waits for new lines, and gets all of those already queued
+
+        :param timeout: how long to wait, in seconds, for the first line
+        :param max_lines: maximum number of lines to get at once
+        :returns list of LogLine. Empty if the timeout was hit
+        """
+
+        try:
+            batch = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+
+        while len(batch) < max_lines:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+
+class LogMultiplexer(object):
+    """ Follows the logs of all NuvlaBox containers, with one Docker follow stream per container, each on its
+    own background thread, and fans the new lines out to all subscribers.
+
+    The most recent lines of each container are also kept in a shared LogBuffer, so that new viewers get their
+    initial tail without any Docker API call. The number of Docker API calls is therefore independent of the
+    number of open dashboards
+    """
+
+    def __init__(self, docker_client, discovery_interval=10, queue_size=1000,
+                 buffer_lines=1000, buffer_bytes=256 * 1024):
+        """ Constructs the multiplexer. Nothing is followed until start() is called
+
+        :param docker_client: Docker client
+        :param discovery_interval: how often, in seconds, to look for new NuvlaBox containers
+        :param queue_size: maximum number of lines queued per subscriber
+        :param buffer_lines: maximum number of lines buffered per container
+        :param buffer_bytes: maximum number of bytes buffered per container
+        """
+
+        self.docker_client = docker_client
+        self.discovery_interval = discovery_interval
+        self.queue_size = queue_size
+        self.buffer = LogBuffer(buffer_lines, buffer_bytes)
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.subscribers = set()
+        # container ID -> follower thread
+        self.followers = {}
+        # container ID -> timestamp, in nanoseconds since the epoch, of the last line received from it
+        self.followed_until = {}
+        # set once the first discovery pass has started following the containers
+        self.ready = threading.Event()
+        self._discovery_thread = None
+
+    def start(self):
+        """ Starts following the NuvlaBox containers' logs, if not yet started """
+
+        with self.lock:
+            if self._discovery_thread and self._discovery_thread.is_alive():
+                return
+
+            self._discovery_thread = threading.Thread(target=self._discover, name='log-discovery', daemon=True)
+            self._discovery_thread.start()
+
+    def _discover(self):
+        """ Periodically makes sure there is one follower per running NuvlaBox container, and forgets about the
+        containers that are gone """
+
+        while True:
+            try:
+                containers = self.docker_client.containers.list(filters={"label": utils.base_label})
+            except Exception as e:
+                log.warning(f'Unable to list the NuvlaBox containers for log following: {str(e)}')
+                containers = None
+
+            if containers is not None:
+                with self.lock:
+                    for container in containers:
+                        follower = self.followers.get(container.id)
+                        if follower and follower.is_alive():
+                            continue
+
+                        follower = threading.Thread(target=self._follow, args=(container,),
+                                                    name=f'log-follower-{container.name}', daemon=True)
+                        self.followers[container.id] = follower
+                        follower.start()
+
+                    running = set(c.id for c in containers)
+                    gone = [cid for cid, f in self.followers.items() if cid not in running and not f.is_alive()]
+                    for container_id in gone:
+                        self.followers.pop(container_id, None)
+                        self.followed_until.pop(container_id, None)
+
+                self.buffer.discard(gone)
+
+            self.ready.set()
+            time.sleep(self.discovery_interval)
+
+    def _follow(self, container):
+        """ Streams a container's logs, publishing every complete line, until the stream ends.
+        The first stream for a container also fetches its most recent lines, to fill the buffer
+
+        :param container: container object
+        """
+
+        # the stream resumes from the second of the last line received, since Docker only takes whole seconds, and
+        # the lines of that second which were already received are skipped
+        resume_after = self.followed_until.get(container.id)
+        if resume_after is not None:
+            kwargs = {'since': resume_after // 10 ** 9}
+        else:
+            kwargs = {'tail': self.buffer.max_lines}
+
+        try:
+            chunks = self.docker_client.api.logs(container.id, stream=True, follow=True, timestamps=True, **kwargs)
+            for line in iter_log_lines(chunks):
+                log_line = LogLine(container.id, container.name, line)
+                timestamp = parse_log_timestamp(log_line.timestamp)
+                if timestamp is not None:
+                    if resume_after is not None and timestamp <= resume_after:
+                        continue
+                    self.followed_until[container.id] = timestamp
+
+                self.publish(log_line)
+        except Exception as e:
+            log.debug(f'Log stream for {container.name} was interrupted: {str(e)}')
+
+    def publish(self, line):
+        """ Buffers a log line and sends it to all subscribers
+
+        The line's HTML rendering is done here, on the follower thread, rather than by each viewer
+
+        :param line: LogLine
+        """
+
+        line.html
+        with self.lock:
+            self.sequence += 1
+            line.sequence = self.sequence
+            self.buffer.append(line)
+            for subscription in self.subscribers:
+                subscription.put(line)
+
+    def tail(self, lines_per_container=30):
+        """ Gets the most recent lines from the buffer, starting the multiplexer if needed
+
+        :param lines_per_container: number of lines per container
+        :returns list of LogLine, and the sequence number of the last line published so far
+        """
+
+        self.start()
+        self.ready.wait(timeout=3)
+        with self.lock:
+            last = self.sequence
+
+        return [item for item in self.buffer.tail(lines_per_container) if item.sequence <= last], last
+
+    def subscribe(self, after=None):
+        """ Registers a new viewer, starting the multiplexer if needed
+
+        :param after: sequence number of the last line the viewer has already got. The buffered lines after it
+        are queued right away
+        :returns LogSubscription
+        """
+
+        self.start()
+        subscription = LogSubscription(self.queue_size)
+        with self.lock:
+            if after is not None:
+                for item in self.buffer.tail(after=after):
+                    subscription.put(item)
+            self.subscribers.add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """ Removes a viewer
+
+        :param subscription: LogSubscription
+        """
+
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+        if subscription.skipped:
+            log.debug(f'Log viewer left after skipping {subscription.skipped} lines for being too slow')
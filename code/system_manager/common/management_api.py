@@ -0,0 +1,219 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Shared client for the NuvlaBox management-api """
+
+import os
+import ssl
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from system_manager.common.logging import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """ Raised, without calling the management-api, while the circuit breaker is open """
+    pass
+
+
+class CircuitBreaker(object):
+    """ Stops calling a failing service for a while.
+
+    After failure_threshold consecutive failures, the circuit opens: calls are refused for reset_timeout seconds.
+    Then a single trial call is let through (half-open): the circuit closes again if it succeeds, or re-opens if not
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        """ Constructs a closed circuit breaker
+
+        :param failure_threshold: number of consecutive failures that opens the circuit
+        :param reset_timeout: how long, in seconds, the circuit stays open before a trial call
+        """
+
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+
+    @property
+    def state(self):
+        """ 'closed', 'open' or 'half-open' """
+
+        if self.opened_at is None:
+            return 'closed'
+
+        return 'half-open' if time.time() - self.opened_at >= self.reset_timeout else 'open'
+
+    def allow(self):
+        """ Whether a call can be made now
+
+        :returns bool
+        """
+
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return True
+
+            if state == 'half-open' and not self.trial_in_progress:
+                self.trial_in_progress = True
+                return True
+
+            return False
+
+    def record_success(self):
+        """ Closes the circuit """
+
+        with self.lock:
+            if self.opened_at is not None:
+                log.info('management-api is reachable again. Closing the circuit breaker')
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        """ Counts a failure, opening the circuit if the threshold is reached, or if the trial call failed """
+
+        with self.lock:
+            self.failures += 1
+            if self.trial_in_progress or (self.opened_at is None and self.failures >= self.failure_threshold):
+                if self.opened_at is None:
+                    log.warning(f'management-api failed {self.failures} times in a row. '
+                                f'Not calling it for {self.reset_timeout} seconds')
+                self.opened_at = time.time()
+            self.trial_in_progress = False
+
+
+class ClientCertAdapter(HTTPAdapter):
+    """ HTTP adapter whose connections all share one SSL context, where the client certificate is loaded once """
+
+    def __init__(self, ssl_context, **kwargs):
+        """ Constructs the adapter
+
+        :param ssl_context: ssl.SSLContext
+        """
+
+        self.ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        return super().init_poolmanager(*args, **kwargs)
+
+
+class ManagementAPIClient(object):
+    """ Client for the management-api, with a pool of keep-alive connections, explicit timeouts and
+    a circuit breaker.
+
+    The client certificate is only loaded into the SSL context once, and again if its files change (e.g. after a
+    certificate rotation). The connections are only opened on the first call
+    """
+
+    def __init__(self, base_url, cert_file, key_file, pool_size=4, connect_timeout=3, read_timeout=10,
+                 failure_threshold=5, reset_timeout=30):
+        """ Constructs the client
+
+        :param base_url: e.g. https://management-api:5001
+        :param cert_file: client certificate file
+        :param key_file: client key file
+        :param pool_size: maximum number of connections kept open
+        :param connect_timeout: how long to wait, in seconds, for a connection
+        :param read_timeout: how long to wait, in seconds, for a response
+        :param failure_threshold: see CircuitBreaker
+        :param reset_timeout: see CircuitBreaker
+        """
+
+        self.base_url = base_url.rstrip('/')
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.lock = threading.Lock()
+        self._session = None
+        self._cert_signature = None
+
+    def _get_cert_signature(self):
+        """ (inode, mtime, size) of the certificate and key files, or None if they do not exist """
+
+        try:
+            return tuple((st.st_ino, st.st_mtime_ns, st.st_size)
+                         for st in (os.stat(self.cert_file), os.stat(self.key_file)))
+        except FileNotFoundError:
+            return None
+
+    def get_session(self):
+        """ Gets the shared session, (re)building it if the client certificate has changed
+
+        :returns requests.Session
+        """
+
+        signature = self._get_cert_signature()
+        with self.lock:
+            if self._session is not None and signature == self._cert_signature:
+                return self._session
+
+            # same as verify=False: the management-api uses a self-signed certificate
+            ssl_context = ssl.create_default_context()
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+            if signature:
+                ssl_context.load_cert_chain(self.cert_file, self.key_file)
+
+            session = requests.Session()
+            session.mount('https://', ClientCertAdapter(ssl_context, pool_connections=1, pool_maxsize=self.pool_size))
+
+            if self._session is not None:
+                self._session.close()
+            self._session = session
+            self._cert_signature = signature
+            return session
+
+    def request(self, method, path, **kwargs):
+        """ Calls the management-api
+
+        :param method: HTTP method
+        :param path: path, e.g. /api/data-source-mjpg/disable
+        :param kwargs: see requests.Session.request. The timeout defaults to the client's one
+        :returns requests.Response, with a successful status
+        :raises CircuitOpenError if the management-api has been failing, or requests.RequestException
+        """
+
+        if not self.breaker.allow():
+            raise CircuitOpenError(f'management-api circuit breaker is {self.breaker.state}')
+
+        kwargs.setdefault('timeout', self.timeout)
+        # given on every call, as a CA bundle from the environment (REQUESTS_CA_BUNDLE) overrides the session default
+        kwargs.setdefault('verify', False)
+        try:
+            response = self.get_session().request(method, f'{self.base_url}{path}', **kwargs)
+            response.raise_for_status()
+        except requests.HTTPError as e:
+            # the management-api did answer: only server errors count as failures
+            if e.response is not None and e.response.status_code < 500:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+
+        self.breaker.record_success()
+        return response
+
+    def post(self, path, **kwargs):
+        """ POST to the management-api. See request """
+
+        return self.request('POST', path, **kwargs)
+
+    def get(self, path, **kwargs):
+        """ GET from the management-api. See request """
+
+        return self.request('GET', path, **kwargs)
@@ -0,0 +1,265 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" OpenMetrics text exposition of the container, host and supervisor metrics
+
+The exposition is rendered by the supervisor once per collection cycle, and published to the dashboard, which serves
+it as is on every scrape. Reference: https://github.com/OpenObservability/OpenMetrics
+"""
+
+import math
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+PREFIX = 'nuvlabox'
+
+MIB = 1024 * 1024
+MB = 1000 * 1000
+
+
+def escape_label_value(value):
+    """ Escapes a label value, as required by the text format
+
+    :param value: any
+    :returns str
+    """
+
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value):
+    """ Formats a sample value
+
+    :param value: number
+    :returns str
+    """
+
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+
+    return repr(value)
+
+
+class MetricFamily(object):
+    """ A metric family and its samples """
+
+    # suffix of the sample names, per metric type
+    suffixes = {'counter': '_total', 'info': '_info', 'gauge': ''}
+
+    def __init__(self, name, metric_type, documentation, unit=None):
+        """ Constructs an empty family
+
+        :param name: family name, without the PREFIX. Must end with the unit, if any
+        :param metric_type: gauge, counter or info
+        :param documentation: HELP text
+        :param unit: e.g. bytes, seconds
+        """
+
+        self.name = f'{PREFIX}_{name}'
+        self.metric_type = metric_type
+        self.documentation = documentation
+        self.unit = unit
+        self.samples = []
+
+    def add(self, value, **labels):
+        """ Adds a sample. Samples whose value is unknown (None) are skipped
+
+        :param value: number
+        :param labels: label values, by label name
+        """
+
+        if value is not None:
+            self.samples.append((labels, value))
+
+    def render(self):
+        """ Text exposition of the family
+
+        :returns str, or an empty string if there are no samples
+        """
+
+        if not self.samples:
+            return ''
+
+        lines = [f'# TYPE {self.name} {self.metric_type}']
+        if self.unit:
+            lines.append(f'# UNIT {self.name} {self.unit}')
+        lines.append(f'# HELP {self.name} {self.documentation}')
+
+        sample_name = self.name + self.suffixes[self.metric_type]
+        for labels, value in self.samples:
+            if labels:
+                label_set = ','.join(f'{k}="{escape_label_value(v)}"' for k, v in labels.items())
+                lines.append(f'{sample_name}{{{label_set}}} {format_value(value)}')
+            else:
+                lines.append(f'{sample_name} {format_value(value)}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def container_families(stats_snapshot):
+    """ Metric families for the Docker stats
+
+    :param stats_snapshot: StatsStore snapshot
+    :returns list of MetricFamily
+    """
+
+    info = MetricFamily('container', 'info', 'NuvlaBox container')
+    cpu = MetricFamily('container_cpu_percent', 'gauge', 'Container CPU usage, in % of one CPU')
+    mem_usage = MetricFamily('container_memory_usage_bytes', 'gauge', 'Container memory usage', 'bytes')
+    mem_limit = MetricFamily('container_memory_limit_bytes', 'gauge', 'Container memory limit', 'bytes')
+    mem_percent = MetricFamily('container_memory_percent', 'gauge', 'Container memory usage, in % of its limit')
+    net_in = MetricFamily('container_network_receive_bytes', 'counter', 'Container network bytes received', 'bytes')
+    net_out = MetricFamily('container_network_transmit_bytes', 'counter', 'Container network bytes transmitted',
+                           'bytes')
+    blk_in = MetricFamily('container_block_read_bytes', 'counter', 'Container block bytes read', 'bytes')
+    blk_out = MetricFamily('container_block_write_bytes', 'counter', 'Container block bytes written', 'bytes')
+    restarts = MetricFamily('container_restarts', 'counter', 'Number of times the container has been restarted')
+
+    for container in stats_snapshot.get("containers", []):
+        labels = {"id": container["id"][:12], "name": container["name"]}
+        info.add(1, status=container["status"], **labels)
+        cpu.add(container["cpu-percent"], **labels)
+        mem_usage.add(container["mem-usage"] * MIB, **labels)
+        mem_limit.add(container["mem-limit"] * MIB, **labels)
+        mem_percent.add(container["mem-percent"], **labels)
+        net_in.add(container["net-in"] * MB, **labels)
+        net_out.add(container["net-out"] * MB, **labels)
+        blk_in.add(container["blk-in"] * MB, **labels)
+        blk_out.add(container["blk-out"] * MB, **labels)
+        restarts.add(container["restart-count"], **labels)
+
+    last_update = MetricFamily('docker_stats_last_update_timestamp_seconds', 'gauge',
+                               'Time of the last Docker stats pass', 'seconds')
+    last_update.add(stats_snapshot.get("last-update"))
+    pass_duration = MetricFamily('docker_stats_pass_duration_seconds', 'gauge',
+                                 'Duration of the last Docker stats pass', 'seconds')
+    pass_duration.add(stats_snapshot.get("pass-duration"))
+
+    return [info, cpu, mem_usage, mem_limit, mem_percent, net_in, net_out, blk_in, blk_out, restarts,
+            last_update, pass_duration]
+
+
+def host_families(nuvlabox_status):
+    """ Metric families for the host usages, from the NuvlaBox status
+
+    :param nuvlabox_status: NuvlaBox status, as written by the NuvlaBox Agent
+    :returns list of MetricFamily
+    """
+
+    cpus = MetricFamily('host_cpus', 'gauge', 'Number of CPUs')
+    cpus.add(nuvlabox_status.get("cpus"))
+    cpu = MetricFamily('host_cpu_usage_percent', 'gauge', 'Host CPU usage, in %')
+    cpu.add(nuvlabox_status.get("cpu-usage"))
+    memory = MetricFamily('host_memory_bytes', 'gauge', 'Host memory', 'bytes')
+    if nuvlabox_status.get("memory") is not None:
+        memory.add(float(nuvlabox_status["memory"]) * MIB)
+    mem_usage = MetricFamily('host_memory_usage_percent', 'gauge', 'Host memory usage, in %')
+    mem_usage.add(nuvlabox_status.get("memory-usage"))
+    disk = MetricFamily('host_disk_bytes', 'gauge', 'Host disk size', 'bytes')
+    if nuvlabox_status.get("disk") is not None:
+        disk.add(float(nuvlabox_status["disk"]) * 1024 * MIB)
+    disk_usage = MetricFamily('host_disk_usage_percent', 'gauge', 'Host disk usage, in %')
+    disk_usage.add(nuvlabox_status.get("disk-usage"))
+
+    net_rx = MetricFamily('host_network_receive_bytes', 'counter', 'Host network bytes received', 'bytes')
+    net_tx = MetricFamily('host_network_transmit_bytes', 'counter', 'Host network bytes transmitted', 'bytes')
+    for nstat in nuvlabox_status.get("resources", {}).get("net-stats", []):
+        iface = nstat.get('interface')
+        if not iface:
+            continue
+
+        net_rx.add(nstat.get('bytes-received'), interface=iface)
+        net_tx.add(nstat.get('bytes-transmitted'), interface=iface)
+
+    return [cpus, cpu, memory, mem_usage, disk, disk_usage, net_rx, net_tx]
+
+
+def scheduler_families(scheduler_report):
+    """ Metric families for the supervisor tasks
+
+    :param scheduler_report: Scheduler report
+    :returns list of MetricFamily
+    """
+
+    runs = MetricFamily('supervisor_task_runs', 'counter', 'Number of runs of the supervisor task')
+    failures = MetricFamily('supervisor_task_failures', 'counter', 'Number of failed runs of the supervisor task')
+    skipped = MetricFamily('supervisor_task_skipped', 'counter',
+                           'Number of runs skipped because the previous one was still running')
+    timeouts = MetricFamily('supervisor_task_timeouts', 'counter', 'Number of runs which exceeded their timeout')
+    missed = MetricFamily('supervisor_task_missed_deadlines', 'counter',
+                          'Number of runs which finished later than their timeout after they were due')
+    duration = MetricFamily('supervisor_task_duration_seconds', 'counter', 'Total run time of the supervisor task',
+                            'seconds')
+    last_duration = MetricFamily('supervisor_task_last_duration_seconds', 'gauge',
+                                 'Run time of the last run of the supervisor task', 'seconds')
+    max_duration = MetricFamily('supervisor_task_max_duration_seconds', 'gauge',
+                                'Longest run of the supervisor task', 'seconds')
+    lag = MetricFamily('supervisor_task_lag_seconds', 'gauge',
+                       'How late the last run of the supervisor task started', 'seconds')
+    interval = MetricFamily('supervisor_task_interval_seconds', 'gauge', 'Interval of the supervisor task',
+                            'seconds')
+
+    for task, report in scheduler_report.items():
+        runs.add(report["runs"], task=task)
+        failures.add(report["failures"], task=task)
+        skipped.add(report["skipped"], task=task)
+        timeouts.add(report["timeouts"], task=task)
+        missed.add(report["missed-deadlines"], task=task)
+        duration.add(report["total-duration"], task=task)
+        last_duration.add(report["last-duration"], task=task)
+        max_duration.add(report["max-duration"], task=task)
+        lag.add(report["last-lag"], task=task)
+        interval.add(report["interval"], task=task)
+
+    return [runs, failures, skipped, timeouts, missed, duration, last_duration, max_duration, lag, interval]
+
+
+def docker_api_families(docker_api_report):
+    """ Metric families for the Docker API calls made by the supervisor
+
+    :param docker_api_report: DockerClientFactory report
+    :returns list of MetricFamily
+    """
+
+    calls = MetricFamily('supervisor_docker_api_calls', 'counter', 'Number of Docker API calls, by endpoint')
+    errors = MetricFamily('supervisor_docker_api_errors', 'counter', 'Number of failed Docker API calls, by endpoint')
+    max_latency = MetricFamily('supervisor_docker_api_max_latency_seconds', 'gauge',
+                               'Slowest Docker API call, by endpoint', 'seconds')
+    for endpoint, metrics in docker_api_report.get("endpoints", {}).items():
+        calls.add(metrics["calls"], endpoint=endpoint)
+        errors.add(metrics["errors"], endpoint=endpoint)
+        max_latency.add(metrics["max-latency"], endpoint=endpoint)
+
+    ping = MetricFamily('supervisor_docker_ping_latency_seconds', 'gauge', 'Latency of the last Docker ping',
+                        'seconds')
+    ping.add(docker_api_report.get("ping-latency"))
+
+    return [calls, errors, max_latency, ping]
+
+
+def render(stats_snapshot=None, nuvlabox_status=None, scheduler_report=None, docker_api_report=None):
+    """ Renders the full exposition
+
+    :param stats_snapshot: StatsStore snapshot
+    :param nuvlabox_status: NuvlaBox status
+    :param scheduler_report: Scheduler report
+    :param docker_api_report: DockerClientFactory report
+    :returns bytes, UTF-8 encoded
+    """
+
+    families = []
+    if stats_snapshot:
+        families += container_families(stats_snapshot)
+    if nuvlabox_status:
+        families += host_families(nuvlabox_status)
+    if scheduler_report:
+        families += scheduler_families(scheduler_report)
+    if docker_api_report:
+        families += docker_api_families(docker_api_report)
+
+    return (''.join(family.render() for family in families) + '# EOF\n').encode()
@@ -0,0 +1,364 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Index of the peripherals discovered by the other NuvlaBox microservices
+
+Each peripheral is a JSON file in the shared .peripherals folder (one sub-folder per peripheral type). The index
+follows the changes with inotify, and only re-parses the files that change. Where inotify is not available, it falls
+back to comparing the files' inode, modification time and size
+"""
+
+import copy
+import ctypes
+import ctypes.util
+import errno
+import json
+import os
+import select
+import struct
+import threading
+import time
+from system_manager.common.logging import logging
+
+
+log = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF \
+             | IN_ONLYDIR
+
+# struct inotify_event {int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[];}
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """ Minimal inotify binding, through the C library """
+
+    def __init__(self):
+        """ Creates a non-blocking inotify instance
+
+        :raises OSError if inotify is not available
+        """
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """ Watches a directory
+
+        :param path: directory path
+        :param mask: events to watch for
+        :returns watch descriptor
+        """
+
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+
+        return wd
+
+    def read(self, timeout):
+        """ Waits for events
+
+        :param timeout: how long to wait, in seconds
+        :returns list of (watch descriptor, mask, name). Empty if the timeout was hit
+        """
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buffer):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(buffer[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, name))
+
+        return events
+
+    def close(self):
+        """ Releases the inotify instance """
+
+        os.close(self.fd)
+
+
+class PeripheralIndex(object):
+    """ Keeps the parsed peripheral files, by file path and by peripheral ID """
+
+    def __init__(self, folder, stat_interval=2, resync_interval=300):
+        """ Constructs the index. Nothing is read until it is first used
+
+        :param folder: peripherals folder
+        :param stat_interval: without inotify, minimum time, in seconds, between two scans of the folder
+        :param resync_interval: with inotify, how often, in seconds, the folder is scanned anyway, as a safety net
+        """
+
+        self.folder = folder
+        self.stat_interval = stat_interval
+        self.resync_interval = resync_interval
+        self.lock = threading.RLock()
+        # file path -> ((inode, mtime, size), peripheral)
+        self.files = {}
+        # peripheral ID -> peripheral
+        self.by_id = {}
+        self.last_scan = 0
+        self.inotify = None
+        self.inotify_available = True
+        # watch descriptor -> directory path
+        self.watches = {}
+        self._watcher = None
+
+    def _load(self, path, signature=None):
+        """ (Re)parses a peripheral file, unless it has not changed
+
+        :param path: file path
+        :param signature: (inode, mtime, size) of the file, if already known
+        """
+
+        if signature is None:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                self._forget(path)
+                return
+
+            signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+        cached = self.files.get(path)
+        if cached and cached[0] == signature:
+            return
+
+        try:
+            with open(path) as p:
+                peripheral = json.loads(p.read())
+        except FileNotFoundError:
+            self._forget(path)
+            return
+        except (OSError, ValueError):
+            # most likely being written. It is read again on its next change, or on the next scan
+            log.warning(f"Cannot read peripheral {path}")
+            return
+
+        self._forget(path)
+        self.files[path] = (signature, peripheral)
+        if isinstance(peripheral, dict) and peripheral.get("id"):
+            self.by_id[peripheral["id"]] = peripheral
+
+    def _forget(self, path):
+        """ Removes a peripheral file from the index
+
+        :param path: file path
+        """
+
+        cached = self.files.pop(path, None)
+        if cached and isinstance(cached[1], dict) and self.by_id.get(cached[1].get("id")) is cached[1]:
+            self.by_id.pop(cached[1]["id"])
+
+    def _forget_folder(self, folder):
+        """ Removes all peripheral files under a folder
+
+        :param folder: folder path
+        """
+
+        prefix = folder.rstrip('/') + '/'
+        for path in [p for p in self.files if p.startswith(prefix)]:
+            self._forget(path)
+
+    def scan(self, folder=None):
+        """ Walks the folder, stat'ing every file, and (re)parses only the new and modified ones.
+        Files which are gone are dropped. With inotify, new sub-folders are also watched
+
+        :param folder: sub-folder to scan. Defaults to the whole peripherals folder
+        """
+
+        folder = folder or self.folder
+        with self.lock:
+            seen = set()
+            pending = [folder]
+            while pending:
+                current = pending.pop()
+                if self.inotify:
+                    self._watch(current)
+                try:
+                    entries = list(os.scandir(current))
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            pending.append(entry.path)
+                            continue
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+
+                    seen.add(entry.path)
+                    self._load(entry.path, (st.st_ino, st.st_mtime_ns, st.st_size))
+
+            prefix = folder.rstrip('/') + '/'
+            for path in [p for p in self.files if p.startswith(prefix) and p not in seen]:
+                self._forget(path)
+
+            if folder == self.folder:
+                self.last_scan = time.time()
+
+    def _watch(self, folder):
+        """ Adds an inotify watch on a folder, if not yet watched
+
+        :param folder: folder path
+        """
+
+        if folder in self.watches.values():
+            return
+
+        try:
+            self.watches[self.inotify.add_watch(folder)] = folder
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                log.warning(f'Unable to watch {folder} for peripheral changes: {str(e)}')
+
+    def start(self):
+        """ Loads the index and, if inotify is available, starts following the changes.
+        Otherwise, the index is refreshed by scanning the folder whenever it is used """
+
+        with self.lock:
+            if self._watcher and self._watcher.is_alive():
+                return
+
+            if os.path.isdir(self.folder):
+                try:
+                    self.inotify = Inotify()
+                except (OSError, AttributeError) as e:
+                    log.warning(f'inotify is not available ({str(e)}). Peripherals will be looked up by scanning')
+                    self.inotify = None
+                    self.inotify_available = False
+
+            self.watches = {}
+            self.scan()
+            if self.inotify:
+                self._watcher = threading.Thread(target=self._follow, name='peripherals-watcher', daemon=True)
+                self._watcher.start()
+
+    def _follow(self):
+        """ Applies the inotify events to the index, until the peripherals folder itself goes away """
+
+        inotify = self.inotify
+        try:
+            while True:
+                events = inotify.read(timeout=self.resync_interval)
+                with self.lock:
+                    if not events:
+                        self.scan()
+                        continue
+
+                    for wd, mask, name in events:
+                        if mask & IN_Q_OVERFLOW:
+                            self.scan()
+                            continue
+
+                        folder = self.watches.get(wd)
+                        if folder is None:
+                            continue
+
+                        if mask & IN_IGNORED:
+                            self.watches.pop(wd, None)
+                            self._forget_folder(folder)
+                            if folder == self.folder:
+                                return
+                            continue
+
+                        if not name:
+                            continue
+
+                        path = os.path.join(folder, name)
+                        if mask & IN_ISDIR:
+                            if mask & (IN_CREATE | IN_MOVED_TO):
+                                self.scan(path)
+                            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                                self._forget_folder(path)
+                        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                            self._load(path)
+                        elif mask & (IN_DELETE | IN_MOVED_FROM):
+                            self._forget(path)
+        except Exception:
+            log.exception('Peripherals watcher stopped. Peripherals will be looked up by scanning')
+        finally:
+            with self.lock:
+                if self.inotify is inotify:
+                    self.inotify = None
+                    self.watches = {}
+                inotify.close()
+
+    def refresh(self):
+        """ Makes sure the index is up to date: followed with inotify, or else scanned recently enough """
+
+        if self._watcher and self._watcher.is_alive():
+            return
+
+        if time.time() - self.last_scan < self.stat_interval:
+            return
+
+        if self.inotify_available and os.path.isdir(self.folder):
+            # (re)try with inotify, e.g. when the folder has been created since the index was started
+            self.start()
+        else:
+            self.scan()
+
+    def list(self):
+        """ All peripherals
+
+        :returns list of peripherals [{...}, {...}] with the original data schema (see Nuvla nuvlabox-peripherals).
+        They are copies, which the caller may modify without affecting the index
+        """
+
+        self.refresh()
+        with self.lock:
+            return [copy.deepcopy(peripheral) for _, peripheral in self.files.values()]
+
+    def ids(self):
+        """ IDs of all peripherals
+
+        :returns set
+        """
+
+        self.refresh()
+        with self.lock:
+            return set(self.by_id)
+
+    def get(self, peripheral_id):
+        """ Looks a peripheral up by its ID
+
+        :param peripheral_id: e.g. nuvlabox-peripheral/<uuid>
+        :returns copy of the peripheral, or None
+        """
+
+        self.refresh()
+        with self.lock:
+            peripheral = self.by_id.get(peripheral_id)
+            return copy.deepcopy(peripheral) if peripheral is not None else None
@@ -0,0 +1,240 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Scheduler for the periodic supervisor tasks
+
+Each task runs on its own interval, on a shared worker pool, so that a slow task (e.g. the Docker stats) does not
+delay the others (e.g. the datagateway recovery)
+"""
+
+import concurrent.futures
+import random
+import threading
+import time
+from system_manager.common.logging import logging
+
+
+log = logging.getLogger(__name__)
+
+# what to do when a task is due while its previous run is still going on
+OVERRUN_SKIP = 'skip'          # skip this run, and schedule the next one
+OVERRUN_DELAY = 'delay'        # run again as soon as the previous run is over
+OVERRUN_CONCURRENT = 'concurrent'  # start another run anyway
+
+
+class Task(object):
+    """ A periodic task, and its execution counters """
+
+    def __init__(self, name, function, interval, timeout=None, jitter=0.0, overrun=OVERRUN_SKIP,
+                 fatal_exceptions=()):
+        """ Constructs a task
+
+        :param name: task name
+        :param function: function to run, without arguments. It may return the number of seconds until it needs
+        to run again, to override the interval for its next run. Other return values are ignored
+        :param interval: how often to run, in seconds
+        :param timeout: how long a run may take, in seconds, before it is reported as timed out. Runs cannot be
+        interrupted, so a timed out run keeps its worker until it returns. Defaults to the interval
+        :param jitter: maximum random delay, in seconds, added to each run, to spread the load
+        :param overrun: one of OVERRUN_SKIP, OVERRUN_DELAY or OVERRUN_CONCURRENT
+        :param fatal_exceptions: exception types which, when raised by the task, stop the scheduler
+        """
+
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.timeout = timeout if timeout is not None else interval
+        self.jitter = jitter
+        self.overrun = overrun
+        self.fatal_exceptions = tuple(fatal_exceptions)
+
+        self.next_run = time.time()
+        # scheduled time -> start time, for the runs in progress
+        self.running = {}
+
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.timeouts = 0
+        self.missed_deadlines = 0
+        self.last_duration = None
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.last_lag = None
+
+    def schedule_next(self, after, interval=None):
+        """ Sets the time of the next run
+
+        :param after: time from which to count the interval
+        :param interval: interval to use instead of the task's one
+        """
+
+        interval = self.interval if interval is None else interval
+        self.next_run = after + interval + (random.uniform(0, self.jitter) if self.jitter else 0)
+
+    def report(self):
+        """ Execution counters
+
+        :returns dict
+        """
+
+        return {
+            "interval": self.interval,
+            "timeout": self.timeout,
+            "runs": self.runs,
+            "running": len(self.running),
+            "failures": self.failures,
+            "skipped": self.skipped,
+            "timeouts": self.timeouts,
+            "missed-deadlines": self.missed_deadlines,
+            "last-duration": self.last_duration,
+            "max-duration": self.max_duration,
+            "mean-duration": self.total_duration / self.runs if self.runs else None,
+            "total-duration": self.total_duration,
+            "last-lag": self.last_lag,
+            "next-run": self.next_run
+        }
+
+
+class Scheduler(object):
+    """ Runs periodic Tasks on a bounded worker pool """
+
+    def __init__(self, max_workers=4):
+        """ Constructs the scheduler
+
+        :param max_workers: size of the worker pool
+        """
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                              thread_name_prefix='supervisor-task')
+        self.tasks = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self._fatal = None
+        self._stopped = False
+
+    def add(self, task):
+        """ Adds a task, to be run as soon as possible and then on its interval
+
+        :param task: Task
+        :returns the task
+        """
+
+        with self.lock:
+            self.tasks.append(task)
+        self.wakeup.set()
+        return task
+
+    def _execute(self, task, scheduled):
+        """ Runs a task, and updates its counters
+
+        :param task: Task
+        :param scheduled: time at which the run was due
+        """
+
+        started = time.time()
+        task.running[scheduled] = started
+        task.last_lag = started - scheduled
+        next_interval = None
+        try:
+            next_interval = task.function()
+        except task.fatal_exceptions as e:
+            self._fatal = e
+            self.wakeup.set()
+        except Exception:
+            task.failures += 1
+            log.exception(f'Supervisor task {task.name} failed')
+        finally:
+            finished = time.time()
+            duration = finished - started
+            task.running.pop(scheduled, None)
+            task.runs += 1
+            task.last_duration = duration
+            task.total_duration += duration
+            task.max_duration = max(task.max_duration, duration)
+            if finished > scheduled + task.timeout:
+                task.missed_deadlines += 1
+
+            # only a number of seconds overrides the interval: any other result (e.g. a "changed" flag, which
+            # is a bool, hence an int) is ignored
+            if isinstance(next_interval, bool) or not isinstance(next_interval, (int, float)):
+                next_interval = None
+
+            if task.overrun == OVERRUN_DELAY or next_interval is not None:
+                with self.lock:
+                    task.schedule_next(finished, next_interval)
+                self.wakeup.set()
+
+    def _check_timeouts(self, now):
+        """ Reports the runs that are taking longer than their timeout, once per run """
+
+        for task in self.tasks:
+            for scheduled, started in list(task.running.items()):
+                if started is not None and now - started > task.timeout:
+                    task.running[scheduled] = None
+                    task.timeouts += 1
+                    log.warning(f'Supervisor task {task.name} has been running for more than {task.timeout} seconds')
+
+    def run_pending(self):
+        """ Submits the tasks that are due
+
+        :returns time until the next task is due, in seconds
+        """
+
+        now = time.time()
+        with self.lock:
+            self._check_timeouts(now)
+            for task in self.tasks:
+                if task.next_run > now:
+                    continue
+
+                if task.running and task.overrun != OVERRUN_CONCURRENT:
+                    if task.overrun == OVERRUN_SKIP:
+                        task.skipped += 1
+                        task.schedule_next(now)
+                    else:
+                        # OVERRUN_DELAY: rescheduled when the current run finishes
+                        task.next_run = float('inf')
+                    continue
+
+                scheduled = task.next_run
+                # the next run is scheduled from the due time, not from the end of the run, to keep a steady pace
+                task.schedule_next(max(scheduled, now - task.interval))
+                if task.overrun == OVERRUN_DELAY:
+                    task.next_run = float('inf')
+                task.running[scheduled] = None
+                self.executor.submit(self._execute, task, scheduled)
+
+            next_run = min((task.next_run for task in self.tasks), default=now + 1)
+
+        return max(next_run - now, 0)
+
+    def report(self):
+        """ Execution counters of all tasks
+
+        :returns dict of task name -> counters
+        """
+
+        with self.lock:
+            return {task.name: task.report() for task in self.tasks}
+
+    def stop(self):
+        """ Makes run_forever return, within a second. Runs already started are not interrupted, but no new run is
+        started. Only sets a flag, so that it is safe to call from a signal handler
+        """
+
+        self._stopped = True
+
+    def run_forever(self):
+        """ Runs the tasks until stop() is called, or one of them raises a fatal exception, which is then re-raised """
+
+        while not self._stopped:
+            delay = self.run_pending()
+            if self._fatal:
+                raise self._fatal
+
+            # wake up at least every second, to check on the timeouts
+            self.wakeup.wait(timeout=min(delay, 1))
+            self.wakeup.clear()
+
+        self.executor.shutdown(wait=False)
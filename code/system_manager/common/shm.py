@@ -0,0 +1,487 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Shared-memory channel for the snapshots published by the supervisor to the dashboard
+
+A SharedSnapshot is a memory-mapped file, in the in-memory RUNTIME_FOLDER, holding the latest version of a payload
+(e.g. the Docker stats, as JSON). The supervisor publishes into it, while each dashboard worker maps the same file
+and reads it without any disk I/O nor system call.
+
+Consistency is given by a seqlock: the sequence counter is odd while a write is in progress, and readers retry when
+it is odd or has changed during their copy of the payload. A CRC32 of the payload guards against the reordering of
+the writes by weakly ordered CPUs. The sequence counter is also a futex word, so that readers can sleep until the
+next publication.
+
+When a payload outgrows the mapping, or when a new writer starts, a new file is created aside and moved in place,
+and the old one is marked as superseded, for the readers to reopen the path. The new file carries the sequence counter
+on, so that readers can keep comparing sequences across files.
+
+File layout:
+
+    header        HEADER_SIZE bytes: magic, version, sequence, superseded (uint32), length (uint64),
+                  timestamp (double), crc32 (uint32), reserved, capacity (uint64), reserved
+    payload       capacity bytes
+"""
+
+import ctypes
+import errno
+import json
+import mmap
+import os
+import platform
+import struct
+import sys
+import threading
+import time
+import zlib
+from system_manager.common.logging import logging
+
+
+log = logging.getLogger(__name__)
+
+MAGIC = 0x4e425348  # "NBSH"
+VERSION = 1
+HEADER_SIZE = 64
+DEFAULT_CAPACITY = 64 * 1024
+
+_SEQUENCE = struct.Struct('=I')
+_SEQUENCE_OFFSET = 8
+_SUPERSEDED = struct.Struct('=I')
+_SUPERSEDED_OFFSET = 12
+# length, timestamp, crc32
+_PAYLOAD_INFO = struct.Struct('=QdI')
+_PAYLOAD_INFO_OFFSET = 16
+_CAPACITY = struct.Struct('=Q')
+_CAPACITY_OFFSET = 40
+
+# attempts at getting a consistent copy, before giving up on a read
+READ_ATTEMPTS = 100
+
+# futex(2) syscall numbers, by machine. Elsewhere, waiters poll the sequence counter
+_FUTEX_SYSCALLS = {'x86_64': 202, 'aarch64': 98, 'armv6l': 240, 'armv7l': 240, 'armv8l': 240, 'i686': 240}
+_FUTEX_WAIT = 0
+_FUTEX_WAKE = 1
+_POLL_INTERVAL = 0.05
+# how long the watcher of a reader lingers without waiters, before it stops
+_WATCHER_IDLE_TIMEOUT = 5
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _load_futex():
+    """ Gets the syscall function and the futex syscall number, if futexes can be used on this machine
+
+    :returns (syscall function, syscall number), or None
+    """
+
+    number = _FUTEX_SYSCALLS.get(platform.machine())
+    if number is None:
+        return None
+
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.syscall, number
+    except (OSError, AttributeError):
+        return None
+
+
+_futex = _load_futex()
+
+
+def _green_threadpool():
+    """ Gets gevent's pool of native threads, if the process has been monkey-patched by gevent (e.g. by the gunicorn
+    gevent worker). Blocking system calls must then be made from that pool, so as not to block the event loop
+
+    :returns gevent ThreadPool, or None
+    """
+
+    gevent_monkey = sys.modules.get('gevent.monkey')
+    if gevent_monkey and gevent_monkey.is_module_patched('threading'):
+        import gevent
+        return gevent.get_hub().threadpool
+
+    return None
+
+
+class SharedSnapshot(object):
+    """ Single-writer, multi-reader, memory-mapped snapshot of a payload """
+
+    def __init__(self, path, mm, writable):
+        """ Maps the snapshot structure on top of an already opened mmap. Use create() or open() instead
+
+        :param path: file path
+        :param mm: mmap object
+        :param writable: whether this instance is the writer
+        """
+
+        self.path = path
+        self.mm = mm
+        self.writable = writable
+
+        magic, version = struct.unpack_from('=II', mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a valid shared snapshot')
+
+        self.capacity = _CAPACITY.unpack_from(mm, _CAPACITY_OFFSET)[0]
+        self._futex_word = ctypes.c_uint32.from_buffer(mm, _SEQUENCE_OFFSET) if _futex else None
+
+    @staticmethod
+    def _new_file(path, capacity, sequence=0):
+        """ Creates and maps a new, empty, snapshot file
+
+        :param path: file path
+        :param capacity: payload capacity, in bytes
+        :param sequence: initial (even) value of the sequence counter. 0 for a new channel
+        :returns mmap object
+        """
+
+        with open(path, 'w+b') as f:
+            f.truncate(HEADER_SIZE + capacity)
+            mm = mmap.mmap(f.fileno(), HEADER_SIZE + capacity)
+
+        struct.pack_into('=II', mm, 0, MAGIC, VERSION)
+        _SEQUENCE.pack_into(mm, _SEQUENCE_OFFSET, sequence)
+        _CAPACITY.pack_into(mm, _CAPACITY_OFFSET, capacity)
+        return mm
+
+    @classmethod
+    def create(cls, path, capacity=DEFAULT_CAPACITY):
+        """ Creates a new snapshot file, for writing, and marks the previous one (if any) as superseded
+
+        :param path: file path
+        :param capacity: initial payload capacity, in bytes. The snapshot grows when needed
+        :returns SharedSnapshot
+        """
+
+        try:
+            previous = cls.open(path)
+        except (OSError, ValueError):
+            previous = None
+
+        # build the new file aside, so that readers still mapping the old one are not affected. Its sequence starts
+        # above the previous file's, so that the first version published into it compares as new
+        sequence = ((previous.sequence + 2) & ~1 & 0xffffffff) if previous else 0
+        tmp_path = f'{path}.tmp'
+        snapshot = cls(tmp_path, cls._new_file(tmp_path, capacity, sequence), True)
+
+        os.replace(tmp_path, path)
+        snapshot.path = path
+        if previous:
+            previous._supersede()
+            previous.close()
+
+        return snapshot
+
+    @classmethod
+    def open(cls, path):
+        """ Maps an existing snapshot file, for reading.
+
+        The file is mapped read-write, since futexes need a writable mapping, but readers never write into it
+
+        :param path: file path
+        :returns SharedSnapshot
+        """
+
+        with open(path, 'r+b') as f:
+            mm = mmap.mmap(f.fileno(), 0)
+
+        try:
+            return cls(path, mm, False)
+        except ValueError:
+            mm.close()
+            raise
+
+    @property
+    def sequence(self):
+        """ Current value of the sequence counter: odd while a write is in progress """
+
+        return _SEQUENCE.unpack_from(self.mm, _SEQUENCE_OFFSET)[0]
+
+    @property
+    def superseded(self):
+        """ Whether a newer snapshot file has replaced this one (readers should then reopen the path) """
+
+        return bool(_SUPERSEDED.unpack_from(self.mm, _SUPERSEDED_OFFSET)[0])
+
+    def close(self):
+        """ Unmaps the file """
+
+        # the futex word holds an export of the mmap buffer, which must be released first
+        self._futex_word = None
+        self.mm.close()
+
+    def _bump_sequence(self):
+        """ Increments the sequence counter (wrapping around) """
+
+        _SEQUENCE.pack_into(self.mm, _SEQUENCE_OFFSET, (self.sequence + 1) & 0xffffffff)
+
+    def _wake(self):
+        """ Wakes up all the readers waiting for a new sequence """
+
+        if self._futex_word is not None:
+            syscall, number = _futex
+            syscall(number, ctypes.byref(self._futex_word), _FUTEX_WAKE, 0x7fffffff, None, None, 0)
+
+    def _supersede(self):
+        """ Marks the file as replaced, and wakes up its readers so that they reopen the path """
+
+        _SUPERSEDED.pack_into(self.mm, _SUPERSEDED_OFFSET, 1)
+        # keep the sequence even, in case a writer died in the middle of a write
+        self._bump_sequence()
+        if self.sequence % 2:
+            self._bump_sequence()
+        self._wake()
+
+    def publish(self, payload, timestamp=None):
+        """ Replaces the payload, and wakes up the waiting readers
+
+        :param payload: bytes
+        :param timestamp: time of the snapshot. Defaults to now
+        """
+
+        if not self.writable:
+            raise PermissionError(f'{self.path} is mapped read-only')
+
+        if len(payload) > self.capacity:
+            self._grow(len(payload))
+
+        timestamp = time.time() if timestamp is None else timestamp
+        self._bump_sequence()
+        self.mm[HEADER_SIZE:HEADER_SIZE + len(payload)] = payload
+        _PAYLOAD_INFO.pack_into(self.mm, _PAYLOAD_INFO_OFFSET, len(payload), timestamp, zlib.crc32(payload))
+        self._bump_sequence()
+        self._wake()
+
+    def _grow(self, size):
+        """ Moves the snapshot into a new, bigger, file
+
+        :param size: payload size the new file must be able to hold
+        """
+
+        capacity = self.capacity
+        while capacity < size:
+            capacity *= 2
+
+        log.info(f'Growing the shared snapshot {self.path} to {capacity} bytes')
+        tmp_path = f'{self.path}.tmp'
+        # publish() is not in the middle of a write yet, so the sequence is even
+        mm = self._new_file(tmp_path, capacity, self.sequence)
+        os.replace(tmp_path, self.path)
+
+        self._supersede()
+        self.close()
+        self.mm = mm
+        self.capacity = capacity
+        self._futex_word = ctypes.c_uint32.from_buffer(mm, _SEQUENCE_OFFSET) if _futex else None
+
+    def read(self):
+        """ Gets a consistent copy of the payload
+
+        :returns (sequence, timestamp, payload bytes). The payload is None if nothing has been published yet, or if
+        no consistent copy could be made
+        """
+
+        for attempt in range(READ_ATTEMPTS):
+            before = self.sequence
+            if before % 2 == 0:
+                length, timestamp, crc = _PAYLOAD_INFO.unpack_from(self.mm, _PAYLOAD_INFO_OFFSET)
+                # nothing published into this file yet (a new file may start with a non-zero sequence)
+                if before == 0 or not timestamp:
+                    return before, None, None
+
+                payload = self.mm[HEADER_SIZE:HEADER_SIZE + min(length, self.capacity)]
+                if self.sequence == before and zlib.crc32(payload) == crc:
+                    return before, timestamp, payload
+
+            # a write is in progress: give the writer a chance to finish it
+            time.sleep(0 if attempt < 10 else 0.001)
+
+        log.warning(f'Unable to get a consistent copy of the shared snapshot {self.path}')
+        return self.sequence, None, None
+
+    def wait(self, sequence, timeout=None):
+        """ Waits until the sequence counter moves away from the given value, or until the file is superseded
+
+        :param sequence: last sequence the caller has seen
+        :param timeout: seconds. Wait forever if None
+        :returns True if there is something new to read, False on timeout
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            current = self.sequence
+            if current != sequence and current % 2 == 0 or self.superseded:
+                return True
+
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+
+            if self._futex_word is None:
+                time.sleep(_POLL_INTERVAL if remaining is None else min(_POLL_INTERVAL, remaining))
+                continue
+
+            threadpool = _green_threadpool()
+            if threadpool is not None:
+                threadpool.apply(self._futex_wait, (current, remaining))
+            else:
+                self._futex_wait(current, remaining)
+
+    def _futex_wait(self, value, timeout):
+        """ Sleeps until woken up by the writer, unless the sequence counter has already moved away from value
+
+        :param value: sequence counter value seen by the caller
+        :param timeout: seconds. Wait forever if None
+        """
+
+        timespec = None
+        if timeout is not None:
+            timespec = ctypes.byref(_Timespec(int(timeout), int((timeout % 1) * 1e9)))
+
+        syscall, number = _futex
+        if syscall(number, ctypes.byref(self._futex_word), _FUTEX_WAIT, ctypes.c_uint32(value), timespec,
+                   None, 0) != 0:
+            err = ctypes.get_errno()
+            if err not in (errno.EAGAIN, errno.ETIMEDOUT, errno.EINTR):
+                raise OSError(err, os.strerror(err))
+
+
+class SharedSnapshotReader(object):
+    """ Reads a document (JSON, by default) published into a SharedSnapshot by another process.
+
+    The file is (re)opened when needed, and the document is only decoded when a new version has been published.
+    Safe to use from several threads.
+
+    Callers of wait() do not each sleep on the snapshot: a single watcher thread does, and wakes them all up through
+    a condition. Under gevent, the watcher is a greenlet, and the waiters only cost a greenlet each, while the
+    futex wait itself takes one thread of gevent's pool per reader, whatever the number of waiters
+    """
+
+    def __init__(self, path, decode=json.loads):
+        """ Constructs the reader. Nothing is opened until the first read
+
+        :param path: snapshot file path
+        :param decode: function decoding the payload bytes. None to get the bytes as they are
+        """
+
+        self.path = path
+        self.decode = decode
+        self.lock = threading.Lock()
+        # notified by the watcher whenever the snapshot might have changed
+        self.changed = threading.Condition(self.lock)
+        self.waiters = 0
+        self.watcher = None
+        self.snapshot = None
+        self.sequence = None
+        self.timestamp = None
+        self.content = None
+
+    def _get_snapshot(self):
+        """ Maps the snapshot file, reopening it when it has been superseded
+
+        :returns SharedSnapshot, or None if the writer has not created it yet
+        """
+
+        if self.snapshot and not self.snapshot.superseded:
+            return self.snapshot
+
+        if self.snapshot:
+            # not closed explicitly, since other threads might still be waiting on it: it is unmapped once unused.
+            # The sequence carries on in the new file, so the current document stays valid until a newer one
+            self.snapshot = None
+
+        try:
+            self.snapshot = SharedSnapshot.open(self.path)
+        except (OSError, ValueError):
+            self.snapshot = None
+
+        return self.snapshot
+
+    def _get(self):
+        """ Same as get(), with the lock already held """
+
+        snapshot = self._get_snapshot()
+        if not snapshot:
+            return None, None
+
+        if snapshot.sequence == self.sequence:
+            return self.sequence, self.content
+
+        sequence, timestamp, payload = snapshot.read()
+        if payload is None:
+            # keep serving the previous version
+            return self.sequence, self.content
+
+        try:
+            self.content = self.decode(payload) if self.decode else payload
+        except ValueError:
+            log.exception(f'Unable to decode the shared snapshot {self.path}')
+            return self.sequence, self.content
+
+        self.sequence = sequence
+        self.timestamp = timestamp
+        return self.sequence, self.content
+
+    def get(self):
+        """ Gets the latest published document
+
+        :returns (sequence, content). Content is None if nothing has been published yet
+        """
+
+        with self.lock:
+            return self._get()
+
+    def _watch(self):
+        """ Watcher thread: sleeps on the snapshot, and wakes the waiters up whenever its sequence changes,
+        until there are no more waiters """
+
+        notified = None
+        while True:
+            with self.lock:
+                if not self.waiters:
+                    self.watcher = None
+                    return
+
+                snapshot = self._get_snapshot()
+                seen = snapshot.sequence if snapshot else None
+                if seen != notified:
+                    # also covers the publications made before this watch started
+                    self.changed.notify_all()
+                    notified = seen
+
+            if not snapshot:
+                # the writer has not started yet
+                time.sleep(_POLL_INTERVAL * 10)
+            else:
+                snapshot.wait(seen, _WATCHER_IDLE_TIMEOUT)
+
+    def wait(self, sequence, timeout=None):
+        """ Waits for a document newer than the given sequence to be published
+
+        :param sequence: sequence of the last document the caller got, from get()
+        :param timeout: seconds. Wait forever if None
+        :returns (sequence, content), as get()
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while True:
+                current, content = self._get()
+                if current != sequence and content is not None:
+                    return current, content
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return current, content
+
+                if self.watcher is None or not self.watcher.is_alive():
+                    self.watcher = threading.Thread(target=self._watch, name='snapshot-watcher', daemon=True)
+                    self.watcher.start()
+
+                self.waiters += 1
+                try:
+                    self.changed.wait(remaining)
+                finally:
+                    self.waiters -= 1
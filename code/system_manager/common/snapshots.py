@@ -0,0 +1,167 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Cached snapshots of expensive Docker API calls """
+
+import concurrent.futures
+import json
+import threading
+import time
+from system_manager.common.logging import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class SnapshotCache(object):
+    """ Caches the results of expensive calls, by key, for a given time to live.
+
+    When a snapshot gets older than its TTL, the cached value is still returned right away, while a single refresh
+    is started in the background. Callers only wait when there is no value yet, or when the value is older than its
+    maximum age. Concurrent requests for the same key always share a single call
+    """
+
+    def __init__(self, max_workers=2):
+        """ Constructs an empty cache
+
+        :param max_workers: maximum number of refreshes running at the same time
+        """
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='snapshots')
+        self.lock = threading.Lock()
+        # key -> (value, time it was fetched)
+        self.values = {}
+        # key -> Future of the call in progress
+        self.in_flight = {}
+
+    def _refresh(self, key, loader):
+        """ Starts a call for a key, unless one is already in progress
+
+        :param key: snapshot key
+        :param loader: function, without arguments, that gets the value
+        :returns Future
+        """
+
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is None:
+                future = self.executor.submit(self._load, key, loader)
+                self.in_flight[key] = future
+
+        return future
+
+    def _load(self, key, loader):
+        """ Gets and caches a value
+
+        :param key: snapshot key
+        :param loader: function, without arguments, that gets the value
+        :returns the value
+        """
+
+        try:
+            value = loader()
+            with self.lock:
+                self.values[key] = (value, time.time())
+            return value
+        except Exception as e:
+            log.warning(f'Unable to refresh the {key} snapshot: {str(e)}')
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+
+    def get(self, key, loader, ttl, max_age=None, timeout=None):
+        """ Gets a snapshot
+
+        :param key: snapshot key
+        :param loader: function, without arguments, that gets the value
+        :param ttl: how long, in seconds, the value is fresh
+        :param max_age: how old, in seconds, a value can be returned while being refreshed. Defaults to 10 TTLs
+        :param timeout: how long to wait, in seconds, when there is no usable value
+        :returns the value
+        :raises whatever the loader raises, if there is no usable value
+        """
+
+        max_age = ttl * 10 if max_age is None else max_age
+        with self.lock:
+            cached = self.values.get(key)
+
+        if cached:
+            value, fetched = cached
+            age = time.time() - fetched
+            if age < ttl:
+                return value
+
+            future = self._refresh(key, loader)
+            if age < max_age:
+                return value
+        else:
+            future = self._refresh(key, loader)
+
+        return future.result(timeout=timeout)
+
+    def invalidate(self, key=None):
+        """ Forgets a snapshot, or all of them
+
+        :param key: snapshot key. If not set, all snapshots are forgotten
+        """
+
+        with self.lock:
+            if key is None:
+                self.values.clear()
+            else:
+                self.values.pop(key, None)
+
+
+class DockerSnapshots(object):
+    """ Cached Docker info(), df() and containers.list() """
+
+    def __init__(self, docker_client, info_ttl=30, df_ttl=300, containers_ttl=3, cache=None):
+        """ Constructs the snapshots. Nothing is fetched until first requested
+
+        :param docker_client: Docker client
+        :param info_ttl: how long, in seconds, docker info is fresh
+        :param df_ttl: how long, in seconds, docker system df is fresh
+        :param containers_ttl: how long, in seconds, the list of containers is fresh
+        :param cache: SnapshotCache. A new one by default
+        """
+
+        self.docker_client = docker_client
+        self.info_ttl = info_ttl
+        self.df_ttl = df_ttl
+        self.containers_ttl = containers_ttl
+        self.cache = cache or SnapshotCache()
+
+    def info(self):
+        """ Docker info
+
+        :returns dict
+        """
+
+        return self.cache.get('info', self.docker_client.info, self.info_ttl)
+
+    def df(self):
+        """ Docker system df. This is expensive on hosts with many images and volumes, so it is never waited for
+        again once it has been fetched
+
+        :returns dict
+        """
+
+        return self.cache.get('df', self.docker_client.df, self.df_ttl, max_age=float('inf'))
+
+    def containers(self, all=False, filters=None):
+        """ List of containers
+
+        :param all: include the containers which are not running
+        :param filters: Docker filters, e.g. {"label": "nuvlabox.component=True"}
+        :returns list of container objects
+        """
+
+        key = ('containers', all, json.dumps(filters, sort_keys=True))
+        return self.cache.get(key, lambda: self.docker_client.containers.list(all=all, filters=filters),
+                              self.containers_ttl)
+
+    def invalidate(self):
+        """ Forgets all snapshots, e.g. after a change was made through the Docker API """
+
+        self.cache.invalidate()
@@ -0,0 +1,201 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Structured, in-process store for the Docker stats collected by the supervisor """
+
+import json
+import threading
+import time
+from datetime import datetime
+from system_manager.common.logging import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class ContainerStats(object):
+    """ Resource usages of a single container, at a given sampling pass
+
+    Usages are kept rounded to 2 decimals, as they are displayed, so that two passes with the same
+    visible numbers compare as equal
+    """
+
+    __slots__ = ('id', 'name', 'cpu_percent', 'mem_usage', 'mem_limit', 'mem_percent',
+                 'net_in', 'net_out', 'blk_in', 'blk_out', 'status', 'restart_count')
+
+    # numeric usages, as kept in the metrics history
+    metrics_fields = ('cpu_percent', 'mem_usage', 'mem_limit', 'mem_percent', 'net_in', 'net_out', 'blk_in', 'blk_out')
+
+    def __init__(self, id: str, name: str, cpu_percent: float = 0.0, mem_usage: float = 0.0, mem_limit: float = 0.0,
+                 mem_percent: float = 0.0, net_in: float = 0.0, net_out: float = 0.0, blk_in: float = 0.0,
+                 blk_out: float = 0.0, status: str = "unknown", restart_count: int = 0):
+        """ Constructs a ContainerStats record
+
+        :param id: container ID
+        :param name: container name
+        :param cpu_percent: CPU usage, in %
+        :param mem_usage: memory usage, in MiB
+        :param mem_limit: memory limit, in MiB
+        :param mem_percent: memory usage, in %
+        :param net_in: network bytes received, in MB
+        :param net_out: network bytes transmitted, in MB
+        :param blk_in: block bytes read, in MB
+        :param blk_out: block bytes written, in MB
+        :param status: container status
+        :param restart_count: number of times the container has been restarted
+        """
+
+        self.id = id
+        self.name = name
+        self.cpu_percent = round(float(cpu_percent), 2)
+        self.mem_usage = round(float(mem_usage), 2)
+        self.mem_limit = round(float(mem_limit), 2)
+        self.mem_percent = round(float(mem_percent), 2)
+        self.net_in = round(float(net_in), 2)
+        self.net_out = round(float(net_out), 2)
+        self.blk_in = round(float(blk_in), 2)
+        self.blk_out = round(float(blk_out), 2)
+        self.status = status
+        self.restart_count = int(restart_count)
+
+    def __eq__(self, other):
+        if not isinstance(other, ContainerStats):
+            return NotImplemented
+
+        return all(getattr(self, attr) == getattr(other, attr) for attr in self.__slots__)
+
+    def __repr__(self):
+        return f'ContainerStats({self.name}, cpu={self.cpu_percent}%, mem={self.mem_percent}%)'
+
+    def metrics(self):
+        """ Numeric usages, in the same order as metrics_fields
+
+        :returns list
+        """
+
+        return [getattr(self, attr) for attr in self.metrics_fields]
+
+    def to_dict(self):
+        """ Serializes the record, using the same key style as the NuvlaBox status
+
+        :returns dict
+        """
+
+        return {attr.replace('_', '-'): getattr(self, attr) for attr in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, content):
+        """ Builds a record from its serialized form (see to_dict)
+
+        :param content: dict
+        :returns ContainerStats
+        """
+
+        return cls(**{attr: content[attr.replace('_', '-')]
+                      for attr in cls.__slots__ if attr.replace('_', '-') in content})
+
+
+class StatsStore(object):
+    """ Keeps the latest Docker stats samples, per container, as ContainerStats records.
+
+    The supervisor updates the store and publishes it, when it changes, as a JSON snapshot in shared memory, while
+    the dashboard keeps its own store which is only reloaded when a new snapshot is published
+    """
+
+    def __init__(self):
+        """ Constructs an empty store """
+
+        self.lock = threading.Lock()
+        self.containers = []
+        self.last_update = None
+        self.pass_duration = None
+        self.generation = 0
+        # sequence of the shared snapshot the store was last reloaded from
+        self._sequence = None
+
+    def update(self, containers, pass_duration=None):
+        """ Replaces the current samples with the ones from a new sampling pass
+
+        :param containers: list of ContainerStats, in display order
+        :param pass_duration: how long the sampling pass took, in seconds
+        :returns True if the samples changed since the previous pass
+        """
+
+        with self.lock:
+            self.last_update = time.time()
+            self.pass_duration = pass_duration
+            if containers == self.containers:
+                return False
+
+            self.containers = list(containers)
+            self.generation += 1
+            return True
+
+    def get(self, container_id):
+        """ Gets the latest sample for a container
+
+        :param container_id: full container ID
+        :returns ContainerStats or None
+        """
+
+        for container in self.containers:
+            if container.id == container_id:
+                return container
+
+        return None
+
+    @property
+    def last_update_utc(self):
+        """ Time of the last update, as a UTC datetime """
+
+        return datetime.utcfromtimestamp(self.last_update) if self.last_update else None
+
+    def snapshot(self):
+        """ JSON serializable view of the store
+
+        :returns dict
+        """
+
+        with self.lock:
+            return {
+                "generation": self.generation,
+                "last-update": self.last_update,
+                "pass-duration": self.pass_duration,
+                "containers": [c.to_dict() for c in self.containers]
+            }
+
+    def load(self, content):
+        """ Replaces the store content with a JSON snapshot (see snapshot)
+
+        :param content: dict
+        """
+
+        with self.lock:
+            self.containers = [ContainerStats.from_dict(c) for c in content.get("containers", [])]
+            self.last_update = content.get("last-update")
+            self.pass_duration = content.get("pass-duration")
+            self.generation = content.get("generation", self.generation + 1)
+
+    def publish(self, shared_snapshot):
+        """ Publishes the JSON snapshot of the store to the other processes
+
+        :param shared_snapshot: SharedSnapshot, open for writing
+        """
+
+        shared_snapshot.publish(json.dumps(self.snapshot()).encode(), self.last_update)
+
+    def refresh(self, reader):
+        """ Reloads the store from the snapshot published by another process, but only if a new one has been
+        published since the last reload
+
+        :param reader: SharedSnapshotReader
+        :returns True if the store was reloaded
+        """
+
+        sequence, content = reader.get()
+        if content is None or sequence == self._sequence:
+            return False
+
+        self.load(content)
+        self._sequence = sequence
+        return True
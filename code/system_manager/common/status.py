@@ -0,0 +1,220 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" NuvlaBox status, as written by the NuvlaBox Agent, and the dashboard view derived from it
+
+The status file is only parsed again when its inode, modification time or size changes. Since the Agent rewrites it
+in place, a read can catch it half written: such content is rejected, and the last valid status is kept until the
+file changes again
+"""
+
+import hashlib
+import json
+import os
+import threading
+from system_manager.common.lazy import lazy_property
+from system_manager.common.logging import logging
+
+
+log = logging.getLogger(__name__)
+
+# status attributes which, when present, must be numbers (or numeric strings)
+NUMERIC_FIELDS = ('cpus', 'memory', 'disk', 'cpu-usage', 'memory-usage', 'disk-usage')
+
+
+def validate_status(content):
+    """ Checks that a decoded status has the expected shape
+
+    :param content: decoded JSON
+    :raises ValueError if the status is not valid
+    """
+
+    if not isinstance(content, dict):
+        raise ValueError(f'expected a JSON object, got {type(content).__name__}')
+
+    for field in NUMERIC_FIELDS:
+        if content.get(field) is not None:
+            try:
+                float(content[field])
+            except (TypeError, ValueError):
+                raise ValueError(f'{field} is not a number: {content[field]!r}')
+
+    resources = content.get("resources") or {}
+    if not isinstance(resources, dict):
+        raise ValueError('resources is not an object')
+
+    net_stats = resources.get("net-stats") or []
+    if not isinstance(net_stats, list):
+        raise ValueError('resources.net-stats is not a list')
+
+    for nstat in net_stats:
+        if not isinstance(nstat, dict):
+            raise ValueError('resources.net-stats has an entry which is not an object')
+
+        for counter in ('bytes-received', 'bytes-transmitted'):
+            try:
+                float(nstat.get(counter, 0))
+            except (TypeError, ValueError):
+                raise ValueError(f'{counter} is not a number: {nstat[counter]!r}')
+
+
+class NuvlaBoxStatus(object):
+    """ A valid NuvlaBox status, and its dashboard view, which is only built when first needed """
+
+    def __init__(self, content, raw=None):
+        """ Constructs the status
+
+        :param content: validated status, as a dict
+        :param raw: the JSON it was decoded from, as bytes
+        """
+
+        self.content = content
+        self.raw = raw
+
+    @classmethod
+    def loads(cls, raw):
+        """ Decodes and validates a status
+
+        :param raw: JSON, as bytes
+        :returns NuvlaBoxStatus
+        :raises ValueError if the JSON cannot be decoded or the status is not valid
+        """
+
+        content = json.loads(raw)
+        validate_status(content)
+        return cls(content, raw)
+
+    def __bool__(self):
+        return bool(self.content)
+
+    @lazy_property
+    def version(self):
+        """ Digest of the status, which identifies it, e.g. in ETags """
+
+        raw = self.raw if self.raw is not None else json.dumps(self.content, sort_keys=True).encode()
+        return hashlib.sha1(raw).hexdigest()[:16]
+
+    @lazy_property
+    def net_stats(self):
+        """ Network counters, as a Chart.js bar chart dataset
+
+        net-stats is provided in the form of [{"interface": "iface1", "bytes-received": X,
+        "bytes-transmitted": Y}, ...]. Reference: nuvlabox/agent
+        """
+
+        labels = []
+        rx = []
+        tx = []
+        for nstat in (self.content.get("resources") or {}).get("net-stats") or []:
+            iface = nstat.get('interface')
+            if not iface:
+                continue
+
+            labels.append(iface)
+            rx.append(float(nstat.get('bytes-received', 0)))
+            tx.append(float(nstat.get('bytes-transmitted', 0)))
+
+        return {
+            "labels": labels,
+            "datasets": [{
+                "label": "rx_bytes",
+                "backgroundColor": "#d88d0e",
+                "borderColor": "#d88d0e",
+                "borderWidth": 1,
+                "data": rx
+            }, {
+                "label": "tx_bytes",
+                "backgroundColor": "#61acb5",
+                "borderColor": "#61acb5",
+                "borderWidth": 1,
+                "data": tx
+            }]
+        }
+
+    @lazy_property
+    def dashboard_view(self):
+        """ Template variables of the dashboard which come from the status, with the totals already formatted """
+
+        status = self.content
+        memory = status.get("memory")
+        disk = status.get("disk")
+        return {
+            "cpus_total": status.get("cpus"),
+            "memory_total": "%.2f GB" % (float(memory) / 1024) if memory is not None else "unknown",
+            "disk_total": "%s GB" % disk if disk is not None else "unknown",
+            "cpu_usage": status.get("cpu-usage"),
+            "memory_usage": status.get("memory-usage"),
+            "disk_usage": status.get("disk-usage"),
+            "os": status.get("operating-system"),
+            "arch": status.get("architecture"),
+            "ip": status.get("ip"),
+            "docker_version": status.get("docker-server-version"),
+            "hostname": status.get("hostname"),
+            "last_boot": status.get("last-boot", "unknown"),
+            "net_stats": self.net_stats
+        }
+
+
+# no status yet
+EMPTY_STATUS = NuvlaBoxStatus({}, b'{}')
+
+
+class NuvlaBoxStatusFile(object):
+    """ Reads the status file written by the NuvlaBox Agent, only parsing it again when it changes.
+    Safe to use from several threads
+    """
+
+    def __init__(self, path):
+        """ Constructs the reader. Nothing is read until the first get()
+
+        :param path: status file path
+        """
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.status = EMPTY_STATUS
+        # (inode, mtime, size) of the file the current status was read from
+        self.signature = None
+        # signature of the last content rejected as invalid, so that it is not read again
+        self.rejected = None
+
+    @staticmethod
+    def _signature(st):
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def get(self):
+        """ Gets the latest valid status
+
+        :returns NuvlaBoxStatus. The same object is returned for as long as the file does not change
+        """
+
+        with self.lock:
+            try:
+                signature = self._signature(os.stat(self.path))
+            except FileNotFoundError:
+                log.warning("NuvlaBox status metrics file not found locally...wait for Agent to create it")
+                self.status = EMPTY_STATUS
+                self.signature = self.rejected = None
+                return self.status
+
+            if signature in (self.signature, self.rejected):
+                return self.status
+
+            try:
+                with open(self.path, 'rb') as nbsf:
+                    raw = nbsf.read()
+                    signature_after = self._signature(os.fstat(nbsf.fileno()))
+                status = NuvlaBoxStatus.loads(raw)
+            except FileNotFoundError:
+                # replaced in the meantime: read it again next time
+                return self.status
+            except (OSError, ValueError) as e:
+                log.warning(f'Ignoring the NuvlaBox status, which is probably being written by the Agent: {str(e)}')
+                self.rejected = signature
+                return self.status
+
+            self.status = status
+            # when the file changed while being read, it will be read again next time
+            self.signature = signature if signature == signature_after else None
+            self.rejected = None
+            return self.status
@@ -0,0 +1,479 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" Fixed-memory time-series storage for the metrics collected by the supervisor
+
+A RingBuffer is a pre-allocated, memory-mapped file holding, for up to max_series series (e.g. one per container),
+a fixed number of time slots of a given resolution. Its size is entirely determined at creation time, and it
+never grows. The supervisor writes into it, while the dashboard maps the same file read-only and serves range
+queries from it. A generation counter, odd while a write is in progress, lets readers detect and retry torn reads.
+
+File layout (all offsets are multiples of 8 bytes):
+
+    header        8 doubles: magic, version, generation, capacity, resolution, max_series, n_fields, reserved
+    fields        FIELDS_SIZE bytes: comma separated field names
+    keys          max_series * KEY_SIZE bytes: series keys, NULL padded
+    last write    max_series doubles: last time each series was written to
+    slots         capacity doubles: timestamp of each slot
+    data          max_series * capacity * n_fields doubles, series-major
+"""
+
+import math
+import mmap
+import os
+import threading
+import time
+from array import array
+from system_manager.common.logging import logging
+
+
+log = logging.getLogger(__name__)
+
+MAGIC = 0x4e42544d  # "NBTM"
+VERSION = 1
+HEADER_SIZE = 8 * 8
+FIELDS_SIZE = 512
+KEY_SIZE = 64
+
+_GENERATION = 2
+
+
+class RingBuffer(object):
+    """ Fixed-size, memory-mapped, multi-series time-series ring buffer """
+
+    def __init__(self, path, mm, writable):
+        """ Maps the buffer structure on top of an already opened mmap. Use create() or open() instead
+
+        :param path: file path
+        :param mm: mmap object
+        :param writable: whether this instance is allowed to write
+        """
+
+        self.path = path
+        self.mm = mm
+        self.writable = writable
+        self.view = memoryview(mm)
+        st = os.stat(path)
+        self._file_signature = (st.st_ino, st.st_size)
+
+        self.header = self.view[0:HEADER_SIZE].cast('d')
+        if int(self.header[0]) != MAGIC or int(self.header[1]) != VERSION:
+            raise ValueError(f'{path} is not a valid metrics ring buffer')
+
+        self.capacity = int(self.header[3])
+        self.resolution = self.header[4]
+        self.max_series = int(self.header[5])
+        self.n_fields = int(self.header[6])
+        self.fields = bytes(self.view[HEADER_SIZE:HEADER_SIZE + FIELDS_SIZE]).rstrip(b'\0').decode().split(',')
+
+        offset = HEADER_SIZE + FIELDS_SIZE
+        self._keys = self.view[offset:offset + self.max_series * KEY_SIZE]
+        offset += self.max_series * KEY_SIZE
+        self._last_write = self.view[offset:offset + self.max_series * 8].cast('d')
+        offset += self.max_series * 8
+        self._slots = self.view[offset:offset + self.capacity * 8].cast('d')
+        offset += self.capacity * 8
+        self._data = self.view[offset:offset + self.max_series * self.capacity * self.n_fields * 8].cast('d')
+
+        self._key_index = {}
+        if writable:
+            # a previous writer might have died in the middle of a write
+            if int(self.header[_GENERATION]) % 2:
+                self.header[_GENERATION] += 1
+            self._key_index = self._read_keys()
+
+    @staticmethod
+    def size_for(n_fields, capacity, max_series):
+        """ Number of bytes needed for a ring buffer with the given shape """
+
+        return HEADER_SIZE + FIELDS_SIZE + max_series * KEY_SIZE + max_series * 8 + capacity * 8 \
+            + max_series * capacity * n_fields * 8
+
+    @classmethod
+    def create(cls, path, fields, resolution, retention, max_series, preallocate=False):
+        """ Creates (or re-uses, if it already exists with the same shape) a ring buffer file, for writing
+
+        :param path: file path
+        :param fields: list of field names, for each series
+        :param resolution: time slot size, in seconds
+        :param retention: how far back, in seconds, the buffer goes
+        :param max_series: maximum number of series kept at the same time
+        :param preallocate: whether to reserve all the file blocks on disk upfront, and sync the new file
+        :returns RingBuffer
+        """
+
+        capacity = max(int(retention // resolution), 1)
+        encoded_fields = ','.join(fields).encode()
+        if len(encoded_fields) > FIELDS_SIZE:
+            raise ValueError(f'Too many fields for a metrics ring buffer: {fields}')
+
+        size = cls.size_for(len(fields), capacity, max_series)
+        try:
+            existing = cls.open(path, writable=True)
+        except (OSError, ValueError):
+            existing = None
+
+        if existing:
+            if existing.fields == list(fields) and existing.capacity == capacity \
+                    and existing.resolution == resolution and existing.max_series == max_series:
+                return existing
+            existing.close()
+
+        # build the new file aside, so that readers still mapping the old one are not affected
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w+b') as f:
+            f.truncate(size)
+            if preallocate:
+                os.posix_fallocate(f.fileno(), 0, size)
+            mm = mmap.mmap(f.fileno(), size)
+
+        header = memoryview(mm)[0:HEADER_SIZE].cast('d')
+        header[0:8] = array('d', [MAGIC, VERSION, 0, capacity, resolution, max_series, len(fields), 0])
+        header.release()
+        mm[HEADER_SIZE:HEADER_SIZE + len(encoded_fields)] = encoded_fields
+
+        rb = cls(tmp_path, mm, True)
+        rb._data[:] = array('d', [math.nan]) * len(rb._data)
+        if preallocate:
+            rb.flush()
+
+        os.replace(tmp_path, path)
+        rb.path = path
+        log.info(f'Created metrics ring buffer {path}: {len(fields)} fields x {capacity} slots of {resolution}s '
+                 f'x {max_series} series ({round(size / 1024 / 1024, 2)} MiB)')
+        return rb
+
+    @classmethod
+    def open(cls, path, writable=False):
+        """ Maps an existing ring buffer file
+
+        :param path: file path
+        :param writable: whether to map it for writing
+        :returns RingBuffer
+        """
+
+        with open(path, 'r+b' if writable else 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+
+        try:
+            return cls(path, mm, writable)
+        except ValueError:
+            mm.close()
+            raise
+
+    @property
+    def nbytes(self):
+        """ Size of the buffer, in bytes """
+
+        return len(self.mm)
+
+    @property
+    def retention(self):
+        """ How far back, in seconds, the buffer goes """
+
+        return self.capacity * self.resolution
+
+    def flush(self):
+        """ Syncs the changes made through the mapping back to the file """
+
+        self.mm.flush()
+
+    def close(self):
+        """ Unmaps the file """
+
+        for view in (self.header, self._keys, self._last_write, self._slots, self._data, self.view):
+            view.release()
+        self.mm.close()
+
+    def is_stale(self):
+        """ Whether the file has been replaced or removed since it was mapped (readers should then reopen it) """
+
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return True
+
+        return (st.st_ino, st.st_size) != self._file_signature
+
+    def _read_keys(self):
+        """ Maps each series key to its index
+
+        :returns dict
+        """
+
+        keys = {}
+        for i in range(self.max_series):
+            key = bytes(self._keys[i * KEY_SIZE:(i + 1) * KEY_SIZE]).rstrip(b'\0')
+            if key:
+                keys[key.decode(errors='replace')] = i
+
+        return keys
+
+    def _series_index(self, key, now):
+        """ Finds the index of a series, or assigns one to it if it is new. When the buffer is full, the
+        series that has not been written to for the longest time is evicted
+
+        :param key: series key
+        :param now: current timestamp
+        :returns index
+        """
+
+        if key in self._key_index:
+            return self._key_index[key]
+
+        used = set(self._key_index.values())
+        free = [i for i in range(self.max_series) if i not in used]
+        if free:
+            index = free[0]
+        else:
+            index = min(used, key=lambda i: self._last_write[i])
+            evicted = [k for k, i in self._key_index.items() if i == index][0]
+            log.debug(f'Metrics ring buffer {self.path} is full. Evicting series {evicted} for {key}')
+            self._key_index.pop(evicted)
+
+        encoded = key.encode()[:KEY_SIZE]
+        self._keys[index * KEY_SIZE:(index + 1) * KEY_SIZE] = encoded.ljust(KEY_SIZE, b'\0')
+        block = self.capacity * self.n_fields
+        self._data[index * block:(index + 1) * block] = array('d', [math.nan]) * block
+        self._last_write[index] = now
+        self._key_index[key] = index
+        return index
+
+    def append(self, timestamp, values):
+        """ Writes one sample per series into the time slot corresponding to the timestamp
+
+        Writing twice into the same slot overwrites the previous values
+
+        :param timestamp: sample time, in seconds since the epoch
+        :param values: dict of series key -> list of values, in the same order as self.fields
+        """
+
+        if not self.writable:
+            raise PermissionError(f'Metrics ring buffer {self.path} is opened read-only')
+
+        slot_time = (timestamp // self.resolution) * self.resolution
+        slot = int(timestamp // self.resolution) % self.capacity
+
+        self.header[_GENERATION] += 1
+        try:
+            if self._slots[slot] != slot_time:
+                # the slot is being recycled, so wipe what is left from the previous round
+                nan_row = array('d', [math.nan]) * self.n_fields
+                for i in range(self.max_series):
+                    start = (i * self.capacity + slot) * self.n_fields
+                    self._data[start:start + self.n_fields] = nan_row
+                self._slots[slot] = slot_time
+
+            for key, series_values in values.items():
+                index = self._series_index(key, timestamp)
+                row = array('d', (math.nan if v is None else float(v) for v in series_values[:self.n_fields]))
+                if len(row) < self.n_fields:
+                    row.extend([math.nan] * (self.n_fields - len(row)))
+
+                start = (index * self.capacity + slot) * self.n_fields
+                self._data[start:start + self.n_fields] = row
+                self._last_write[index] = timestamp
+        finally:
+            self.header[_GENERATION] += 1
+
+    def _consistent_read(self, reader, retries=20):
+        """ Runs a read function until it is not interleaved with a write
+
+        :param reader: function to run
+        :param retries: how many times to try
+        :returns whatever reader returns
+        """
+
+        result = None
+        for _ in range(retries):
+            generation = self.header[_GENERATION]
+            if int(generation) % 2:
+                time.sleep(0.001)
+                continue
+
+            result = reader()
+            if self.header[_GENERATION] == generation:
+                return result
+
+        log.debug(f'Could not get a consistent read from {self.path}. Returning the last attempt')
+        return reader() if result is None else result
+
+    def keys(self):
+        """ Keys of the series currently in the buffer """
+
+        return list(self._consistent_read(self._read_keys))
+
+    def query(self, start=None, end=None, keys=None):
+        """ Gets the samples within a time range
+
+        :param start: range start, in seconds since the epoch. Defaults to the oldest sample
+        :param end: range end, in seconds since the epoch. Defaults to now
+        :param keys: list of series keys to get. Defaults to all series
+        :returns dict of series key -> list of [timestamp, value1, value2, ...], sorted by time. Missing
+        values are None
+        """
+
+        start = float('-inf') if start is None else float(start)
+        end = float('inf') if end is None else float(end)
+
+        def read():
+            key_index = self._read_keys()
+            slots = [(ts, i) for i, ts in enumerate(self._slots.tolist()) if ts and start <= ts <= end]
+            slots.sort()
+
+            result = {}
+            block = self.capacity * self.n_fields
+            for key, index in key_index.items():
+                if keys is not None and key not in keys:
+                    continue
+
+                series = self._data[index * block:(index + 1) * block].tolist()
+                rows = []
+                for ts, slot in slots:
+                    row = series[slot * self.n_fields:(slot + 1) * self.n_fields]
+                    if all(math.isnan(v) for v in row):
+                        continue
+                    rows.append([ts] + [None if math.isnan(v) else v for v in row])
+
+                result[key] = rows
+
+            return result
+
+        return self._consistent_read(read)
+
+
+class MetricsArchive(object):
+    """ Downsampled, on-disk history of a metrics stream, surviving restarts
+
+    Samples are rolled up into the first (finest) archive level, whose closed buckets are in turn rolled up into
+    the next level, and so on (e.g. samples -> 1m -> 1h). Each level is a pre-allocated RingBuffer file, so the
+    archive never grows. Closed buckets are kept in memory and only written, and synced, to disk every
+    flush_interval seconds, to limit the number of writes on SD cards.
+
+    Gauges are averaged over each bucket, while counters (cumulative values) keep the last value
+    """
+
+    def __init__(self, folder, name, fields, max_series, levels, flush_interval=600, counter_fields=()):
+        """ Creates, or re-opens, the archive files
+
+        :param folder: where to keep the archive files
+        :param name: archive name, used as prefix for the files
+        :param fields: list of field names, for each series
+        :param max_series: maximum number of series kept at the same time
+        :param levels: list of (resolution, retention) tuples, in seconds, from the finest to the coarsest
+        :param flush_interval: how often, in seconds, to write the closed buckets to disk
+        :param counter_fields: fields holding cumulative values
+        """
+
+        os.makedirs(folder, exist_ok=True)
+        self.fields = list(fields)
+        self.levels = [RingBuffer.create(self.level_path(folder, name, resolution), fields, resolution, retention,
+                                         max_series, preallocate=True)
+                       for resolution, retention in levels]
+        self.flush_interval = flush_interval
+        self._counters = [f in counter_fields for f in self.fields]
+        # per level, open buckets as {key: [bucket time, sums, counts, last values]}
+        self._buckets = [{} for _ in self.levels]
+        # per level, closed buckets waiting to be written, as {bucket time: {key: values}}
+        self._pending = [{} for _ in self.levels]
+        self._last_flush = time.time()
+        # samples are added by the supervisor tasks, while the final flush comes from the shutdown
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def level_path(folder, name, resolution):
+        """ Path of the file for an archive level """
+
+        return f'{folder}/{name}-{int(resolution)}s.ring'
+
+    def _accumulate(self, level, timestamp, values):
+        """ Adds samples to the open buckets of a level, closing (and cascading to the next level)
+        the buckets that are over
+
+        :param level: level index
+        :param timestamp: sample time, in seconds since the epoch
+        :param values: dict of series key -> list of values
+        """
+
+        resolution = self.levels[level].resolution
+        bucket_time = (timestamp // resolution) * resolution
+        buckets = self._buckets[level]
+        closed = {}
+        for key, series_values in values.items():
+            bucket = buckets.get(key)
+            if bucket and bucket[0] != bucket_time:
+                closed[key] = self._close_bucket(bucket)
+                bucket = None
+
+            if not bucket:
+                n = len(self.fields)
+                bucket = buckets[key] = [bucket_time, [0.0] * n, [0] * n, [None] * n]
+
+            for i, v in enumerate(series_values[:len(self.fields)]):
+                if v is None or math.isnan(v):
+                    continue
+                bucket[1][i] += v
+                bucket[2][i] += 1
+                bucket[3][i] = v
+
+        # series that stopped reporting also get their buckets closed
+        for key in [k for k, b in buckets.items() if k not in values and b[0] != bucket_time]:
+            closed[key] = self._close_bucket(buckets.pop(key))
+
+        for key, (closed_time, closed_values) in closed.items():
+            self._pending[level].setdefault(closed_time, {})[key] = closed_values
+            if level + 1 < len(self.levels):
+                self._accumulate(level + 1, closed_time, {key: closed_values})
+
+    def _close_bucket(self, bucket):
+        """ Computes the rolled up values of a bucket
+
+        :param bucket: [bucket time, sums, counts, last values]
+        :returns (bucket time, list of values)
+        """
+
+        bucket_time, sums, counts, last = bucket
+        rolled_up = [last[i] if self._counters[i] else (sums[i] / counts[i] if counts[i] else None)
+                     for i in range(len(self.fields))]
+        return bucket_time, rolled_up
+
+    def add(self, timestamp, values):
+        """ Adds a new sample for each series, and writes the closed buckets to disk if it is time to
+
+        :param timestamp: sample time, in seconds since the epoch
+        :param values: dict of series key -> list of values, in the same order as self.fields
+        """
+
+        with self.lock:
+            self._accumulate(0, timestamp, values)
+            if time.time() - self._last_flush >= self.flush_interval:
+                self.flush()
+
+    def flush(self, close_buckets=False):
+        """ Writes all the closed buckets to the archive files, in one batch per level, and syncs them
+
+        :param close_buckets: whether to also close, and write, the buckets which are still open, e.g. on shutdown.
+        Their partial rollups are overwritten if samples for the same buckets come after a restart
+        """
+
+        with self.lock:
+            if close_buckets:
+                for level, buckets in enumerate(self._buckets):
+                    for key, bucket in buckets.items():
+                        closed_time, closed_values = self._close_bucket(bucket)
+                        self._pending[level].setdefault(closed_time, {})[key] = closed_values
+                        if level + 1 < len(self.levels):
+                            self._accumulate(level + 1, closed_time, {key: closed_values})
+                    buckets.clear()
+
+            for level, ring_buffer in enumerate(self.levels):
+                pending = self._pending[level]
+                if not pending:
+                    continue
+
+                for bucket_time in sorted(pending):
+                    ring_buffer.append(bucket_time, pending[bucket_time])
+                ring_buffer.flush()
+                pending.clear()
+
+            self._last_flush = time.time()
@@ -4,7 +4,10 @@
 """ Common set of managament methods to be used by
  the different system manager classes """
 
-import docker
+import concurrent.futures
+import os
+import threading
+import time
 from system_manager.common.logging import logging
 
 data_volume = "/srv/nuvlabox/shared"
@@ -14,42 +17,249 @@ cert_file = f"{data_volume}/cert.pem"
 key_file = f"{data_volume}/key.pem"
 nuvlabox_peripherals_folder = "{}/.peripherals".format(data_volume)
 operational_status_file = f'{data_volume}/.status'
+# report of the last requirements check
+requirements_report_file = f'{data_volume}/.requirements.json'
 base_label = "nuvlabox.component=True"
 
-docker_stats_html_file = "docker_stats.html"
+# in-memory folder for the files exchanged between the supervisor and the dashboard
+runtime_folder = os.getenv('RUNTIME_FOLDER', '/dev/shm')
+# the Docker stats and the NuvlaBox status are published by the supervisor as shared snapshots (see common/shm.py)
+docker_stats_snapshot_file = f"{runtime_folder}/docker_stats.shm"
+nuvlabox_status_snapshot_file = f"{runtime_folder}/nuvlabox_status.shm"
+# the OpenMetrics exposition served on /metrics is rendered by the supervisor every metrics_export_interval seconds
+openmetrics_snapshot_file = f"{runtime_folder}/openmetrics.shm"
+metrics_export_interval = float(os.getenv('METRICS_EXPORT_INTERVAL', 5))
+container_metrics_file = f"{runtime_folder}/container_metrics.ring"
+host_metrics_file = f"{runtime_folder}/host_metrics.ring"
+docker_api_metrics_file = f"{runtime_folder}/docker_api_metrics.json"
+# the metrics history is kept in fixed-size ring buffers, sized from their resolution and retention
+# (in seconds) and from the maximum number of containers to follow
+metrics_resolution = float(os.getenv('METRICS_RESOLUTION', 5))
+metrics_retention = int(os.getenv('METRICS_RETENTION', 3600))
+metrics_max_containers = int(os.getenv('METRICS_MAX_CONTAINERS', 64))
+# the metrics are also rolled up into a downsampled, on-disk archive, with one (resolution, retention) per level,
+# which is only written to disk every metrics_archive_flush_interval seconds
+metrics_archive_folder = os.getenv('METRICS_ARCHIVE_FOLDER', f"{data_volume}/.metrics")
+metrics_archive_levels = ((60, int(os.getenv('METRICS_ARCHIVE_MINUTELY_RETENTION', 3 * 24 * 3600))),
+                          (3600, int(os.getenv('METRICS_ARCHIVE_HOURLY_RETENTION', 30 * 24 * 3600))))
+metrics_archive_flush_interval = int(os.getenv('METRICS_ARCHIVE_FLUSH_INTERVAL', 600))
+# size of the worker pool used to sample the containers' stats concurrently, and how long (in seconds)
+# each container's stats stream is given before it is left behind
+docker_stats_workers = int(os.getenv('DOCKER_STATS_WORKERS', 8))
+docker_stats_timeout = float(os.getenv('DOCKER_STATS_TIMEOUT', 10))
+# "stream" takes two live samples per container on every pass, while "oneshot" takes a single sample and
+# computes the CPU usage against the previous pass. "cgroup" reads the counters of all containers straight from
+# the cgroup filesystem mounted at cgroup_root (and their network counters from cgroup_proc_root), like "oneshot",
+# and only falls back to the Docker API for the containers it cannot read
+docker_stats_mode = os.getenv('DOCKER_STATS_MODE', 'stream').lower()
+cgroup_root = os.getenv('CGROUP_ROOT', '/sys/fs/cgroup')
+cgroup_proc_root = os.getenv('CGROUP_PROC_ROOT', '/proc')
 html_templates = "templates"
 
+# all Docker API calls of a process go through a single client, which keeps up to docker_max_pool_size connections
+# open with the Docker daemon (the stats workers and the log followers each hold one), and whose health is checked
+# every docker_health_check_interval seconds
+docker_max_pool_size = int(os.getenv('DOCKER_MAX_POOL_SIZE', 32))
+docker_api_timeout = int(os.getenv('DOCKER_API_TIMEOUT', 60))
+docker_health_check_interval = float(os.getenv('DOCKER_HEALTH_CHECK_INTERVAL', 30))
+
+# how long (in seconds) the snapshots of docker info, docker system df and of the list of containers are used for,
+# before being refreshed in the background
+docker_info_ttl = float(os.getenv('DOCKER_INFO_TTL', 30))
+docker_df_ttl = float(os.getenv('DOCKER_DF_TTL', 300))
+docker_containers_ttl = float(os.getenv('DOCKER_CONTAINERS_TTL', 3))
+
+# caps for the per-container log lines kept in memory by the dashboard, shared by all log viewers
+log_buffer_lines = int(os.getenv('LOG_BUFFER_LINES', 1000))
+log_buffer_bytes = int(os.getenv('LOG_BUFFER_BYTES', 256 * 1024))
+
+# with "events", the datagateway is supervised as soon as Docker reports a change on its containers, and only
+# reconciled every supervision_reconciliation_interval seconds. With "poll", it is checked on every cycle
+supervision_mode = os.getenv('SUPERVISION_MODE', 'events').lower()
+supervision_reconciliation_interval = int(os.getenv('SUPERVISION_RECONCILIATION_INTERVAL', 60))
+
+# the supervisor tasks run on their own intervals (in seconds), on a pool of scheduler_workers threads
+scheduler_workers = int(os.getenv('SCHEDULER_WORKERS', 4))
+docker_stats_interval = float(os.getenv('DOCKER_STATS_INTERVAL', 3))
+datagateway_check_interval = float(os.getenv('DATAGATEWAY_CHECK_INTERVAL', 3))
+cert_check_interval = float(os.getenv('CERT_CHECK_INTERVAL', 3600))
+
+# calls to the management-api are given management_api_connect_timeout seconds to connect and management_api_timeout
+# seconds to answer, and are retried management_api_retries times, waiting management_api_backoff seconds before the
+# first retry, and twice as long before each of the next ones. After management_api_failure_threshold consecutive
+# failures, the management-api is not called for management_api_reset_timeout seconds
+management_api_url = os.getenv('MANAGEMENT_API_URL', 'https://management-api:5001')
+management_api_connect_timeout = float(os.getenv('MANAGEMENT_API_CONNECT_TIMEOUT', 3))
+management_api_timeout = float(os.getenv('MANAGEMENT_API_TIMEOUT', 10))
+management_api_retries = int(os.getenv('MANAGEMENT_API_RETRIES', 3))
+management_api_backoff = float(os.getenv('MANAGEMENT_API_BACKOFF', 1))
+management_api_workers = int(os.getenv('MANAGEMENT_API_WORKERS', 4))
+management_api_failure_threshold = int(os.getenv('MANAGEMENT_API_FAILURE_THRESHOLD', 5))
+management_api_reset_timeout = float(os.getenv('MANAGEMENT_API_RESET_TIMEOUT', 30))
+
 tls_sync_file = f"{data_volume}/.tls"
+# certificates which are regenerated when any of them is due to expire within cert_rotation_margin seconds
+rotated_cert_files = ["ca.pem", "server-cert.pem", "cert.pem"]
+cert_rotation_margin = int(os.getenv('CERT_ROTATION_MARGIN', 5 * 24 * 3600))
+
+# on cleanup, the NuvlaBox Engine containers are stopped concurrently, by up to shutdown_workers at a time. Each one is
+# given shutdown_stop_timeout seconds to stop, and they are all killed if not stopped within shutdown_deadline seconds
+shutdown_deadline = float(os.getenv('SHUTDOWN_DEADLINE', 30))
+shutdown_stop_timeout = int(os.getenv('SHUTDOWN_STOP_TIMEOUT', 5))
+shutdown_kill_timeout = float(os.getenv('SHUTDOWN_KILL_TIMEOUT', 10))
+shutdown_workers = int(os.getenv('SHUTDOWN_WORKERS', 16))
 
 log = logging.getLogger(__name__)
 
-with open("/proc/self/cgroup", 'r') as f:
-    docker_id = f.readlines()[0].replace('\n', '').split("/")[-1]
+_docker_id = None
+
+
+def get_docker_id():
+    """ Gets the ID of the container this process is running in, from its cgroup. It is only read once """
+
+    global _docker_id
+    if _docker_id is None:
+        with open("/proc/self/cgroup", 'r') as f:
+            _docker_id = f.readlines()[0].replace('\n', '').split("/")[-1]
+
+    return _docker_id
+
+
+def __getattr__(name):
+    """ Module attributes which are only computed when first accessed """
+
+    if name == 'docker_id':
+        return get_docker_id()
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def list_internal_containers():
     """ Gets all the containers that compose the NuvlaBox Engine """
 
-    return docker.from_env().containers.list(filters={"label": base_label})
+    # imported here, since the Docker client module depends on this one for its settings
+    from system_manager.common.docker_client import get_docker_client
+
+    return get_docker_client().containers.list(filters={"label": base_label})
 
 
-def cleanup(containers=None, exclude=None):
+def start_daemon_calls(calls, max_workers, name):
+    """ Starts calls concurrently, each in a daemon thread, so that the ones which hang neither block the other calls
+    nor keep the process from exiting, as the workers of a ThreadPoolExecutor would
+
+    :param calls: dict of key -> (function, args, kwargs)
+    :param max_workers: maximum number of calls running at the same time
+    :param name: thread name prefix
+    :returns dict of Future -> key
     """
-    Cleans up all the NuvlaBox Engine containers gracefully
+
+    semaphore = threading.BoundedSemaphore(max_workers)
+
+    def run(future, function, args, kwargs):
+        with semaphore:
+            if not future.set_running_or_notify_cancel():
+                return
+
+            try:
+                future.set_result(function(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+    futures = {}
+    for i, (key, (function, args, kwargs)) in enumerate(calls.items()):
+        future = concurrent.futures.Future()
+        threading.Thread(target=run, args=(future, function, args, kwargs), name=f'{name}_{i}', daemon=True).start()
+        futures[future] = key
+
+    return futures
+
+
+def stop_containers(docker_client, containers, deadline, stop_timeout=5):
+    """ Stops containers concurrently. Those which are not stopped by the deadline are killed
+
+    :param docker_client: Docker client
+    :param containers: list of container objects
+    :param deadline: time (as in time.time()) by which all containers must be stopped
+    :param stop_timeout: how long, in seconds, each container is given to stop, before Docker kills it
+    :returns dict of container name -> "stopped", "killed", or the reason it could not be stopped
+    """
+
+    if not containers:
+        return {}
+
+    results = {}
+    stop_calls = {}
+    for cont in containers:
+        log.warning("Stopping container %s" % cont.name)
+        timeout = max(0, min(stop_timeout, int(deadline - time.time())))
+        stop_calls[cont] = (docker_client.api.stop, (cont.id,), {"timeout": timeout})
+
+    stopping = start_daemon_calls(stop_calls, min(len(containers), shutdown_workers), 'shutdown-stop')
+    done, not_done = concurrent.futures.wait(stopping, timeout=max(0, deadline - time.time()))
+    for future in done:
+        error = future.exception()
+        results[stopping[future].name] = f"failed: {str(error)}" if error else "stopped"
+
+    # out of time: escalate to kill, in new threads since the stop calls may still be hanging on theirs, which are
+    # left behind
+    kill_calls = {}
+    for future in not_done:
+        # the stop calls still waiting for a worker are not made
+        future.cancel()
+        cont = stopping[future]
+        log.warning(f"Container {cont.name} did not stop in time. Killing it")
+        kill_calls[cont] = (docker_client.api.kill, (cont.id,), {})
+
+    if not kill_calls:
+        return results
+
+    killing = start_daemon_calls(kill_calls, len(kill_calls), 'shutdown-kill')
+    done, not_done = concurrent.futures.wait(killing, timeout=shutdown_kill_timeout)
+    for future in done:
+        error = future.exception()
+        results[killing[future].name] = f"kill failed: {str(error)}" if error else "killed"
+    for future in not_done:
+        results[killing[future].name] = "kill timed out"
+
+    return results
+
+
+def cleanup(containers=None, exclude=None, deadline=None, rank=None):
+    """
+    Cleans up all the NuvlaBox Engine containers gracefully, stopping them concurrently, under an overall deadline
 
     :param containers: list of container objects
     :param exclude: ID to exclude
-    :return:
+    :param deadline: how long, in seconds, the whole cleanup can take. Defaults to shutdown_deadline
+    :param rank: optional function giving the stop order of a container. Containers with a lower rank are stopped
+    first, and the ones with the same rank are stopped together
+    :return: dict of container name -> "stopped", "killed", "excluded", or the reason it could not be stopped
     """
 
-    if containers and isinstance(containers, list):
+    from system_manager.common.docker_client import get_docker_client
+
+    results = {}
+    if not containers or not isinstance(containers, list):
+        return results
+
+    docker_client = get_docker_client()
+    deadline = time.time() + (shutdown_deadline if deadline is None else deadline)
+
+    to_stop = []
+    for cont in containers:
+        if exclude and exclude == cont.id:
+            results[cont.name] = "excluded"
+            continue
+
+        to_stop.append(cont)
 
-        for cont in containers:
-            if exclude and exclude == cont.id:
-                pass
+    ranks = sorted(set(rank(cont) for cont in to_stop)) if rank else [None]
+    for current_rank in ranks:
+        group = [cont for cont in to_stop if rank is None or rank(cont) == current_rank]
+        results.update(stop_containers(docker_client, group, deadline, stop_timeout=shutdown_stop_timeout))
 
-            log.warning("Stopping container %s" % cont)
-            docker.from_env().api.stop(cont.id, timeout=5)
+    log.info(f"NuvlaBox Engine containers cleanup: {results}")
+    return results
 
 
 def set_operational_status(status: str):
@@ -0,0 +1,371 @@
+#!/usr/local/bin/python3.7
+# -*- coding: utf-8 -*-
+
+""" HTTP caching and compression for the dashboard, which is often reached over slow links
+
+Static files are served under content-hashed URLs (e.g. /static/js/Chart.min.0123456789ab.js), which browsers can
+keep for good, from the gzip and brotli variants precompressed when the image is built (see compress-static.py).
+The files the stylesheets refer to, like the webfonts, are also referenced by their hashed names at that point.
+
+Dynamic responses get weak ETags derived from the version of the data they show, so that an unchanged page is
+answered with a 304 without being rendered, and are compressed on the fly
+"""
+
+import collections
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+import time
+from system_manager.common.lazy import lazy_property
+from system_manager.common.logging import logging
+
+try:
+    import brotli
+except ImportError:
+    # only gzip is offered
+    brotli = None
+
+
+log = logging.getLogger(__name__)
+
+# content codings, by order of preference
+ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)
+# file name suffix of the precompressed static files, by content coding
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+# static files which are already compressed
+INCOMPRESSIBLE = ('.png', '.jpg', '.jpeg', '.gif', '.woff', '.woff2')
+# dynamic responses worth compressing
+COMPRESSIBLE_MIMETYPES = ('text/', 'application/json', 'application/javascript', 'application/openmetrics-text',
+                          'image/svg+xml')
+MIN_COMPRESS_SIZE = 512
+
+# url() references in stylesheets
+CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+# hashed static files never change, while the others must be revalidated on every use
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+
+# part of every dynamic ETag, so that a restart (e.g. an upgrade, with new templates) invalidates them
+_etag_salt = repr(time.time())
+
+
+def make_etag(*versions):
+    """ Builds a weak ETag out of the versions of the data a response is made of
+
+    :param versions: anything with a stable repr, e.g. generation counters and timestamps
+    :returns ETag, quoted
+    """
+
+    digest = hashlib.sha1(repr((_etag_salt,) + versions).encode()).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def negotiate_encoding(accept_encodings, available=ENCODINGS):
+    """ Picks the content coding of a response
+
+    :param accept_encodings: the request's Accept-Encoding, as a werkzeug Accept object
+    :param available: content codings the response can be sent with
+    :returns content coding, or None to send the response as is
+    """
+
+    best = None
+    best_quality = 0
+    for encoding in ENCODINGS:
+        quality = accept_encodings[encoding]
+        if encoding in available and quality > best_quality:
+            best, best_quality = encoding, quality
+
+    return best
+
+
+def compress(data, encoding, quality=None):
+    """ Compresses data
+
+    :param data: bytes
+    :param encoding: br or gzip
+    :param quality: compression level. Defaults to a fast one, as needed for dynamic responses
+    :returns bytes
+    """
+
+    if encoding == 'br':
+        return brotli.compress(data, quality=4 if quality is None else quality)
+
+    return gzip.compress(data, compresslevel=6 if quality is None else quality)
+
+
+class CompressionCache(object):
+    """ Keeps the last compressed bodies of the responses which have an ETag, so that the same page is only
+    compressed once per content coding
+    """
+
+    def __init__(self, size=32):
+        """ Constructs an empty cache
+
+        :param size: number of compressed bodies to keep
+        """
+
+        self.size = size
+        self.lock = threading.Lock()
+        # (ETag, content coding) -> compressed body
+        self.bodies = collections.OrderedDict()
+
+    def compress(self, data, encoding, etag=None):
+        """ Compresses data, or gets it from the cache
+
+        :param data: bytes
+        :param encoding: content coding
+        :param etag: ETag of the response. Not cached if None
+        :returns bytes
+        """
+
+        if etag is None:
+            return compress(data, encoding)
+
+        key = (etag, encoding)
+        with self.lock:
+            body = self.bodies.get(key)
+            if body is not None:
+                self.bodies.move_to_end(key)
+                return body
+
+        body = compress(data, encoding)
+        with self.lock:
+            self.bodies[key] = body
+            while len(self.bodies) > self.size:
+                self.bodies.popitem(last=False)
+
+        return body
+
+
+def compress_response(response, accept_encodings, cache=None):
+    """ Compresses a response in place, if it is worth it and the client accepts it
+
+    Streamed responses (e.g. live logs), files and responses which are already encoded are left as they are
+
+    :param response: werkzeug Response
+    :param accept_encodings: the request's Accept-Encoding, as a werkzeug Accept object
+    :param cache: CompressionCache
+    :returns the response
+    """
+
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed \
+            or 'Content-Encoding' in response.headers \
+            or not (response.mimetype or '').startswith(COMPRESSIBLE_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding(accept_encodings)
+    data = response.get_data()
+    if not encoding or len(data) < MIN_COMPRESS_SIZE:
+        return response
+
+    etag = response.headers.get('ETag')
+    body = cache.compress(data, encoding, etag) if cache else compress(data, encoding)
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def hashed_name(name, content_hash):
+    """ Inserts a content hash into a file name, before its extension
+
+    :param name: e.g. js/Chart.min.js
+    :param content_hash: hex digest
+    :returns e.g. js/Chart.min.0123456789ab.js
+    """
+
+    root, ext = os.path.splitext(name)
+    return f'{root}.{content_hash}{ext}'
+
+
+class StaticFile(object):
+    """ A static file, with its content hash and its precompressed variants """
+
+    def __init__(self, name, path, content_hash, last_modified, variants):
+        """ Constructs the record
+
+        :param name: path relative to the static folder, e.g. js/Chart.min.js
+        :param path: file path
+        :param content_hash: hex digest of the content
+        :param last_modified: modification time, as a timestamp
+        :param variants: dict of content coding -> path of the precompressed file
+        """
+
+        self.name = name
+        self.path = path
+        self.content_hash = content_hash
+        self.last_modified = last_modified
+        self.variants = variants
+        self.mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.url_name = hashed_name(name, content_hash)
+
+    def etag(self, encoding=None):
+        """ Strong ETag of one of the variants
+
+        :param encoding: content coding, or None for the file as is
+        :returns ETag, unquoted
+        """
+
+        return f'{self.content_hash}-{encoding}' if encoding else self.content_hash
+
+
+class StaticAssets(object):
+    """ Index of the static files, built on first use """
+
+    def __init__(self, folder, url_path='/static'):
+        """ Constructs the index. Nothing is read until first used
+
+        :param folder: static folder
+        :param url_path: URL the static folder is served at
+        """
+
+        self.folder = folder
+        self.url_path = url_path
+
+    @staticmethod
+    def hash_file(path):
+        """ Content hash of a file
+
+        :param path: file path
+        :returns hex digest, 12 characters long
+        """
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+
+        return digest.hexdigest()[:12]
+
+    @lazy_property
+    def files(self):
+        """ Static files, by name and by hashed name """
+
+        files = {}
+        for root, _, filenames in os.walk(self.folder):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                if any(filename.endswith(suffix) and os.path.isfile(path[:-len(suffix)])
+                       for suffix in SUFFIXES.values()):
+                    continue
+
+                st = os.stat(path)
+                variants = {}
+                for encoding in ENCODINGS:
+                    variant = path + SUFFIXES[encoding]
+                    # ignore the precompressed files which are older than the original
+                    if os.path.isfile(variant) and os.stat(variant).st_mtime >= st.st_mtime:
+                        variants[encoding] = variant
+
+                name = os.path.relpath(path, self.folder).replace(os.sep, '/')
+                static_file = StaticFile(name, path, self.hash_file(path), st.st_mtime, variants)
+                files[name] = static_file
+                files[static_file.url_name] = static_file
+
+        log.info(f'Indexed {len(files) // 2} static files in {self.folder}')
+        return files
+
+    def url(self, name):
+        """ URL of a static file, with its content hash
+
+        :param name: path relative to the static folder, e.g. js/Chart.min.js
+        :returns URL, or the plain URL if the file does not exist
+        """
+
+        static_file = self.files.get(name)
+        return f'{self.url_path}/{static_file.url_name if static_file else name}'
+
+    def find(self, name):
+        """ Finds a static file by its plain or hashed name
+
+        :param name: path relative to the static folder
+        :returns (StaticFile, True if requested by its hashed name), or (None, False)
+        """
+
+        static_file = self.files.get(name)
+        if not static_file:
+            return None, False
+
+        return static_file, name == static_file.url_name
+
+
+def hash_css_references(folder):
+    """ Rewrites the url() references of the stylesheets to other static files (e.g. ../webfonts/fa-solid-900.woff2)
+    with their content-hashed names, so that these files are requested by the hashed name, and can be cached for good
+    as well. References to files which do not exist, or which are already hashed, are left as they are
+
+    :param folder: static folder
+    :returns number of references rewritten
+    """
+
+    hashes = {}
+    rewritten = 0
+
+    def replace(match, css_folder):
+        nonlocal rewritten
+        quote, reference = match.groups()
+        if reference.startswith(('data:', '/', '#')) or '://' in reference:
+            return match.group(0)
+
+        target, query = re.match(r'([^?#]*)(.*)', reference).groups()
+        path = os.path.normpath(os.path.join(css_folder, target))
+        if not os.path.isfile(path):
+            return match.group(0)
+
+        if path not in hashes:
+            hashes[path] = StaticAssets.hash_file(path)
+
+        rewritten += 1
+        return f'url({quote}{hashed_name(target, hashes[path])}{query}{quote})'
+
+    for root, _, filenames in os.walk(folder):
+        for filename in filenames:
+            if not filename.endswith('.css'):
+                continue
+
+            path = os.path.join(root, filename)
+            with open(path, encoding='utf-8') as f:
+                css = f.read()
+
+            new_css = CSS_URL.sub(lambda match: replace(match, root), css)
+            if new_css != css:
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(new_css)
+
+    return rewritten
+
+
+def precompress(folder, min_ratio=0.9):
+    """ Writes the gzip (and brotli, if available) variants of the static files next to them, with the best
+    compression. Variants which do not save at least 10% are not kept
+
+    :param folder: static folder
+    :param min_ratio: largest compressed to original size ratio worth keeping
+    :returns number of variants written
+    """
+
+    written = 0
+    for root, _, filenames in os.walk(folder):
+        for filename in filenames:
+            if filename.endswith(tuple(SUFFIXES.values())) or filename.lower().endswith(INCOMPRESSIBLE):
+                continue
+
+            path = os.path.join(root, filename)
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            for encoding in ENCODINGS:
+                body = compress(data, encoding, quality=11 if encoding == 'br' else 9)
+                if len(body) > len(data) * min_ratio:
+                    continue
+
+                with open(path + SUFFIXES[encoding], 'wb') as f:
+                    f.write(body)
+                written += 1
+
+    return written